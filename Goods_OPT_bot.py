@@ -2,12 +2,39 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
 import logging
+import threading
+import re
+import json
+import sqlite3
+import sys
+import gzip
+import argparse
+import csv
+import tempfile
+import functools
+import heapq
+import itertools
+import multiprocessing
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from decimal import Decimal
+from collections.abc import MutableMapping
+from collections import Counter, OrderedDict, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import telebot
 import pyodbc
-from datetime import datetime
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import date, datetime
 from dotenv import load_dotenv
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+from telebot.types import (
+    InlineQueryResultArticle, InlineQueryResultCachedPhoto, InlineQueryResultPhoto, InputTextMessageContent
+)
 
 # ─────────────────────────────────────────────────────────────────────────────
 # 1. Настройка логирования
@@ -32,6 +59,127 @@ MSSQL_DATABASE = os.getenv("MSSQL_DATABASE")
 MSSQL_USERNAME = os.getenv("MSSQL_USERNAME")
 MSSQL_PASSWORD = os.getenv("MSSQL_PASSWORD")
 
+# Подписки на появление товара (/watch)
+WATCH_INTERVAL       = int(os.getenv("WATCH_INTERVAL", "300"))  # секунд между снимками остатков
+WATCH_LIMIT_PER_USER = int(os.getenv("WATCH_LIMIT_PER_USER", "50"))
+
+# Прайс-лист /pricelist: один файл на цикл PRICELIST_TTL для всех клиентов
+PRICELIST_DIR        = os.getenv("PRICELIST_DIR", "pricelists")
+PRICELIST_TTL        = int(os.getenv("PRICELIST_TTL", "900"))
+PRICELIST_BATCH_SIZE = int(os.getenv("PRICELIST_BATCH_SIZE", "50"))  # EXEC qry_goods_opt_bot в одном пакете
+
+# Поиск по названию: источник каталога (должен возвращать колонки g_id, g_name) и интервалы обновления
+CATALOG_QUERY                = os.getenv("CATALOG_QUERY", "SELECT g_id, g_name FROM dbo.List_Goods")
+CATALOG_REFRESH_INTERVAL     = int(os.getenv("CATALOG_REFRESH_INTERVAL", "600"))     # догрузка новых товаров
+CATALOG_FULL_RELOAD_INTERVAL = int(os.getenv("CATALOG_FULL_RELOAD_INTERVAL", "86400"))  # полная перезагрузка
+SEARCH_RESULTS_LIMIT         = int(os.getenv("SEARCH_RESULTS_LIMIT", "10"))
+
+# Inline-режим (@bot <код или название>)
+INLINE_CACHE_TTL      = int(os.getenv("INLINE_CACHE_TTL", "300"))      # TTL карточки товара в памяти, сек
+INLINE_CACHE_SIZE     = int(os.getenv("INLINE_CACHE_SIZE", "5000"))
+INLINE_CACHE_TIME     = int(os.getenv("INLINE_CACHE_TIME", "300"))     # cache_time для Telegram, сек
+INLINE_RESULTS_LIMIT  = int(os.getenv("INLINE_RESULTS_LIMIT", "10"))
+
+# Масштабирование: несколько процессов-воркеров с общим хранилищем состояния
+BOT_WORKERS       = int(os.getenv("BOT_WORKERS", "1"))
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "1000"))
+STATE_STORE       = os.getenv("STATE_STORE", "memory").lower()  # memory | sqlite | redis
+STATE_STORE_PATH  = os.getenv("STATE_STORE_PATH", "goods_opt_bot_state.sqlite3")
+STATE_REDIS_URL   = os.getenv("STATE_REDIS_URL", "redis://localhost:6379/0")
+STATE_KEY_PREFIX  = os.getenv("STATE_KEY_PREFIX", "goods_opt_bot")
+
+# Конвейер обновлений: типы обновлений от Telegram, потоки-обработчики и очереди по типам
+ALLOWED_UPDATES        = [kind.strip() for kind in os.getenv("ALLOWED_UPDATES", "message,callback_query,inline_query").split(",") if kind.strip()]
+UPDATE_WORKERS         = int(os.getenv("UPDATE_WORKERS", "4"))
+UPDATE_QUEUE_SIZE      = int(os.getenv("UPDATE_QUEUE_SIZE", "200"))        # на каждую очередь
+UPDATE_ENQUEUE_TIMEOUT = float(os.getenv("UPDATE_ENQUEUE_TIMEOUT", "10"))  # ожидание места в полной очереди, потом — сброс
+
+# Circuit breaker для linked server mysql_sales
+LINKED_BREAKER_FAILURES = int(os.getenv("LINKED_BREAKER_FAILURES", "3"))     # ошибок подряд до размыкания
+LINKED_BREAKER_RESET    = int(os.getenv("LINKED_BREAKER_RESET", "30"))       # секунд между пробами
+LINKED_STALE_MAX_AGE    = int(os.getenv("LINKED_STALE_MAX_AGE", "86400"))    # сколько хранить последние данные, сек
+LINKED_STALE_CACHE_SIZE = int(os.getenv("LINKED_STALE_CACHE_SIZE", "20000"))
+
+# Таймауты запросов к MSSQL по классам, сек (0 — без таймаута)
+DB_TIMEOUTS = {
+    "lookup":      int(os.getenv("DB_TIMEOUT_LOOKUP", "5")),        # быстрые выборки по ключу
+    "scan":        int(os.getenv("DB_TIMEOUT_SCAN", "20")),         # OPENQUERY и отчётные процедуры
+    "transaction": int(os.getenv("DB_TIMEOUT_TRANSACTION", "30")),  # create_transfer_opt_bot
+    "bulk":        int(os.getenv("DB_TIMEOUT_BULK", "180")),        # массовые загрузки (каталог, снимок остатков)
+}
+DB_CANCEL_GRACE = float(os.getenv("DB_CANCEL_GRACE", "2"))  # через сколько после дедлайна отменять запрос принудительно
+
+# Запись трафика для воспроизведения (пусто — запись выключена)
+TRACE_RECORD_PATH = os.getenv("TRACE_RECORD_PATH", "")
+
+# Профилирование по команде /profile (только для MANAGER_TELEGRAM_ID)
+PROFILE_DIR          = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS  = float(os.getenv("PROFILE_INTERVAL_MS", "5"))   # период семплирования стеков
+PROFILE_SAMPLE_EVERY = int(os.getenv("PROFILE_SAMPLE_EVERY", "1"))    # профилировать каждое N-е обновление
+PROFILE_MAX_MINUTES  = int(os.getenv("PROFILE_MAX_MINUTES", "60"))
+
+# Статистика работы (/stats и JSON на локальном порту; 0 — HTTP выключен)
+STATS_HTTP_HOST      = os.getenv("STATS_HTTP_HOST", "127.0.0.1")
+STATS_HTTP_PORT      = int(os.getenv("STATS_HTTP_PORT", "0"))
+DB_LATENCY_SAMPLES   = int(os.getenv("DB_LATENCY_SAMPLES", "1000"))  # последних замеров на запрос для перцентилей
+
+# HTTP-клиент Bot API: общий пул keep-alive соединений для всех потоков (0 в BOT_API_POOLED — сессии pyTelegramBotAPI)
+BOT_API_POOLED          = os.getenv("BOT_API_POOLED", "1") == "1"
+BOT_API_POOL_SIZE       = int(os.getenv("BOT_API_POOL_SIZE", "32"))        # соединений — с запасом на параллельные рассылки
+BOT_API_CONNECT_TIMEOUT = float(os.getenv("BOT_API_CONNECT_TIMEOUT", "5"))
+BOT_API_READ_TIMEOUT    = float(os.getenv("BOT_API_READ_TIMEOUT", "30"))
+BOT_API_RETRIES         = int(os.getenv("BOT_API_RETRIES", "3"))           # повторы при сбое соединения и 503 с Retry-After
+BOT_API_RETRY_BACKOFF   = float(os.getenv("BOT_API_RETRY_BACKOFF", "0.3"))
+
+# Предрасчёт «кто интересовался товаром» (qry_g_id_interesting_shops_bot)
+INTEREST_FULL_REFRESH_INTERVAL = int(os.getenv("INTEREST_FULL_REFRESH_INTERVAL", "3600"))  # перезагрузка всех активных кодов
+INTEREST_REFRESH_INTERVAL      = int(os.getenv("INTEREST_REFRESH_INTERVAL", "300"))        # догрузка новых активных кодов
+INTEREST_MAX_AGE               = int(os.getenv("INTEREST_MAX_AGE", "7200"))    # старше — читаем из БД напрямую
+INTEREST_ACTIVE_TTL            = int(os.getenv("INTEREST_ACTIVE_TTL", "86400"))  # код активен сутки после последнего запроса
+INTEREST_BATCH_SIZE            = int(os.getenv("INTEREST_BATCH_SIZE", "50"))   # процедур в одном пакете
+
+# Карточка товара для менеджеров одним пакетом запросов (nextset) вместо отдельных round trip
+PRODUCT_VIEW_BATCH = os.getenv("PRODUCT_VIEW_BATCH", "1") == "1"
+
+# Журнал заказов (append-only JSON Lines) для восстановления после падения и аудита
+ORDER_JOURNAL_PATH     = os.getenv("ORDER_JOURNAL_PATH", "orders_journal.jsonl")  # пусто — журнал выключен
+ORDER_JOURNAL_FLUSH_MS = int(os.getenv("ORDER_JOURNAL_FLUSH_MS", "200"))  # максимальная задержка записи пачки
+ORDER_JOURNAL_FSYNC    = os.getenv("ORDER_JOURNAL_FSYNC", "1") == "1"
+
+# Ограничение частоты запросов товара на пользователя (token bucket), отдельно для клиентов и менеджеров
+THROTTLE_CLIENT_RATE      = float(os.getenv("THROTTLE_CLIENT_RATE", "0.5"))   # запросов в секунду в среднем
+THROTTLE_CLIENT_BURST     = int(os.getenv("THROTTLE_CLIENT_BURST", "5"))      # запросов подряд без ожидания
+THROTTLE_MANAGER_RATE     = float(os.getenv("THROTTLE_MANAGER_RATE", "2"))
+THROTTLE_MANAGER_BURST    = int(os.getenv("THROTTLE_MANAGER_BURST", "20"))
+THROTTLE_DUPLICATE_WINDOW = float(os.getenv("THROTTLE_DUPLICATE_WINDOW", "3"))  # тот же запрос повторно — игнор, сек
+
+# Распределение заявок между оптовыми менеджерами
+OPT_ROUTING            = os.getenv("OPT_ROUTING", "broadcast").lower()      # broadcast | round_robin | least_pending
+OPT_ROUTING_TIMEOUT    = int(os.getenv("OPT_ROUTING_TIMEOUT", "300"))       # сек без решения до передачи заявки
+OPT_ROUTING_ESCALATION = os.getenv("OPT_ROUTING_ESCALATION", "reassign").lower()  # reassign | broadcast
+OPT_ROUTING_RETENTION  = int(os.getenv("OPT_ROUTING_RETENTION", "86400"))   # сколько помнить получателей решённой заявки
+
+# Сроки заявок, ожидающих решения менеджера (сек от создания; 0 — выключено)
+REQUEST_REMIND_AFTER   = int(os.getenv("REQUEST_REMIND_AFTER", "900"))     # напоминание получившим заявку
+REQUEST_ESCALATE_AFTER = int(os.getenv("REQUEST_ESCALATE_AFTER", "1800"))  # заявки опта — ещё и MANAGER_TELEGRAM_ID
+REQUEST_EXPIRE_AFTER   = int(os.getenv("REQUEST_EXPIRE_AFTER", "14400"))   # закрыть заявку и убрать кнопки
+
+# Кнопок магазинов на одной странице клавиатуры выбора магазина
+SHOP_KEYBOARD_PAGE_SIZE = int(os.getenv("SHOP_KEYBOARD_PAGE_SIZE", "8"))
+
+# Позиций в кошике клиента (/cart): все уходят менеджерам одной заявкой
+CART_MAX_LINES = int(os.getenv("CART_MAX_LINES", "30"))
+
+# Строк на странице секций карточки менеджера (магазины, интересы, залоги);
+# запрашивается только первая страница, остальные — кнопкой «Показати ще»
+STOCK_PAGE_SIZE    = int(os.getenv("STOCK_PAGE_SIZE", "5"))
+INTEREST_PAGE_SIZE = int(os.getenv("INTEREST_PAGE_SIZE", "3"))
+ZALOG_PAGE_SIZE    = int(os.getenv("ZALOG_PAGE_SIZE", "2"))
+
+# Справочник магазинов (List_Kontr) в памяти
+SHOP_DIRECTORY_REFRESH_INTERVAL = int(os.getenv("SHOP_DIRECTORY_REFRESH_INTERVAL", "3600"))
+SHOP_DIRECTORY_RETRY_INTERVAL   = int(os.getenv("SHOP_DIRECTORY_RETRY_INTERVAL", "60"))  # пауза после неудачной загрузки
+
 # Разбираем список notify-only менеджеров
 opt_manager_ids = []
 for mid in OPT_MANAGER_TELEGRAM_ID.split(","):
@@ -66,26 +214,634 @@ conn_str = (
     f"UID={MSSQL_USERNAME};"
     f"PWD={MSSQL_PASSWORD}"
 )
-logger.info(f"Connecting to MSSQL at {MSSQL_SERVER}/{MSSQL_DATABASE}")
-conn = pyodbc.connect(conn_str, autocommit=True)
-cursor = conn.cursor()
+
+# Своё подключение на каждый поток: pyodbc-курсор нельзя делить между потоками,
+# а таймаут задаётся на подключении и применяется к создаваемым курсорам
+db_local = threading.local()
+
+# Запросы в работе: id(cursor) -> (cursor, дедлайн, класс, имя)
+db_inflight = {}
+db_inflight_lock = threading.Lock()
+db_watchdog_started = False
+
+# Метрики по классам запросов
+db_query_counts = Counter()
+db_deadline_hits = Counter()
+db_cancelled = Counter()
+
+# Метрики по отдельным запросам: количество и последние длительности (для перцентилей)
+db_helper_counts = Counter()
+db_helper_latency = defaultdict(lambda: deque(maxlen=DB_LATENCY_SAMPLES))
+
+# Запись/воспроизведение трафика (см. раздел 9)
+trace_recorder = None
+trace_replayer = None
+
+# SQLSTATE: таймаут запроса, отмена, обрыв связи
+DB_TIMEOUT_STATES = ("HYT00", "HYT01", "HY008")
+DB_CONNECTION_STATES = ("08S01", "08003", "08001", "08007")
+
+def get_connection():
+    """
+    Подключение к MSSQL для текущего потока (создаётся при первом обращении).
+    """
+    conn = getattr(db_local, "conn", None)
+    if conn is None:
+        logger.info(f"Connecting to MSSQL at {MSSQL_SERVER}/{MSSQL_DATABASE} ({threading.current_thread().name})")
+        conn = pyodbc.connect(conn_str, autocommit=True)
+        db_local.conn = conn
+    return conn
+
+def reset_connection():
+    """
+    Сбрасывает подключение текущего потока — следующий запрос переподключится.
+    """
+    conn = getattr(db_local, "conn", None)
+    db_local.conn = None
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+def db_watchdog_loop():
+    """
+    Отменяет запросы, которые вышли за дедлайн, а драйвер их так и не прервал
+    (например, зависший OPENQUERY на стороне linked server).
+    """
+    while True:
+        time.sleep(0.5)
+        now = time.monotonic()
+        with db_inflight_lock:
+            expired = [item for item in db_inflight.values() if item[1] + DB_CANCEL_GRACE < now]
+        for cur, deadline, query_class, name in expired:
+            logger.warning(f"Cancelling {name} ({query_class}): deadline exceeded")
+            db_cancelled[query_class] += 1
+            try:
+                cur.cancel()
+            except Exception as e:
+                logger.error(f"Failed to cancel {name}: {e}")
+            with db_inflight_lock:
+                db_inflight.pop(id(cur), None)
+
+def is_db_timeout(error):
+    return bool(error.args) and str(error.args[0]) in DB_TIMEOUT_STATES
+
+@contextmanager
+def db_query(query_class, name):
+    """
+    Курсор для одного запроса с таймаутом класса query_class (lookup/scan/transaction/bulk).
+    Таймаут применяется через ODBC (SQL_ATTR_QUERY_TIMEOUT) и подстраховывается
+    отменой запроса из watchdog-потока. Превышения дедлайна считаются в db_deadline_hits.
+    """
+    global db_watchdog_started
+    if trace_replayer is not None:
+        yield trace_replayer.cursor(name)
+        return
+
+    timeout = DB_TIMEOUTS[query_class]
+    conn = get_connection()
+    conn.timeout = timeout
+    cur = conn.cursor()
+    if trace_recorder is not None:
+        cur = RecordingCursor(cur, name, counts_only=query_class == "bulk")
+    db_query_counts[query_class] += 1
+    db_helper_counts[name] += 1
+    started = time.perf_counter()
+
+    if timeout:
+        if not db_watchdog_started:
+            db_watchdog_started = True
+            threading.Thread(target=db_watchdog_loop, name="DBWatchdog", daemon=True).start()
+        with db_inflight_lock:
+            db_inflight[id(cur)] = (cur, time.monotonic() + timeout, query_class, name)
+
+    try:
+        yield cur
+    except pyodbc.Error as e:
+        if is_db_timeout(e):
+            db_deadline_hits[query_class] += 1
+            logger.warning(f"DB deadline hit in {name} ({query_class}, {timeout}s)")
+        elif e.args and str(e.args[0]) in DB_CONNECTION_STATES:
+            reset_connection()
+        raise
+    finally:
+        db_helper_latency[name].append(time.perf_counter() - started)
+        with db_inflight_lock:
+            db_inflight.pop(id(cur), None)
+        try:
+            cur.close()
+        except Exception:
+            pass
+
+def read_result_sets(cursor):
+    """
+    Читает все результаты пакета (fetchall по каждому nextset), пропуская служебные
+    результаты без колонок.
+    """
+    result_sets = []
+    while True:
+        if getattr(cursor, "description", ()) is not None:
+            result_sets.append(cursor.fetchall())
+        if not cursor.nextset():
+            return result_sets
+
+def read_marked_result_sets(cursor, marker):
+    """
+    Читает пакет, где после каждого запроса идёт набор-метка «SELECT ? AS {marker}»:
+    возвращает {значение метки: первый набор перед ней} ([] — запрос ничего не вернул).
+    Лишний или недостающий набор одного запроса не сдвигает результаты соседних.
+    """
+    result = {}
+    rows = None
+    while True:
+        description = getattr(cursor, "description", None)
+        if description is not None:
+            result_set = cursor.fetchall()
+            if description[0][0] == marker:
+                result[result_set[0][0]] = rows if rows is not None else []
+                rows = None
+            elif rows is None:
+                rows = result_set
+        if not cursor.nextset():
+            return result
+
+# ─────────────────────────────────────────────────────────────────────────────
+# 4. Хранилище состояния пользователей
+# ─────────────────────────────────────────────────────────────────────────────
+def _state_json_default(value):
+    """
+    Сериализация значений из БД, которых нет в JSON (pyodbc.Row, Decimal, даты).
+    """
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (tuple, set, pyodbc.Row)):
+        return list(value)
+    raise TypeError(f"Unsupported state value: {type(value)}")
+
+class SQLiteStateStore:
+    """
+    Хранилище состояния в локальном SQLite (режим WAL) — общее для процессов на одной машине.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        db = self.connection()
+        db.execute("CREATE TABLE IF NOT EXISTS state (ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (ns, key))")
+
+    def connection(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    def get(self, ns, key):
+        row = self.connection().execute("SELECT value FROM state WHERE ns = ? AND key = ?", (ns, key)).fetchone()
+        return row[0] if row else None
+
+    def set(self, ns, key, value):
+        self.connection().execute("INSERT OR REPLACE INTO state (ns, key, value) VALUES (?, ?, ?)", (ns, key, value))
+
+    def delete(self, ns, key):
+        return self.connection().execute("DELETE FROM state WHERE ns = ? AND key = ?", (ns, key)).rowcount > 0
+
+    def modify(self, ns, key, fn):
+        """
+        Атомарно для всех процессов: value = fn(старое значение или None), None — удалить.
+        BEGIN IMMEDIATE сразу берёт блокировку записи, поэтому чтение и запись не перемежаются с чужими.
+        """
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT value FROM state WHERE ns = ? AND key = ?", (ns, key)).fetchone()
+            value = fn(row[0] if row else None)
+            if value is None:
+                db.execute("DELETE FROM state WHERE ns = ? AND key = ?", (ns, key))
+            else:
+                db.execute("INSERT OR REPLACE INTO state (ns, key, value) VALUES (?, ?, ?)", (ns, key, value))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return value
+
+    def pop(self, ns, key):
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT value FROM state WHERE ns = ? AND key = ?", (ns, key)).fetchone()
+            if row:
+                db.execute("DELETE FROM state WHERE ns = ? AND key = ?", (ns, key))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return row[0] if row else None
+
+    def items(self, ns):
+        return self.connection().execute("SELECT key, value FROM state WHERE ns = ?", (ns,)).fetchall()
+
+    def count(self, ns):
+        return self.connection().execute("SELECT COUNT(*) FROM state WHERE ns = ?", (ns,)).fetchone()[0]
+
+class RedisStateStore:
+    """
+    Хранилище состояния в Redis-совместимом сервере: по одному hash на пространство имён.
+    """
+
+    def __init__(self, url, prefix):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("STATE_STORE=redis requires the 'redis' package (pip install redis)")
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    def get(self, ns, key):
+        return self.client.hget(f"{self.prefix}:{ns}", key)
+
+    def set(self, ns, key, value):
+        self.client.hset(f"{self.prefix}:{ns}", key, value)
+
+    def delete(self, ns, key):
+        return self.client.hdel(f"{self.prefix}:{ns}", key) > 0
+
+    def modify(self, ns, key, fn):
+        """
+        Атомарно для всех процессов: WATCH/MULTI, при чужой записи в hash — повтор (fn вызывается заново).
+        """
+        name = f"{self.prefix}:{ns}"
+
+        def transaction(pipe):
+            value = fn(pipe.hget(name, key))
+            pipe.multi()
+            if value is None:
+                pipe.hdel(name, key)
+            else:
+                pipe.hset(name, key, value)
+            return value
+
+        return self.client.transaction(transaction, name, value_from_callable=True)
+
+    def pop(self, ns, key):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hget(f"{self.prefix}:{ns}", key)
+        pipe.hdel(f"{self.prefix}:{ns}", key)
+        value, _ = pipe.execute()
+        return value
+
+    def items(self, ns):
+        return list(self.client.hgetall(f"{self.prefix}:{ns}").items())
+
+    def count(self, ns):
+        return self.client.hlen(f"{self.prefix}:{ns}")
+
+class SharedDict(MutableMapping):
+    """
+    Словарь поверх общего хранилища: ключи и значения хранятся в JSON.
+    Вложенные значения надо переприсваивать целиком — изменения «на месте» не сохраняются.
+    """
+
+    def __init__(self, store, ns):
+        self.store = store
+        self.ns = ns
+
+    def __getitem__(self, key):
+        value = self.store.get(self.ns, json.dumps(key))
+        if value is None:
+            raise KeyError(key)
+        return json.loads(value)
+
+    def __setitem__(self, key, value):
+        self.store.set(self.ns, json.dumps(key), json.dumps(value, default=_state_json_default))
+
+    def __delitem__(self, key):
+        if not self.store.delete(self.ns, json.dumps(key)):
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter([json.loads(key) for key, value in self.store.items(self.ns)])
+
+    def __len__(self):
+        return self.store.count(self.ns)
+
+    def pop(self, key, *default):
+        value = self.store.pop(self.ns, json.dumps(key))
+        if value is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return json.loads(value)
+
+    def modify(self, key, fn):
+        def apply(value):
+            value = fn(None if value is None else json.loads(value))
+            return None if value is None else json.dumps(value, default=_state_json_default)
+
+        value = self.store.modify(self.ns, json.dumps(key), apply)
+        return None if value is None else json.loads(value)
+
+    def items(self):
+        return [(json.loads(key), json.loads(value)) for key, value in self.store.items(self.ns)]
+
+if STATE_STORE == "sqlite":
+    state_store = SQLiteStateStore(STATE_STORE_PATH)
+elif STATE_STORE == "redis":
+    state_store = RedisStateStore(STATE_REDIS_URL, STATE_KEY_PREFIX)
+else:
+    state_store = None
+
+if BOT_WORKERS > 1 and state_store is None:
+    raise RuntimeError("BOT_WORKERS > 1 requires a shared STATE_STORE (sqlite or redis)")
+
+def make_state_dict(ns):
+    """
+    Состояние в памяти процесса (по умолчанию) или в общем хранилище, если оно настроено.
+    """
+    return SharedDict(state_store, ns) if state_store else {}
+
+state_modify_lock = threading.Lock()
+
+def modify_state(state, key, fn):
+    """
+    Атомарное чтение-изменение-запись значения: fn(старое значение или None) -> новое (None — удалить).
+    В общем хранилище — транзакцией хранилища (атомарно и между процессами), в памяти — под
+    state_modify_lock. fn может вызываться повторно и не должна иметь побочных эффектов.
+    """
+    if isinstance(state, SharedDict):
+        return state.modify(key, fn)
+    with state_modify_lock:
+        value = fn(state.get(key))
+        if value is None:
+            state.pop(key, None)
+        else:
+            state[key] = value
+        return value
 
 # ─────────────────────────────────────────────────────────────────────────────
-# 4. Инициализация бота
+# 5. Инициализация бота
 # ─────────────────────────────────────────────────────────────────────────────
 bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
 
+# Лимиты Telegram на длину текста (в UTF-16 code units)
+TELEGRAM_CAPTION_LIMIT = 1024
+TELEGRAM_MESSAGE_LIMIT = 4096
+
 # Глобальные переменные для хранения состояния пользователей
-user_context = {}
-user_last_product_code = {}
-user_urgency_choice = {}
-user_self_delivery_mode = {}
-user_selected_shop = {}
-user_self_delivery_pending = {}
-user_receiver_name = {}  # Новое: ФИО получателя для самовывоза
-user_waiting_for_receiver = {}  # Новое: ожидание ввода ФИО
-manager_self_delivery_responses = {}  # Новое: ответы менеджеров по самовывозу
-manager_shop_selection_responses = {}  # Новое: ответы менеджеров по выбору магазина для обычных заказов
+user_context = make_state_dict("user_context")
+user_last_product_code = make_state_dict("user_last_product_code")
+user_urgency_choice = make_state_dict("user_urgency_choice")
+user_self_delivery_mode = make_state_dict("user_self_delivery_mode")
+user_selected_shop = make_state_dict("user_selected_shop")
+user_self_delivery_shops = make_state_dict("user_self_delivery_shops")  # telegram_id -> {"code", "shops"}: магазины, показанные клиенту
+user_self_delivery_pending = make_state_dict("user_self_delivery_pending")
+user_receiver_name = make_state_dict("user_receiver_name")  # Новое: ФИО получателя для самовывоза
+user_waiting_for_receiver = make_state_dict("user_waiting_for_receiver")  # Новое: ожидание ввода ФИО
+manager_self_delivery_responses = make_state_dict("manager_self_delivery_responses")  # Новое: ответы менеджеров по самовывозу
+manager_shop_selection_responses = make_state_dict("manager_shop_selection_responses")  # Новое: ответы менеджеров по выбору магазина для обычных заказов
+stock_watches = make_state_dict("stock_watches")  # g_id -> список telegram_id: подписки на появление товара
+stock_watch_snapshot = {}  # g_id -> суммарный остаток на момент последнего снимка
+stock_watches_lock = threading.Lock()
+pending_requests = make_state_dict("pending_requests")  # ключ заявки -> {"type": ..., "created": unix time}
+opt_request_assignments = make_state_dict("opt_request_assignments")  # ключ заявки -> кому и что отправлено
+request_messages = make_state_dict("request_messages")  # ключ заявки -> [[chat_id, message_id], ...] карточек с кнопками
+request_shop_lists = make_state_dict("request_shop_lists")  # ключ заявки -> магазины в кнопках заявки ([K_ID, имя, ...])
+user_carts = make_state_dict("user_carts")  # telegram_id -> список кодов товаров в кошике
+cart_requests = make_state_dict("cart_requests")  # ключ заявки кошика -> клиент, терміновість и позиции с выбранными магазинами
+request_timer_claims = make_state_dict("request_timer_claims")  # ключ заявки -> {срок: время}: сроки, уже выполненные каким-то процессом
+transfer_claims = make_state_dict("transfer_claims")  # ключ заявки -> время: заявки, по которым уже вызывается create_transfer_opt_bot
+
+class DeadlineScheduler:
+    """
+    Планировщик отложенных действий на куче: постановка O(log n), один поток спит до
+    ближайшего срока. Отмены нет — действие само проверяет, актуально ли оно ещё
+    (например, что заявка не решена и не пересоздана).
+    """
+
+    def __init__(self):
+        self.heap = []  # (monotonic-время срабатывания, порядковый номер, действие, аргументы)
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.started = False
+        self.fired = Counter()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, delay, action, *args):
+        with self.cond:
+            if not self.started:
+                self.started = True
+                threading.Thread(target=self.run, name="DeadlineScheduler", daemon=True).start()
+            entry = (time.monotonic() + max(0, delay), next(self.seq), action, args)
+            heapq.heappush(self.heap, entry)
+            if self.heap[0] is entry:
+                self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.cond.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                _, _, action, args = heapq.heappop(self.heap)
+            self.fired[action.__name__] += 1
+            try:
+                action(*args)
+            except Exception as e:
+                logger.error(f"Scheduled {action.__name__}{args} failed: {e}")
+
+request_scheduler = DeadlineScheduler()
+request_deadline_counter = Counter()  # reminded / escalated / expired
+order_states = make_state_dict("order_states")  # ключ заявки -> последнее состояние из журнала заказов
+
+class OrderJournal:
+    """
+    Журнал заказов: заявки, решения менеджеров и вызовы create_transfer_opt_bot пишутся
+    строками JSON в append-only файл. Обработчики только кладут событие в очередь в памяти,
+    на диск пачками пишет фоновый поток. При старте журнал перечитывается: восстанавливаются
+    ожидающие заявки и отметки об уже отправленных заказах.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = deque()
+        self.wakeup = threading.Event()
+        self.written = 0
+        self.batches = 0
+        self.write_errors = 0
+        self.writer_started = False
+
+    @staticmethod
+    def apply(states, record):
+        """
+        Применяет событие журнала к словарю состояний заявок.
+        """
+        event = record["ev"]
+
+        def next_state(state):
+            if event == "request":
+                # Детали заявки (uid, code/codes, K_ID, ...) нужны для восстановления pending_requests
+                details = {name: value for name, value in record.items() if name not in ("ts", "ev", "key", "type")}
+                state = {"type": record.get("type"), "status": "pending", "transfer": None, "created": record["ts"],
+                         "details": details}
+            else:
+                state = dict(state or {"type": None, "status": "unknown", "transfer": None, "created": record["ts"]})
+                if event == "decision":
+                    state["status"] = record.get("decision")
+                elif event == "transfer_started":
+                    state["transfer"] = "started"
+                elif event == "transfer_submitted":
+                    state["transfer"] = "submitted"
+                    state["result"] = record.get("result")
+                elif event == "transfer_failed":
+                    state["transfer"] = "failed"
+                    state["error"] = record.get("error")
+            state["ts"] = record["ts"]
+            return state
+
+        modify_state(states, record["key"], next_state)
+
+    def append(self, event, key, **fields):
+        """
+        Записывает событие: сразу в состояние заявок и в очередь на запись. Не блокирует.
+        """
+        record = {"ts": round(time.time(), 3), "ev": event, "key": key, **fields}
+        self.apply(order_states, record)
+        self.pending.append(record)
+        self.wakeup.set()
+
+    def writer_loop(self):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        # Строка, оборванная падением процесса, не должна склеиться со следующей записью
+        if os.path.getsize(self.path):
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    os.write(fd, b"\n")
+        while True:
+            self.wakeup.wait()
+            # Копим события ORDER_JOURNAL_FLUSH_MS, чтобы писать и fsync-ать пачкой
+            time.sleep(ORDER_JOURNAL_FLUSH_MS / 1000)
+            self.wakeup.clear()
+            self.flush(fd)
+
+    def flush(self, fd):
+        batch = []
+        while self.pending:
+            batch.append(self.pending.popleft())
+        if not batch:
+            return
+        data = "".join(json.dumps(record, ensure_ascii=False, default=_state_json_default) + "\n" for record in batch)
+        try:
+            # Одна запись на пачку: в режиме O_APPEND строки разных процессов не перемешиваются
+            os.write(fd, data.encode("utf-8"))
+            if ORDER_JOURNAL_FSYNC:
+                os.fsync(fd)
+        except OSError as e:
+            self.write_errors += 1
+            logger.error(f"Failed to write {len(batch)} order journal records: {e}")
+            self.pending.extendleft(reversed(batch))
+            return
+        self.written += len(batch)
+        self.batches += 1
+
+    def start(self):
+        if not self.writer_started:
+            self.writer_started = True
+            threading.Thread(target=self.writer_loop, name="OrderJournal", daemon=True).start()
+
+    @staticmethod
+    def read(path):
+        """
+        Построчно читает журнал; повреждённая последняя строка (падение во время записи) пропускается.
+        """
+        with open(path, encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning(f"Skipping malformed order journal line {line_no}")
+
+    def recover(self):
+        """
+        Восстанавливает состояние заявок из журнала: ожидающие заявки возвращаются
+        в pending_requests, незавершённые вызовы create_transfer_opt_bot попадают в лог.
+        """
+        if not os.path.exists(self.path):
+            return
+        states = {}
+        records = 0
+        for record in self.read(self.path):
+            self.apply(states, record)
+            records += 1
+        restored = 0
+        for key, state in states.items():
+            modify_state(order_states, key, lambda current: state if current is None or current.get("ts", 0) < state["ts"] else current)
+            if state["status"] == "pending" and key not in pending_requests:
+                pending_requests[key] = {"type": state["type"], "created": state["created"], **state.get("details", {})}
+                restored += 1
+            if state["transfer"] == "started":
+                logger.warning(f"Order {key}: create_transfer_opt_bot was started but its result is unknown, "
+                               f"repeat submission is blocked until a new request")
+        logger.info(f"Order journal recovered: {records} records, {len(states)} orders, {restored} pending restored")
+
+order_journal = OrderJournal(ORDER_JOURNAL_PATH) if ORDER_JOURNAL_PATH else None
+
+def journal_order_event(event, key, **fields):
+    if order_journal is not None:
+        order_journal.append(event, key, **fields)
+
+def transfer_already_submitted(order_key):
+    """
+    True, если по этой заявке create_transfer_opt_bot уже вызывался (успешно или с неизвестным исходом).
+    """
+    state = order_states.get(order_key)
+    return bool(state and state.get("transfer") in ("started", "submitted"))
+
+def claim_transfer(order_key):
+    """
+    Атомарно отмечает заявку как оформляемую. True только у первого вызова —
+    работает и без журнала заказов, и между процессами.
+    """
+    claimed = False
+
+    def claim(current):
+        nonlocal claimed
+        claimed = current is None
+        return time.time() if claimed else current
+
+    modify_state(transfer_claims, order_key, claim)
+    return claimed
+
+def track_pending_request(request_key, request_type, **details):
+    """
+    Запоминает заявку, ожидающую решения менеджера.
+    """
+    created = time.time()
+    pending_requests[request_key] = {"type": request_type, "created": created, **details}
+    request_messages[request_key] = []
+    request_timer_claims.pop(request_key, None)
+    transfer_claims.pop(request_key, None)
+    journal_order_event("request", request_key, type=request_type, **details)
+    schedule_request_timers(request_key, created)
+
+def resolve_pending_request(request_key, decision=None, **details):
+    """
+    Убирает заявку из ожидающих (менеджер принял решение).
+    """
+    pending_requests.pop(request_key, None)
+    request_messages.pop(request_key, None)
+    request_shop_lists.pop(request_key, None)
+    cart_requests.pop(request_key, None)
+    request_timer_claims.pop(request_key, None)
+    if decision:
+        journal_order_event("decision", request_key, decision=decision, **details)
 
 def clear_user_cache(uid):
     """
@@ -101,6 +857,9 @@ def clear_user_cache(uid):
     if uid in user_waiting_for_receiver:
         del user_waiting_for_receiver[uid]
     
+    # Очищаем список магазинов самовывоза, показанный клиенту
+    user_self_delivery_shops.pop(uid, None)
+    
     # Очищаем кэш ответов менеджеров по самовывозу
     keys_to_remove = []
     for key in manager_self_delivery_responses.keys():
@@ -123,8 +882,182 @@ def clear_user_cache(uid):
     
     logger.debug(f"[clear_user_cache] cache cleared for user {uid}")
 
+class TTLCache:
+    """
+    Потокобезопасный LRU-кэш в памяти с временем жизни записей.
+    """
+
+    def __init__(self, ttl, maxsize=1000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.data = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def __len__(self):
+        return len(self.data)
+
+class InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных запросов: пока запрос с ключом (функция, аргументы)
+    выполняется, остальные вызовы с тем же ключом ждут и получают его результат.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}  # (имя, аргументы) -> InFlightCall
+        self.calls = Counter()
+        self.merged = Counter()
+
+    def do(self, name, key, fn):
+        with self.lock:
+            self.calls[name] += 1
+            call = self.inflight.get((name, key))
+            leader = call is None
+            if leader:
+                call = self.inflight[(name, key)] = InFlightCall()
+            else:
+                self.merged[name] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[(name, key)]
+            call.done.set()
+        return call.result
+
+single_flight = SingleFlight()
+
+def coalesced(func):
+    """
+    Декоратор для функций чтения из БД: одинаковые одновременные вызовы выполняют один запрос.
+    Результат общий для всех ожидавших — изменять его на месте нельзя.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        return single_flight.do(func.__name__, key, lambda: func(*args, **kwargs))
+    return wrapper
+
+class RequestThrottle:
+    """
+    Ограничение частоты запросов на пользователя: token bucket с лимитами по роли
+    и отбрасывание повторов того же запроса в течение THROTTLE_DUPLICATE_WINDOW.
+    В режиме нескольких воркеров пользователь всегда попадает в один процесс,
+    поэтому состояния в памяти процесса достаточно.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.users = OrderedDict()  # telegram_id -> {"tokens", "updated", "last_key", "last_at", "notified"}
+        self.lock = threading.Lock()
+        self.allowed = 0
+        self.duplicates = 0
+        self.throttled = 0
+
+    @staticmethod
+    def limits(uid):
+        if uid in manager_ids or uid in opt_manager_ids:
+            return THROTTLE_MANAGER_RATE, THROTTLE_MANAGER_BURST
+        return THROTTLE_CLIENT_RATE, THROTTLE_CLIENT_BURST
+
+    def check(self, uid, key):
+        """
+        Возвращает "ok", "duplicate" (повтор того же запроса — молча пропускаем),
+        "throttled" (первое превышение — ответить пользователю) или "silent" (превышение
+        после уже отправленного предупреждения).
+        """
+        rate, burst = self.limits(uid)
+        now = time.monotonic()
+        with self.lock:
+            state = self.users.get(uid)
+            if state is None:
+                state = {"tokens": burst, "updated": now, "last_key": None, "last_at": 0.0, "notified": False}
+                self.users[uid] = state
+                while len(self.users) > self.maxsize:
+                    self.users.popitem(last=False)
+            self.users.move_to_end(uid)
+
+            if key == state["last_key"] and now - state["last_at"] < THROTTLE_DUPLICATE_WINDOW:
+                self.duplicates += 1
+                return "duplicate"
+
+            state["tokens"] = min(burst, state["tokens"] + (now - state["updated"]) * rate)
+            state["updated"] = now
+            if state["tokens"] < 1:
+                self.throttled += 1
+                if state["notified"]:
+                    return "silent"
+                state["notified"] = True
+                return "throttled"
+
+            state["tokens"] -= 1
+            state["last_key"] = key
+            state["last_at"] = now
+            state["notified"] = False
+            self.allowed += 1
+            return "ok"
+
+request_throttle = RequestThrottle()
+
+def throttle_request(uid, key):
+    """
+    True, если запрос можно обрабатывать. При первом превышении лимита отправляет
+    пользователю короткое предупреждение, дальше до восстановления лимита молчит.
+    """
+    verdict = request_throttle.check(uid, key)
+    if verdict == "ok":
+        return True
+    logger.debug(f"[throttle_request] user={uid}, key={key}: {verdict}")
+    if verdict == "throttled":
+        try:
+            bot.send_message(uid, "⏳ Забагато запитів. Зачекайте кілька секунд і спробуйте ще раз.")
+        except Exception as e:
+            logger.error(f"Failed to send throttle notice to {uid}: {e}")
+    return False
+
 # ─────────────────────────────────────────────────────────────────────────────
-# 5. Вспомогательные функции
+# 6. Вспомогательные функции
 # ─────────────────────────────────────────────────────────────────────────────
 def is_allowed_user(telegram_id: int) -> bool:
     """
@@ -133,7 +1066,8 @@ def is_allowed_user(telegram_id: int) -> bool:
     """
     logger.debug(f"[is_allowed_user] checking {telegram_id}")
     try:
-        cursor.execute("""
+        with db_query("lookup", "is_allowed_user") as cursor:
+            cursor.execute("""
 			SELECT
     t.ID,
     t.K_ID,
@@ -150,7 +1084,7 @@ LEFT JOIN dbo.List_Emploees AS e
     ON t.Emp_ID = e.Emp_ID
             WHERE t.Telegram_ID = ?
         """, telegram_id)
-        row = cursor.fetchone()
+            row = cursor.fetchone()
     except Exception as e:
         logger.error(f"DB error in is_allowed_user: {e}")
         return False
@@ -170,630 +1104,2327 @@ LEFT JOIN dbo.List_Emploees AS e
 
     return False
 
+def make_product(row):
+    """
+    Строка qry_goods_opt_bot -> словарь товара.
+    """
+    return {
+        "Код": row[0],
+        "Название": row[1],
+        "Цена": row[2],
+        "Brand_ID": row[3],  # строго Brand_ID
+        "Фото": row[4]
+    }
+
+@coalesced
 def get_product_info(code: int):
     logger.debug(f"[get_product_info] code={code}")
     try:
-        cursor.execute("EXEC qry_goods_opt_bot ?", code)
-        row = cursor.fetchone()
+        with db_query("lookup", "get_product_info") as cursor:
+            cursor.execute("EXEC qry_goods_opt_bot ?", code)
+            row = cursor.fetchone()
         logger.debug(f"[get_product_info] row={row}")
         if row:
-            return {
-                "Код": row[0],
-                "Название": row[1],
-                "Цена": row[2],
-                "Brand_ID": row[3],  # строго Brand_ID
-                "Фото": row[4]
-            }
+            return make_product(row)
     except Exception as e:
         logger.error(f"DB error in get_product_info: {e}")
     return None
 
-def get_stock_info(code: int):
+class CircuitBreaker:
     """
-    Получение информации о наличии товара в магазинах через OPENQUERY.
+    Circuit breaker: после failure_threshold ошибок подряд цепь размыкается, и вызовы
+    сразу получают отказ. Пока цепь разомкнута, фоновый поток раз в reset_timeout
+    выполняет probe() и замыкает цепь при первом успехе.
     """
-    logger.debug(f"[get_stock_info] code={code}")
-    try:
-        query = """
-            SELECT k.K_Name, o.g_id, o.ostatok 
-            FROM OPENQUERY(mysql_sales,'
-                SELECT ko_id, g_id, ostatok FROM ostatki
-                UNION ALL
-                SELECT stock_id, g_id, ostatok FROM ostatki_sklad
-            ') AS o 
-            INNER JOIN dbo.List_Kontr AS k ON o.ko_id = k.K_ID
-            WHERE o.g_id = ?
-        """
-        cursor.execute(query, code)
-        return cursor.fetchall()
-    except Exception as e:
-        logger.error(f"DB error in get_stock_info: {e}")
-        return []
+    CLOSED = "closed"
+    OPEN = "open"
 
-def get_available_shops(code: int):
+    def __init__(self, name, failure_threshold, reset_timeout, probe):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe = probe
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.open_count = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        return self.state == self.CLOSED
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.OPEN or self.failures < self.failure_threshold:
+                return
+            self.state = self.OPEN
+            self.opened_at = datetime.now()
+            self.open_count += 1
+        logger.warning(f"Circuit {self.name} opened after {self.failures} failures")
+        threading.Thread(target=self.probe_loop, name=f"Probe-{self.name}", daemon=True).start()
+
+    def probe_loop(self):
+        while True:
+            time.sleep(self.reset_timeout)
+            try:
+                self.probe()
+            except Exception as e:
+                logger.debug(f"[{self.name}] probe failed: {e}")
+                continue
+            with self.lock:
+                self.state = self.CLOSED
+                self.failures = 0
+                self.opened_at = None
+            logger.warning(f"Circuit {self.name} closed, probe succeeded")
+            return
+
+class LinkedServerRows(list):
     """
-    Получение списка всех доступных магазинов с наличием товара.
+    Строки из linked server. as_of — время, на которое данные актуальны, если отдали
+    сохранённую копию; unavailable — если linked server недоступен и копии нет.
     """
-    logger.debug(f"[get_available_shops] code={code}")
-    try:
-        query = """
-            SELECT k.K_ID, k.K_Name, o.ostatok 
-            FROM OPENQUERY(mysql_sales,'
-                SELECT ko_id, g_id, ostatok FROM ostatki
-                UNION ALL
-                SELECT stock_id, g_id, ostatok FROM ostatki_sklad
-            ') AS o 
-            INNER JOIN dbo.List_Kontr AS k ON o.ko_id = k.K_ID
-            WHERE o.g_id = ? AND o.ostatok > 0
-            ORDER BY o.ostatok DESC
-        """
-        cursor.execute(query, code)
-        return cursor.fetchall()
-    except Exception as e:
-        logger.error(f"DB error in get_available_shops: {e}")
-        return []
 
-def get_self_delivery_shops(code: int):
+    def __init__(self, rows=(), as_of=None, unavailable=False):
+        super().__init__(rows)
+        self.as_of = as_of
+        self.unavailable = unavailable
+
+def probe_mysql_sales():
+    with db_query("lookup", "probe_mysql_sales") as cursor:
+        cursor.execute("SELECT * FROM OPENQUERY(mysql_sales, 'SELECT 1')")
+        cursor.fetchall()
+
+def is_linked_server_error(error):
     """
-    Получение списка магазинов для самовывоза из Киева.
+    Ошибка, за которую отвечает mysql_sales: сообщение провайдера linked server или
+    дедлайн запроса (зависает в пакете именно OPENQUERY). Ошибки локальных процедур
+    и расхождения схемы цепь не размыкают.
     """
-    logger.debug(f"[get_self_delivery_shops] code={code}")
+    if not isinstance(error, pyodbc.Error):
+        return False
+    return is_db_timeout(error) or "linked server" in str(error).lower()
+
+mysql_sales_breaker = CircuitBreaker("mysql_sales", LINKED_BREAKER_FAILURES, LINKED_BREAKER_RESET, probe_mysql_sales)
+linked_server_last_good = TTLCache(LINKED_STALE_MAX_AGE, LINKED_STALE_CACHE_SIZE)
+
+def linked_server_query(name, key, fetch):
+    """
+    Выполняет запрос к mysql_sales через circuit breaker. Успешный результат запоминается;
+    при ошибке или разомкнутой цепи возвращается последний удачный результат с отметкой времени.
+    """
+    if mysql_sales_breaker.allow():
+        try:
+            rows = fetch()
+        except Exception as e:
+            logger.error(f"DB error in {name}: {e}")
+            mysql_sales_breaker.record_failure()
+        else:
+            mysql_sales_breaker.record_success()
+            linked_server_last_good.set((name, key), (rows, datetime.now()))
+            return LinkedServerRows(rows)
+    else:
+        logger.debug(f"[{name}] mysql_sales circuit is open, serving last good data for {key}")
+
+    cached = linked_server_last_good.get((name, key))
+    if cached is None:
+        return LinkedServerRows(unavailable=True)
+    rows, fetched_at = cached
+    return LinkedServerRows(rows, as_of=fetched_at)
+
+def make_stale_note(rows):
+    """
+    Пометка для карточки, если данные linked server не свежие.
+    """
+    if getattr(rows, "unavailable", False):
+        return "⚠️ Дані про наявність тимчасово недоступні"
+    as_of = getattr(rows, "as_of", None)
+    if as_of:
+        return f"⚠️ Дані станом на {as_of:%H:%M}"
+    return None
+
+class ShopDirectory:
+    """
+    Справочник магазинов List_Kontr в памяти: K_ID -> название.
+    Подменяется целиком при перезагрузке, поэтому чтение не требует блокировок.
+    """
+
+    def __init__(self, shops=None):
+        self.shops = shops or {}  # K_ID -> {"name": ...}
+        self.loaded_at = None
+
+    def __len__(self):
+        return len(self.shops)
+
+    def __contains__(self, shop_id):
+        return shop_id in self.shops
+
+    @property
+    def loaded(self):
+        return self.loaded_at is not None
+
+    def name(self, shop_id, default=None):
+        shop = self.shops.get(shop_id)
+        return shop["name"] if shop else default
+
+    def with_names(self, rows):
+        """
+        Строки (K_ID, ...) -> (K_ID, K_Name, ...); неизвестные K_ID отбрасываются, как при INNER JOIN.
+        """
+        return [(row[0], self.shops[row[0]]["name"], *row[1:]) for row in rows if row[0] in self.shops]
+
+shop_directory = ShopDirectory()
+shop_directory_lock = threading.Lock()
+shop_directory_failed_at = None  # time.monotonic() последней неудачной загрузки по запросу
+
+def load_shop_directory():
+    """
+    Загружает справочник магазинов одним запросом и подменяет shop_directory.
+    """
+    global shop_directory
+    logger.debug("[load_shop_directory] loading List_Kontr")
+    try:
+        with db_query("bulk", "load_shop_directory") as cursor:
+            cursor.execute("SELECT K_ID, K_Name FROM dbo.List_Kontr")
+            rows = cursor.fetchall()
+    except Exception as e:
+        logger.error(f"DB error in load_shop_directory: {e}")
+        return False
+    shops = {}
+    for row in rows:
+        name = (row[1] or "").strip()
+        shops[int(row[0])] = {"name": name}
+    directory = ShopDirectory(shops)
+    directory.loaded_at = datetime.now()
+    shop_directory = directory
+    logger.info(f"Shop directory loaded: {len(directory)} shops")
+    return True
+
+def ensure_shop_directory():
+    """
+    Загружает справочник при первом обращении, если фоновая загрузка ещё не успела.
+    Пока загрузка падает, повтор — не чаще SHOP_DIRECTORY_RETRY_INTERVAL, и обработчики
+    не ждут чужую загрузку: без справочника запросы идут через JOIN с List_Kontr.
+    """
+    global shop_directory_failed_at
+    if shop_directory.loaded:
+        return True
+    if shop_directory_failed_at is not None and time.monotonic() - shop_directory_failed_at < SHOP_DIRECTORY_RETRY_INTERVAL:
+        return False
+    if not shop_directory_lock.acquire(blocking=False):
+        return shop_directory.loaded
     try:
+        if not shop_directory.loaded and not load_shop_directory():
+            shop_directory_failed_at = time.monotonic()
+    finally:
+        shop_directory_lock.release()
+    return shop_directory.loaded
+
+def shop_directory_refresh_loop():
+    """
+    Периодическая перезагрузка справочника магазинов.
+    """
+    while True:
+        try:
+            with shop_directory_lock:
+                load_shop_directory()
+        except Exception as e:
+            logger.error(f"Error in shop directory refresh loop: {e}")
+        time.sleep(SHOP_DIRECTORY_REFRESH_INTERVAL)
+
+# Остатки по магазинам: K_ID без названия (названия из shop_directory) и с JOIN на List_Kontr.
+# Строки секции stock в обоих случаях: (название, g_id, остаток, K_ID)
+STOCK_BY_SHOP_ID_QUERY = """
+    SELECT o.ko_id, o.g_id, o.ostatok
+    FROM OPENQUERY(mysql_sales,'
+        SELECT ko_id, g_id, ostatok FROM ostatki
+        UNION ALL
+        SELECT stock_id, g_id, ostatok FROM ostatki_sklad
+    ') AS o
+    WHERE o.g_id = ?
+"""
+STOCK_JOINED_QUERY = """
+    SELECT k.K_Name, o.g_id, o.ostatok, k.K_ID
+    FROM OPENQUERY(mysql_sales,'
+        SELECT ko_id, g_id, ostatok FROM ostatki
+        UNION ALL
+        SELECT stock_id, g_id, ostatok FROM ostatki_sklad
+    ') AS o 
+    INNER JOIN dbo.List_Kontr AS k ON o.ko_id = k.K_ID
+    WHERE o.g_id = ?
+"""
+
+@coalesced
+def get_stock_info(code: int):
+    """
+    Получение информации о наличии товара в магазинах через OPENQUERY.
+    Названия магазинов берутся из shop_directory; без справочника — JOIN с List_Kontr.
+    """
+    logger.debug(f"[get_stock_info] code={code}")
+    if ensure_shop_directory():
+        def fetch():
+            with db_query("scan", "get_stock_info") as cursor:
+                cursor.execute(STOCK_BY_SHOP_ID_QUERY, code)
+                rows = cursor.fetchall()
+            return [(*row[1:], row[0]) for row in shop_directory.with_names(rows)]
+
+        return linked_server_query("get_stock_info", code, fetch)
+
+    def fetch():
+        with db_query("scan", "get_stock_info") as cursor:
+            cursor.execute(STOCK_JOINED_QUERY, code)
+            return cursor.fetchall()
+
+    return linked_server_query("get_stock_info", code, fetch)
+
+@coalesced
+def get_available_shops(code: int):
+    """
+    Получение списка всех доступных магазинов с наличием товара.
+    Названия магазинов берутся из shop_directory; без справочника — JOIN с List_Kontr.
+    """
+    logger.debug(f"[get_available_shops] code={code}")
+    if ensure_shop_directory():
         query = """
-            SELECT TOP 5 K_ID, k_name 
-            FROM vw_goods_ost_bot 
-            WHERE k_name LIKE '/Киев%' AND g_id = ?
+            SELECT o.ko_id, o.ostatok
+            FROM OPENQUERY(mysql_sales,'
+                SELECT ko_id, g_id, ostatok FROM ostatki
+                UNION ALL
+                SELECT stock_id, g_id, ostatok FROM ostatki_sklad
+            ') AS o
+            WHERE o.g_id = ? AND o.ostatok > 0
+            ORDER BY o.ostatok DESC
         """
-        cursor.execute(query, code)
-        return cursor.fetchall()
+
+        def fetch():
+            with db_query("scan", "get_available_shops") as cursor:
+                cursor.execute(query, code)
+                return shop_directory.with_names(cursor.fetchall())
+
+        return linked_server_query("get_available_shops", code, fetch)
+
+    query = """
+        SELECT k.K_ID, k.K_Name, o.ostatok 
+        FROM OPENQUERY(mysql_sales,'
+            SELECT ko_id, g_id, ostatok FROM ostatki
+            UNION ALL
+            SELECT stock_id, g_id, ostatok FROM ostatki_sklad
+        ') AS o 
+        INNER JOIN dbo.List_Kontr AS k ON o.ko_id = k.K_ID
+        WHERE o.g_id = ? AND o.ostatok > 0
+        ORDER BY o.ostatok DESC
+    """
+
+    def fetch():
+        with db_query("scan", "get_available_shops") as cursor:
+            cursor.execute(query, code)
+            return cursor.fetchall()
+
+    return linked_server_query("get_available_shops", code, fetch)
+
+SELF_DELIVERY_SHOPS_QUERY = """
+    SELECT TOP 5 K_ID, k_name 
+    FROM vw_goods_ost_bot 
+    WHERE k_name LIKE '/Киев%' AND g_id = ?
+"""
+
+@coalesced
+def get_self_delivery_shops(code: int):
+    """
+    Получение списка магазинов для самовывоза из Киева.
+    """
+    logger.debug(f"[get_self_delivery_shops] code={code}")
+    try:
+        with db_query("lookup", "get_self_delivery_shops") as cursor:
+            cursor.execute(SELF_DELIVERY_SHOPS_QUERY, code)
+            return cursor.fetchall()
     except Exception as e:
         logger.error(f"DB error in get_self_delivery_shops: {e}")
         return []
 
-def get_shops_for_sensitive_brand(code: int):
+# В vw_goods_ost_bot у магазина может быть несколько строк по товару — DISTINCT делает
+# ключ (k_name, K_ID) уникальным, иначе строки повторялись бы или терялись на границе страниц
+SENSITIVE_SHOPS_QUERY = """
+    SELECT DISTINCT TOP (?) K_ID, k_name 
+    FROM vw_goods_ost_bot 
+    WHERE g_id = ?
+    ORDER BY k_name, K_ID
+"""
+# Следующая страница: keyset по (k_name, K_ID) последнего показанного магазина
+SENSITIVE_SHOPS_AFTER_QUERY = """
+    SELECT DISTINCT TOP (?) v.K_ID, v.k_name
+    FROM vw_goods_ost_bot AS v
+    CROSS JOIN (SELECT MIN(k_name) AS k_name FROM vw_goods_ost_bot WHERE g_id = ? AND K_ID = ?) AS last
+    WHERE v.g_id = ? AND (v.k_name > last.k_name OR (v.k_name = last.k_name AND v.K_ID > ?))
+    ORDER BY v.k_name, v.K_ID
+"""
+
+@coalesced
+def get_shops_for_sensitive_brand(code: int, after=None):
     """
-    Получение списка магазинов где есть товар для бренд-чувствительных товаров.
-    Использует запрос: select K_ID, k_name from vw_goods_ost_bot where g_id = ?
+    Получение списка магазинов где есть товар для бренд-чувствительных товаров (vw_goods_ost_bot).
+    Одна страница: STOCK_PAGE_SIZE + 1 строка (лишняя — признак следующей страницы),
+    после магазина after (K_ID) или с начала.
     """
-    logger.debug(f"[get_shops_for_sensitive_brand] code={code}")
+    logger.debug(f"[get_shops_for_sensitive_brand] code={code}, after={after}")
     try:
-        query = """
-            SELECT K_ID, k_name 
-            FROM vw_goods_ost_bot 
-            WHERE g_id = ?
-            ORDER BY k_name
-        """
-        cursor.execute(query, code)
-        return cursor.fetchall()
+        with db_query("lookup", "get_shops_for_sensitive_brand") as cursor:
+            if after is None:
+                cursor.execute(SENSITIVE_SHOPS_QUERY, STOCK_PAGE_SIZE + 1, code)
+            else:
+                cursor.execute(SENSITIVE_SHOPS_AFTER_QUERY, STOCK_PAGE_SIZE + 1, code, after, code, after)
+            return cursor.fetchall()
     except Exception as e:
         logger.error(f"DB error in get_shops_for_sensitive_brand: {e}")
         return []
 
+OPT_SHOPS_QUERY = """
+    SELECT 
+        k.K_ID,
+        k.k_name
+    FROM 
+        OPENQUERY(mysql_sales, '
+            SELECT 
+                stock_id AS ko_id, 
+                g_id, 
+                ostatok  
+            FROM 
+                ostatki_sklad
+        ') AS o
+    INNER JOIN 
+        list_kontr AS k ON o.ko_id = k.K_ID
+    WHERE 
+        o.g_id = ?
+
+    UNION ALL
+
+    SELECT TOP 10
+        K_ID,
+        k_name
+    FROM 
+        vw_goods_ost_bot
+    WHERE g_id = ?
+"""
+
+@coalesced
 def get_shops_for_opt_managers(code: int):
     """
     Получение списка магазинов для выбора OPT_MANAGER_TELEGRAM_ID.
     Использует новый запрос с UNION ALL для получения магазинов из остатков и Киевских магазинов.
     """
     logger.debug(f"[get_shops_for_opt_managers] code={code}")
-    try:
-        query = """
-            SELECT 
-                k.K_ID,
-                k.k_name
-            FROM 
-                OPENQUERY(mysql_sales, '
-                    SELECT 
-                        stock_id AS ko_id, 
-                        g_id, 
-                        ostatok  
-                    FROM 
-                        ostatki_sklad
-                ') AS o
-            INNER JOIN 
-                list_kontr AS k ON o.ko_id = k.K_ID
-            WHERE 
-                o.g_id = ?
 
-            UNION ALL
+    def fetch():
+        with db_query("scan", "get_shops_for_opt_managers") as cursor:
+            cursor.execute(OPT_SHOPS_QUERY, code, code)
+            return cursor.fetchall()
 
-            SELECT TOP 10
-                K_ID,
-                k_name
-            FROM 
-                vw_goods_ost_bot
-            WHERE g_id = ?
-        """
-        cursor.execute(query, code, code)
-        return cursor.fetchall()
-    except Exception as e:
-        logger.error(f"DB error in get_shops_for_opt_managers: {e}")
-        return []
+    return linked_server_query("get_shops_for_opt_managers", code, fetch)
 
 
 
+@coalesced
 def is_sensitive_brand(brand_id: int) -> bool:
     """
     Проверка флага чувствительности бренда в tbl_Brand_Goods_OPT_bot.
     """
     logger.debug(f"[is_sensitive_brand] brand_id={brand_id}")
     try:
-        cursor.execute(
-            "SELECT Flag FROM tbl_Brand_Goods_OPT_bot WHERE Brand_ID = ?",
-            brand_id
-        )
-        row = cursor.fetchone()
+        with db_query("lookup", "is_sensitive_brand") as cursor:
+            cursor.execute(
+                "SELECT Flag FROM tbl_Brand_Goods_OPT_bot WHERE Brand_ID = ?",
+                brand_id
+            )
+            row = cursor.fetchone()
         return bool(row and row[0] == 1)
     except Exception as e:
         logger.error(f"DB error in is_sensitive_brand: {e}")
         return False
 
+@coalesced
 def get_interest_info(code: int):
     """
     Вызов qry_g_id_interesting_shops_bot — клиенты, интересовавшиеся товаром за 2 недели.
+    При ошибке БД возвращает None (не пустой список), чтобы сбой не попал в индекс интересов.
     """
     try:
-        cursor.execute("EXEC qry_g_id_interesting_shops_bot ?", code)
-        return cursor.fetchall()
+        with db_query("scan", "get_interest_info") as cursor:
+            cursor.execute("EXEC qry_g_id_interesting_shops_bot ?", code)
+            return cursor.fetchall()
     except Exception as e:
         logger.error(f"DB error in get_interest_info: {e}")
-        return []
+        return None
 
-def get_zalog_info(code: int):
+class InterestIndex:
     """
-    Получение информации о залогах товара через OPENQUERY.
+    Индекс интересов по g_id в памяти: строки qry_g_id_interesting_shops_bot и время загрузки.
+    Активные коды (те, по которым недавно спрашивали) фоново перезагружаются пакетами.
     """
-    sql_inner = (
-        "SELECT g.created_at, g.product_id, f.name as filial_name, "
-        "g.amount, g.interest_rate, s.name as seller_name, s.phone "
-        "FROM secunda.guarantees g "
-        "LEFT JOIN secunda.guarantee_products gp ON g.id = gp.guarantee_id "
-        "LEFT JOIN secunda.filial f ON g.filial_id = f.id "
-        "LEFT JOIN secunda.sellers s ON g.seller_id = s.id "
-        "WHERE DATE(g.created_at) >= DATE_SUB(CURDATE(), INTERVAL 1 year) "
-        "AND g.is_issued = 0 "
-    )
-    query = f"SELECT * FROM OPENQUERY(mysql_sales, '{sql_inner}') WHERE product_id = ?"
-    logger.debug(f"[get_zalog_info] code={code}")
-    try:
-        cursor.execute(query, code)
-        return cursor.fetchall()
-    except Exception as e:
-        logger.error(f"DB error in get_zalog_info: {e}")
-        return []
 
-def make_manager_card(product, ctx, urgent, interest=None, zalog=None, stock=None, status_note=None):
+    def __init__(self):
+        self.rows = {}    # g_id -> (строки, время загрузки)
+        self.active = {}  # g_id -> время последнего обращения
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, code):
+        now = time.time()
+        with self.lock:
+            self.active[code] = now
+            item = self.rows.get(code)
+            if item and now - item[1] < INTEREST_MAX_AGE:
+                self.hits += 1
+                return item[0]
+            self.misses += 1
+            return None
+
+    def put(self, code, rows):
+        with self.lock:
+            self.rows[code] = (rows, time.time())
+
+    def codes_to_refresh(self, full):
+        """
+        Активные коды для перезагрузки: все (full) или только ещё не загруженные.
+        Коды, по которым давно не спрашивали, из индекса удаляются.
+        """
+        now = time.time()
+        with self.lock:
+            for code in [code for code, seen in self.active.items() if now - seen > INTEREST_ACTIVE_TTL]:
+                del self.active[code]
+                self.rows.pop(code, None)
+            if full:
+                return list(self.active)
+            return [code for code in self.active if code not in self.rows]
+
+interest_index = InterestIndex()
+
+def load_interest_batch(codes):
     """
-    Формирует полный текст карточки товара для MANAGER_TELEGRAM_ID с интересами, залогами и наличием.
+    Загружает интересы по нескольким кодам за один round trip: пакет из EXEC
+    qry_g_id_interesting_shops_bot, результаты читаются через nextset(). После каждого
+    EXEC идёт набор-метка с кодом: строки товара — первый набор его процедуры, даже если
+    процедура вернёт несколько наборов.
     """
-    lines = []
-    if status_note:
-        lines.append(status_note)
-    lines.append(f"\U0001F4E6 Код: {product['Код']}")
-    lines.append(f"\U0001F4DB Название: {product['Название']}")
-    lines.append(f"\U0001F4B0 Ціна: {product['Цена']} грн")
-    lines.append(f"Клієнт: [ID: {ctx['K_ID']}] {ctx['K_Name']} ({ctx['FIO']})")
-    lines.append(f"Менеджер клієнта: {ctx['Employee_FIO']}")
-    lines.append(f"Терміновість: {'Термінове' if urgent else 'Не термінове'}")
-    
-    if stock:
-        lines.append("\n\U0001F4E5 Наявність у магазинах:")
-        # Ограничиваем количество магазинов до 5
-        for i, row in enumerate(stock[:5]):
-            lines.append(f"- {row[0]} • {row[2]} шт.")
-        if len(stock) > 5:
-            lines.append(f"... та ще {len(stock) - 5} магазинів")
-    
-    if interest:
-        lines.append("\n\U0001F575️ Цим товаром за останні два тижні цікавилися:")
-        # Ограничиваем количество записей до 3
-        for i, row in enumerate(interest[:3]):
-            date = row[0].strftime("%d.%m.%Y")
-            lines.append(f"- {date} • {row[1]} • {row[2]} • {row[3]}")
-        if len(interest) > 3:
-            lines.append(f"... та ще {len(interest) - 3} запитів")
-    
-    if zalog:
-        lines.append("\n\U0001F4BC Товар зараз у заставі:")
-        # Ограничиваем количество записей до 2
-        for i, row in enumerate(zalog[:2]):
-            ondate = row[0].strftime("%d.%m.%Y")
-            lines.append(f"- {ondate} • {row[2]} • {row[5]} • {row[6]}")
-        if len(zalog) > 2:
-            lines.append(f"... та ще {len(zalog) - 2} застав")
-    
-    return "\n".join(lines)
+    logger.debug(f"[load_interest_batch] {len(codes)} codes")
+    sql = "SET NOCOUNT ON; " + " ".join(
+        "EXEC qry_g_id_interesting_shops_bot ?; SELECT ? AS interest_batch_code;" for _ in codes
+    )
+    with db_query("bulk", "load_interest_batch") as cursor:
+        cursor.execute(sql, *[param for code in codes for param in (code, code)])
+        return read_marked_result_sets(cursor, "interest_batch_code")
 
-def make_product_card_only(product, ctx, urgent, status_note=None):
+def refresh_interest_index(full):
+    codes = interest_index.codes_to_refresh(full)
+    for start in range(0, len(codes), INTEREST_BATCH_SIZE):
+        batch = codes[start:start + INTEREST_BATCH_SIZE]
+        try:
+            for code, rows in load_interest_batch(batch).items():
+                interest_index.put(code, rows)
+        except Exception as e:
+            logger.error(f"DB error in load_interest_batch: {e}")
+            return
+    if codes:
+        logger.debug(f"[refresh_interest_index] full={full}, refreshed {len(codes)} codes")
+
+def interest_refresh_loop():
     """
-    Формирует только карточку товара без дополнительной информации.
+    Фоновое обновление индекса интересов: полная перезагрузка активных кодов раз в
+    INTEREST_FULL_REFRESH_INTERVAL, между ними — догрузка новых кодов.
     """
-    lines = []
-    if status_note:
-        lines.append(status_note)
-    lines.append(f"📦 Код: {product['Код']}")
-    lines.append(f"📋 Название: {product['Название']}")
-    lines.append(f"💰 Ціна: {product['Цена']} грн")
-    lines.append(f"Клієнт: [ID: {ctx['K_ID']}] {ctx['K_Name']} ({ctx['FIO']})")
-    lines.append(f"Менеджер клієнта: {ctx['Employee_FIO']}")
-    lines.append(f"Терміновість: {'Термінове' if urgent else 'Не термінове'}")
-    
-    return "\n".join(lines)
+    last_full_refresh = time.time()
+    while True:
+        time.sleep(INTEREST_REFRESH_INTERVAL)
+        try:
+            full = time.time() - last_full_refresh >= INTEREST_FULL_REFRESH_INTERVAL
+            refresh_interest_index(full)
+            if full:
+                last_full_refresh = time.time()
+        except Exception as e:
+            logger.error(f"Error in interest refresh loop: {e}")
 
-def make_interest_info_message(interest):
+def get_interest_info_cached(code: int):
     """
-    Формирует сообщение с информацией о заинтересованных клиентах.
+    Интересы по товару из предрасчитанного индекса; при промахе — прямой вызов процедуры.
     """
-    if not interest:
-        return None
-    
-    lines = []
-    lines.append("🔍 Цим товаром за останні два тижні цікавилися:")
-    
-    for i, row in enumerate(interest):
-        date = row[0].strftime("%d.%m.%Y")
-        lines.append(f"- {date} • {row[1]} • {row[2]} • {row[3]}")
-    
-    return "\n".join(lines)
+    rows = interest_index.get(code)
+    if rows is not None:
+        return rows
+    rows = get_interest_info(code)
+    if rows is None:
+        return []
+    interest_index.put(code, rows)
+    return rows
 
-def make_zalog_info_message(zalog):
+# DISTINCT: LEFT JOIN с guarantee_products повторяет залог по числу его товаров,
+# а keyset по (created_at, guarantee_id) требует уникального ключа
+ZALOG_INNER_QUERY = (
+    "SELECT DISTINCT g.created_at, g.product_id, f.name as filial_name, "
+    "g.amount, g.interest_rate, s.name as seller_name, s.phone, g.id as guarantee_id "
+    "FROM secunda.guarantees g "
+    "LEFT JOIN secunda.guarantee_products gp ON g.id = gp.guarantee_id "
+    "LEFT JOIN secunda.filial f ON g.filial_id = f.id "
+    "LEFT JOIN secunda.sellers s ON g.seller_id = s.id "
+    "WHERE DATE(g.created_at) >= DATE_SUB(CURDATE(), INTERVAL 1 year) "
+    "AND g.is_issued = 0 "
+)
+ZALOG_QUERY = (
+    f"SELECT TOP (?) * FROM OPENQUERY(mysql_sales, '{ZALOG_INNER_QUERY}') WHERE product_id = ? "
+    "ORDER BY created_at DESC, guarantee_id DESC"
+)
+# Следующая страница: keyset по (created_at, guarantee_id) последнего показанного залога
+ZALOG_AFTER_QUERY = (
+    f"SELECT TOP (?) * FROM OPENQUERY(mysql_sales, '{ZALOG_INNER_QUERY}') WHERE product_id = ? "
+    "AND (created_at < ? OR (created_at = ? AND guarantee_id < ?)) "
+    "ORDER BY created_at DESC, guarantee_id DESC"
+)
+
+@coalesced
+def get_zalog_info(code: int, after=None):
     """
-    Формирует сообщение с информацией о залогах товара.
+    Получение информации о залогах товара через OPENQUERY, от новых к старым.
+    Одна страница: ZALOG_PAGE_SIZE + 1 строка, после залога after = (created_at, guarantee_id) или с начала.
     """
-    if not zalog:
-        return None
-    
-    lines = []
-    lines.append("🏦 Товар зараз у заставі:")
-    
-    for i, row in enumerate(zalog):
-        ondate = row[0].strftime("%d.%m.%Y")
-        lines.append(f"- {ondate} • {row[2]} • {row[5]} • {row[6]}")
-    
-    return "\n".join(lines)
+    logger.debug(f"[get_zalog_info] code={code}, after={after}")
 
-def make_stock_info_message(shops):
+    def fetch():
+        with db_query("scan", "get_zalog_info") as cursor:
+            if after is None:
+                cursor.execute(ZALOG_QUERY, ZALOG_PAGE_SIZE + 1, code)
+            else:
+                created_at, guarantee_id = after
+                cursor.execute(ZALOG_AFTER_QUERY, ZALOG_PAGE_SIZE + 1, code, created_at, created_at, guarantee_id)
+            return cursor.fetchall()
+
+    return linked_server_query("get_zalog_info", code if after is None else (code, after), fetch)
+
+@dataclass
+class ProductView:
     """
-    Формирует сообщение с информацией о магазинах где есть товар.
+    Всё, что нужно карточкам товара для менеджеров: товар и секции (наличие, интересы,
+    залоги, списки магазинов). Незапрошенные секции остаются пустыми.
     """
-    if not shops:
-        return None
-    
-    lines = []
-    lines.append("🏪 Наявність у магазинах:")
-    
-    for i, row in enumerate(shops):
-        lines.append(f"- {row[1]} (ID: {row[0]})")
-    
-    return "\n".join(lines)
+    product: dict
+    sensitive: bool = False
+    stock: list = field(default_factory=LinkedServerRows)
+    interest: list = field(default_factory=list)
+    zalog: list = field(default_factory=LinkedServerRows)
+    sensitive_shops: list = field(default_factory=list)
+    opt_shops: list = field(default_factory=LinkedServerRows)
+    self_delivery_shops: list = field(default_factory=list)
+
+    @property
+    def code(self):
+        return self.product['Код']
 
+    @property
+    def photo(self):
+        return self.product['Фото']
 
+# Наборы секций для разных карточек
+MANAGER_VIEW_SECTIONS = ("brand", "stock", "interest", "zalog", "sensitive_shops", "opt_shops")
+DECISION_VIEW_SECTIONS = ("stock", "opt_shops")
+SELF_DELIVERY_VIEW_SECTIONS = ("self_delivery_shops",)
 
-def make_opt_manager_card(product, ctx, urgent, stock=None, status_note=None):
+# Секции, которые читаются через linked server mysql_sales (с circuit breaker и последними данными)
+LINKED_VIEW_SECTIONS = {"stock": "get_stock_info", "zalog": "get_zalog_info", "opt_shops": "get_shops_for_opt_managers"}
+
+def fetch_product_view_separately(code, sections):
     """
-    Формирует текст карточки товара для OPT_MANAGER_TELEGRAM_ID БЕЗ интересов и залогов.
+    Карточка товара отдельными запросами — по одному round trip на секцию.
     """
-    lines = []
-    if status_note:
-        lines.append(status_note)
-    lines.append(f"\U0001F4E6 Код: {product['Код']}")
-    lines.append(f"\U0001F4DB Название: {product['Название']}")
-    lines.append(f"\U0001F4B0 Ціна: {product['Цена']} грн")
-    lines.append(f"Клієнт: [ID: {ctx['K_ID']}] {ctx['K_Name']} ({ctx['FIO']})")
-    lines.append(f"Менеджер клієнта: {ctx['Employee_FIO']}")
-    lines.append(f"Терміновість: {'Термінове' if urgent else 'Не термінове'}")
-    
-    return "\n".join(lines)
+    product = get_product_info(code)
+    if not product:
+        return None
+    view = ProductView(product)
+    if "brand" in sections:
+        view.sensitive = is_sensitive_brand(product['Brand_ID']) if product['Brand_ID'] else False
+    if "stock" in sections:
+        view.stock = get_stock_info(code)
+    if "interest" in sections:
+        view.interest = get_interest_info_cached(code)
+    if "zalog" in sections:
+        view.zalog = get_zalog_info(code)
+    if "sensitive_shops" in sections:
+        view.sensitive_shops = get_shops_for_sensitive_brand(code)
+    if "opt_shops" in sections:
+        view.opt_shops = get_shops_for_opt_managers(code)
+    if "self_delivery_shops" in sections:
+        view.self_delivery_shops = get_self_delivery_shops(code)
+    return view
 
-def make_self_delivery_card(product, ctx, selected_shop, available_shops, receiver_name=None, status_note=None):
+def fetch_product_view_batched(code, sections):
     """
-    Формирует карточку для самовывоза с выбором магазина.
+    Карточка товара одним пакетом: все запросы секций в одном batch, после каждого —
+    набор-метка с номером запроса, результаты читаются через nextset(). Интересы берутся
+    из индекса, если он свежий.
     """
-    lines = []
-    if status_note:
-        lines.append(status_note)
-    lines.append(f"\U0001F4E6 Код: {product['Код']}")
-    lines.append(f"\U0001F4DB Название: {product['Название']}")
-    lines.append(f"\U0001F4B0 Ціна: {product['Цена']} грн")
-    lines.append(f"Клієнт: [ID: {ctx['K_ID']}] {ctx['K_Name']} ({ctx['FIO']})")
-    lines.append(f"Менеджер клієнта: {ctx['Employee_FIO']}")
-    lines.append(f"\n\U0001F4E5 Обраний магазин клієнтом: {selected_shop[1]}")
-    
-    if receiver_name:
-        lines.append(f"\U0001F464 Отримувач: {receiver_name}")
-    
-    if available_shops:
-        lines.append("\n\U0001F4E5 Доступні магазини для самовивозу:")
-        for shop in available_shops:
-            lines.append(f"- {shop[1]} (ID: {shop[0]})")
-    
-    return "\n".join(lines)
+    interest = interest_index.get(code) if "interest" in sections else None
+    by_shop_id = "stock" in sections and ensure_shop_directory()
+    statements = [("product", "EXEC qry_goods_opt_bot ?", (code,))]
+    if "brand" in sections:
+        statements.append(("brand", "SELECT Brand_ID FROM tbl_Brand_Goods_OPT_bot WHERE Flag = 1", ()))
+    if "stock" in sections:
+        statements.append(("stock", STOCK_BY_SHOP_ID_QUERY if by_shop_id else STOCK_JOINED_QUERY, (code,)))
+    if "interest" in sections and interest is None:
+        statements.append(("interest", "EXEC qry_g_id_interesting_shops_bot ?", (code,)))
+    if "zalog" in sections:
+        statements.append(("zalog", ZALOG_QUERY, (ZALOG_PAGE_SIZE + 1, code)))
+    if "sensitive_shops" in sections:
+        statements.append(("sensitive_shops", SENSITIVE_SHOPS_QUERY, (STOCK_PAGE_SIZE + 1, code)))
+    if "opt_shops" in sections:
+        statements.append(("opt_shops", OPT_SHOPS_QUERY, (code, code)))
+    if "self_delivery_shops" in sections:
+        statements.append(("self_delivery_shops", SELF_DELIVERY_SHOPS_QUERY, (code,)))
 
-def send_opt_manager_notification(product, ctx, urgent, status_note, stock=None):
-    full_text = make_opt_manager_card(product, ctx, urgent, stock, status_note)
-    for m_id in opt_manager_ids:
+    sql = "SET NOCOUNT ON; " + " ".join(f"{query.strip()}; SELECT ? AS view_section;" for _, query, _ in statements)
+    params = [param for index, (_, _, statement_params) in enumerate(statements) for param in (*statement_params, index)]
+    with db_query("scan", "fetch_product_view") as cursor:
+        cursor.execute(sql, *params)
+        result_sets = read_marked_result_sets(cursor, "view_section")
+    if len(result_sets) != len(statements):
+        raise RuntimeError(f"expected {len(statements)} sections, got {len(result_sets)}")
+    results = {section: result_sets[index] for index, (section, _, _) in enumerate(statements)}
+
+    if not results["product"]:
+        return None
+    view = ProductView(make_product(results["product"][0]))
+    if "brand" in results:
+        view.sensitive = view.product['Brand_ID'] in {row[0] for row in results["brand"]}
+    if "stock" in results:
+        rows = results["stock"]
+        results["stock"] = [(*row[1:], row[0]) for row in shop_directory.with_names(rows)] if by_shop_id else rows
+    if "interest" in results:
+        interest = results["interest"]
+        interest_index.put(code, interest)
+    if interest is not None:
+        view.interest = interest
+    for section in ("sensitive_shops", "self_delivery_shops"):
+        if section in results:
+            setattr(view, section, results[section])
+    for section, name in LINKED_VIEW_SECTIONS.items():
+        if section in results:
+            linked_server_last_good.set((name, code), (results[section], datetime.now()))
+            setattr(view, section, LinkedServerRows(results[section]))
+    if any(section in results for section in LINKED_VIEW_SECTIONS):
+        mysql_sales_breaker.record_success()
+    return view
+
+@coalesced
+def fetch_product_view(code, sections=MANAGER_VIEW_SECTIONS, batched=None):
+    """
+    Карточка товара для менеджеров. По умолчанию (PRODUCT_VIEW_BATCH) — одним пакетом;
+    при разомкнутом circuit breaker или ошибке пакета — отдельными запросами, которые
+    отдадут последние удачные данные linked server.
+    """
+    logger.debug(f"[fetch_product_view] code={code}, sections={sections}")
+    if batched is None:
+        batched = PRODUCT_VIEW_BATCH
+    uses_linked_server = any(section in LINKED_VIEW_SECTIONS for section in sections)
+    if batched and (not uses_linked_server or mysql_sales_breaker.allow()):
         try:
-            bot.send_photo(m_id, product['Фото'], caption=full_text)
+            return fetch_product_view_batched(code, sections)
         except Exception as e:
-            logger.error(f"Failed to send to opt manager {m_id}: {e}")
+            logger.error(f"DB error in fetch_product_view: {e}")
+            if uses_linked_server and is_linked_server_error(e):
+                mysql_sales_breaker.record_failure()
+    return fetch_product_view_separately(code, sections)
 
-def send_sensitive_brand_notification(product, ctx, urgent, uid, code):
+def get_stock_snapshot():
     """
-    Отправляет разбитые сообщения менеджеру для бренд-чувствительных товаров.
+    Снимок суммарных остатков по всем товарам за один проход OPENQUERY.
+    Возвращает словарь {g_id: остаток} только для товаров, которые есть в наличии.
     """
-    logger.debug(f"[send_sensitive_brand_notification] sending to manager for sensitive brand, code={code}")
-    
-    if not manager_ids:
-        logger.error("ERROR: No confirmation managers configured! Cannot send notification.")
-        return False
-    
-    # Получаем всю информацию
-    interest = get_interest_info(code)
-    zalog = get_zalog_info(code)
-    shops = get_shops_for_sensitive_brand(code)
-    
-    # Формируем сообщения
-    card_text = make_product_card_only(product, ctx, urgent, "🔔 Клієнт зацікавився товаром (чувствительный бренд)")
-    interest_text = make_interest_info_message(interest)
-    zalog_text = make_zalog_info_message(zalog)
-    stock_text = make_stock_info_message(shops)
-    
-    # Создаем клавиатуру
-    keyboard = InlineKeyboardMarkup(row_width=1)
-    keyboard.add(
-        InlineKeyboardButton("✅ Підтвердити", callback_data=f"approve_{uid}_{code}"),
-        InlineKeyboardButton("❌ Відхилити", callback_data=f"reject_{uid}_{code}")
-    )
-    
-    success = True
-    
-    for manager_id in manager_ids:
+    logger.debug("[get_stock_snapshot] loading stock snapshot")
+    if not mysql_sales_breaker.allow():
+        logger.debug("[get_stock_snapshot] mysql_sales circuit is open, skipping snapshot")
+        return None
+    try:
+        query = """
+            SELECT o.g_id, SUM(o.ostatok)
+            FROM OPENQUERY(mysql_sales,'
+                SELECT ko_id, g_id, ostatok FROM ostatki WHERE ostatok > 0
+                UNION ALL
+                SELECT stock_id, g_id, ostatok FROM ostatki_sklad WHERE ostatok > 0
+            ') AS o
+            INNER JOIN dbo.List_Kontr AS k ON o.ko_id = k.K_ID
+            GROUP BY o.g_id
+        """
+        with db_query("bulk", "get_stock_snapshot") as cursor:
+            cursor.execute(query)
+            snapshot = {row[0]: row[1] for row in cursor.fetchall()}
+    except Exception as e:
+        logger.error(f"DB error in get_stock_snapshot: {e}")
+        mysql_sales_breaker.record_failure()
+        return None
+    mysql_sales_breaker.record_success()
+    return snapshot
+
+def add_stock_watch(uid, code):
+    """
+    Подписывает пользователя на появление товара. Возвращает False, если достигнут лимит подписок.
+    """
+    if uid in stock_watches.get(code, []):
+        return True
+    user_watch_count = sum(1 for watchers in stock_watches.values() if uid in watchers)
+    if user_watch_count >= WATCH_LIMIT_PER_USER:
+        return False
+    # Список подписчиков меняется атомарно: /watch, /unwatch и снятие подписок после
+    # снимка из разных процессов не затирают друг друга
+    modify_state(stock_watches, code, lambda subscribers: subscribers if subscribers and uid in subscribers
+                 else (subscribers or []) + [uid])
+    logger.debug(f"[add_stock_watch] user={uid}, code={code}")
+    return True
+
+def remove_stock_watch(uid, code):
+    """
+    Отписывает пользователя от товара. Возвращает True, если подписка была.
+    """
+    removed = False
+
+    def unsubscribe(subscribers):
+        nonlocal removed
+        removed = bool(subscribers) and uid in subscribers
+        if not removed:
+            return subscribers
+        return [watcher for watcher in subscribers if watcher != uid] or None
+
+    if modify_state(stock_watches, code, unsubscribe) is None:
+        with stock_watches_lock:
+            stock_watch_snapshot.pop(code, None)
+    if not removed:
+        return False
+    logger.debug(f"[remove_stock_watch] user={uid}, code={code}")
+    return True
+
+def diff_stock_snapshot(previous, current, watched):
+    """
+    Инкрементальное сравнение снимков: возвращает g_id из watched, которых раньше
+    не было в наличии, а теперь появились. Стоимость — O(количество подписок).
+    """
+    appeared = []
+    for code in watched:
+        if previous.get(code, 0) <= 0 and current.get(code, 0) > 0:
+            appeared.append(code)
+    return appeared
+
+def check_stock_watches():
+    """
+    Один проход проверки подписок: один снимок остатков на все подписки сразу.
+    Подписчикам товаров, которые появились в наличии, отправляется уведомление,
+    после чего подписка снимается.
+    """
+    with stock_watches_lock:
+        watched = list(stock_watches.keys())
+    if not watched:
+        return
+
+    snapshot = get_stock_snapshot()
+    if snapshot is None:
+        return
+
+    with stock_watches_lock:
+        appeared = diff_stock_snapshot(stock_watch_snapshot, snapshot, watched)
+        for code in watched:
+            stock_watch_snapshot[code] = snapshot.get(code, 0)
+        notifications = [(code, stock_watches.pop(code, [])) for code in appeared]
+        for code in appeared:
+            stock_watch_snapshot.pop(code, None)
+
+    logger.debug(f"[check_stock_watches] watched={len(watched)}, appeared={len(appeared)}")
+    for code, subscribers in notifications:
+        for uid in subscribers:
+            try:
+                bot.send_message(uid, f"🔔 Товар {code} з'явився в наявності. Введіть код {code}, щоб замовити.")
+            except Exception as e:
+                logger.error(f"Failed to send stock watch notification to {uid}: {e}")
+
+def stock_watch_loop():
+    """
+    Фоновый цикл проверки подписок на появление товара.
+    """
+    logger.info(f"Stock watch loop started, interval={WATCH_INTERVAL}s")
+    while True:
+        time.sleep(WATCH_INTERVAL)
         try:
-            # 1. Отправляем карточку товара с фото
-            logger.debug(f"[send_sensitive_brand_notification] sending card to manager {manager_id}")
-            bot.send_photo(manager_id, product['Фото'], caption=card_text)
-            
-            # 2. Отправляем информацию о заинтересованных (если есть)
-            if interest_text:
-                logger.debug(f"[send_sensitive_brand_notification] sending interest info to manager {manager_id}")
-                bot.send_message(manager_id, interest_text)
-            
-            # 3. Отправляем информацию о залогах (если есть)
-            if zalog_text:
-                logger.debug(f"[send_sensitive_brand_notification] sending zalog info to manager {manager_id}")
-                bot.send_message(manager_id, zalog_text)
-            
-            # 4. Отправляем информацию о наличии (если есть)
-            if stock_text:
-                logger.debug(f"[send_sensitive_brand_notification] sending stock info to manager {manager_id}")
-                bot.send_message(manager_id, stock_text)
-            
-            # 5. Отправляем кнопки выбора
-            logger.debug(f"[send_sensitive_brand_notification] sending buttons to manager {manager_id}")
-            bot.send_message(manager_id, "Оберіть дію:", reply_markup=keyboard)
-            
-            logger.debug(f"[send_sensitive_brand_notification] all messages sent successfully to manager {manager_id}")
-            
+            check_stock_watches()
         except Exception as e:
-            logger.error(f"Error sending sensitive brand notification to manager {manager_id}: {e}")
-            success = False
-    
-    return success
+            logger.error(f"Error in stock watch loop: {e}")
+
+PRICELIST_STOCK_QUERY = """
+    SELECT o.g_id, o.ko_id, o.ostatok
+    FROM OPENQUERY(mysql_sales,'
+        SELECT ko_id, g_id, ostatok FROM ostatki WHERE ostatok > 0
+        UNION ALL
+        SELECT stock_id, g_id, ostatok FROM ostatki_sklad WHERE ostatok > 0
+    ') AS o
+    ORDER BY o.g_id
+"""
+PRICELIST_COLUMNS = ["Код", "Назва", "Ціна, грн", "Магазин", "Залишок"]
 
-def send_self_delivery_notification(product, ctx, selected_shop, available_shops, receiver_name=None):
+def spool_stock_by_shop(spool):
     """
-    Отправляет уведомление о самовывозе менеджерам опта.
+    Снимок остатков по магазинам (g_id, K_ID, остаток), упорядоченный по g_id, — во временный
+    CSV-файл пачками: в памяти только одна пачка строк.
     """
-    logger.debug(f"[send_self_delivery_notification] product={product['Код']}, client={ctx['K_ID']}")
+    writer = csv.writer(spool)
+    count = 0
+    with db_query("bulk", "spool_stock_by_shop") as cursor:
+        cursor.execute(PRICELIST_STOCK_QUERY)
+        while True:
+            rows = cursor.fetchmany(5000)
+            if not rows:
+                break
+            writer.writerows((row[0], row[1], row[2]) for row in rows)
+            count += len(rows)
+    spool.seek(0)
+    return count
+
+def iter_stock_batches(spool):
+    """
+    Читает спул по товарам: пачки по PRICELIST_BATCH_SIZE пар (g_id, [(K_ID, остаток), ...]).
+    """
+    def quantity(text):
+        value = Decimal(text)
+        return int(value) if value == value.to_integral_value() else value
+
+    batch = []
+    for code, rows in itertools.groupby(csv.reader(spool), key=lambda row: int(row[0])):
+        batch.append((code, [(int(row[1]), quantity(row[2])) for row in rows]))
+        if len(batch) >= PRICELIST_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def load_products_batch(codes):
+    """
+    Товары по нескольким кодам за один round trip: пакет из EXEC qry_goods_opt_bot,
+    после каждого — набор-метка с кодом, чтобы товар не сместился на чужой код.
+    """
+    sql = "SET NOCOUNT ON; " + " ".join("EXEC qry_goods_opt_bot ?; SELECT ? AS product_batch_code;" for _ in codes)
+    with db_query("bulk", "load_products_batch") as cursor:
+        cursor.execute(sql, *[param for code in codes for param in (code, code)])
+        result_sets = read_marked_result_sets(cursor, "product_batch_code")
+    return {code: make_product(rows[0]) for code, rows in result_sets.items() if rows}
+
+class PricelistWriter:
+    """
+    Потоковая запись прайс-листа: CSV (разделитель «;», UTF-8 с BOM — для Excel)
+    или XLSX через openpyxl в режиме write_only.
+    """
+
+    def __init__(self, path, fmt):
+        self.path = path
+        self.file = None
+        self.workbook = None
+        if fmt == "xlsx":
+            from openpyxl import Workbook
+            self.workbook = Workbook(write_only=True)
+            self.sheet = self.workbook.create_sheet("Прайс")
+            self.writerow = self.sheet.append
+        else:
+            self.file = open(path, "w", newline="", encoding="utf-8-sig")
+            self.writerow = csv.writer(self.file, delimiter=";").writerow
+
+    def close(self):
+        if self.workbook is not None:
+            self.workbook.save(self.path)
+        else:
+            self.file.close()
+
+def xlsx_available():
+    try:
+        import openpyxl  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def build_pricelist(fmt, cycle):
+    """
+    Строит прайс-лист товаров в наличии (цена и остаток по магазинам) за два прохода:
+    остатки по магазинам — во временный спул, затем пачками по товарам — цены и запись в файл.
+    Память ограничена одной пачкой, файл появляется под своим именем только после успешной сборки.
+    Имя файла уникально (mkstemp): процессы-воркеры строят прайс-лист независимо и не пишут
+    в один файл; старые файлы удаляются только спустя два цикла, когда их уже никто не отправляет.
+    """
+    # Без справочника все строки отфильтровались бы и пустой прайс-лист попал бы в кэш на весь цикл
+    if not ensure_shop_directory():
+        raise RuntimeError("shop directory is not loaded")
+    directory = shop_directory
+    os.makedirs(PRICELIST_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=PRICELIST_DIR, prefix=f"pricelist-{cycle}-", suffix=f".{fmt}.tmp")
+    os.close(fd)
+    path = tmp_path[:-len(".tmp")]
+    started = time.perf_counter()
+    products = 0
+    try:
+        with tempfile.TemporaryFile("w+", newline="") as spool:
+            stock_rows = spool_stock_by_shop(spool)
+            writer = PricelistWriter(tmp_path, fmt)
+            try:
+                writer.writerow(PRICELIST_COLUMNS)
+                for batch in iter_stock_batches(spool):
+                    found = load_products_batch([code for code, _ in batch])
+                    for code, shops in batch:
+                        product = found.get(code)
+                        shops = [(shop_id, quantity) for shop_id, quantity in shops if shop_id in directory]
+                        if not product or not shops:
+                            continue
+                        products += 1
+                        for shop_id, quantity in shops:
+                            writer.writerow([code, product['Название'], product['Цена'],
+                                             directory.name(shop_id), quantity])
+            finally:
+                writer.close()
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    expired = time.time() - 2 * PRICELIST_TTL
+    for name in os.listdir(PRICELIST_DIR):
+        file_path = os.path.join(PRICELIST_DIR, name)
+        try:
+            if name.startswith("pricelist-") and os.path.getmtime(file_path) < expired:
+                os.remove(file_path)
+        except OSError:
+            pass
+    logger.info(f"Pricelist {fmt} built: {products} products, {stock_rows} stock rows, "
+                f"{time.perf_counter() - started:.1f}s")
+    return {"cycle": cycle, "path": path, "products": products, "built_at": datetime.now(), "file_id": None}
+
+class PricelistCache:
+    """
+    Готовые прайс-листы по формату на текущий цикл PRICELIST_TTL. Сборка идёт в фоновом
+    потоке — одна на формат и цикл; запросившие ждут её без занятого потока (колбэк deliver).
+    После первой отправки файл пересылается по file_id без повторной загрузки.
+    """
+
+    def __init__(self):
+        self.entries = {}  # формат -> запись build_pricelist
+        self.waiters = {}  # (формат, цикл) -> колбэки deliver(entry, error) идущей сборки
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def request(self, fmt, deliver):
+        """
+        Вызывает deliver(entry, error): сразу, если прайс-лист текущего цикла готов,
+        иначе из потока сборки по её окончании.
+        """
+        cycle = int(time.time() // PRICELIST_TTL)
+        with self.lock:
+            entry = self.entries.get(fmt)
+            fresh = bool(entry and entry["cycle"] == cycle)
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+                waiters = self.waiters.setdefault((fmt, cycle), [])
+                waiters.append(deliver)
+                start = len(waiters) == 1
+        if fresh:
+            deliver(entry, None)
+        elif start:
+            threading.Thread(target=self.build, args=(fmt, cycle), name=f"Pricelist-{fmt}", daemon=True).start()
+
+    def build(self, fmt, cycle):
+        entry = error = None
+        try:
+            entry = build_pricelist(fmt, cycle)
+        except Exception as e:
+            logger.error(f"Failed to build pricelist ({fmt}): {e}")
+            error = e
+        with self.lock:
+            if entry:
+                self.entries[fmt] = entry
+            waiters = self.waiters.pop((fmt, cycle), [])
+        for deliver in waiters:
+            try:
+                deliver(entry, error)
+            except Exception as e:
+                logger.error(f"Failed to deliver pricelist ({fmt}): {e}")
+
+    def invalidate(self, fmt, entry):
+        with self.lock:
+            if self.entries.get(fmt) is entry:
+                del self.entries[fmt]
+
+    def is_fresh(self, fmt):
+        entry = self.entries.get(fmt)
+        return bool(entry and entry["cycle"] == int(time.time() // PRICELIST_TTL))
+
+pricelist_cache = PricelistCache()
+
+class CatalogIndex:
+    """
+    Локальный триграммный индекс по названиям товаров каталога.
+    Поиск идёт целиком в памяти, без обращений к MSSQL.
+    """
+
+    def __init__(self):
+        self.names = {}     # g_id -> название
+        self.postings = {}  # триграмма -> set(g_id)
+        self.max_g_id = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text):
+        text = (text or "").lower().replace("ё", "е")
+        return " ".join(re.findall(r"\w+", text))
+
+    @staticmethod
+    def trigrams(text):
+        grams = set()
+        for word in text.split():
+            padded = f" {word} "
+            for i in range(len(padded) - 2):
+                grams.add(padded[i:i + 3])
+        return grams
+
+    def add(self, g_id, name):
+        with self.lock:
+            old_name = self.names.get(g_id)
+            if old_name is not None:
+                for gram in self.trigrams(self.normalize(old_name)):
+                    bucket = self.postings.get(gram)
+                    if bucket:
+                        bucket.discard(g_id)
+            self.names[g_id] = name
+            for gram in self.trigrams(self.normalize(name)):
+                self.postings.setdefault(gram, set()).add(g_id)
+            self.max_g_id = max(self.max_g_id, g_id)
+
+    def __len__(self):
+        return len(self.names)
+
+    def search(self, query, limit=SEARCH_RESULTS_LIMIT):
+        """
+        Возвращает до limit пар (g_id, название), отсортированных по релевантности:
+        доля совпавших триграмм, затем совпадение с началом названия, затем длина названия.
+        """
+        normalized = self.normalize(query)
+        grams = self.trigrams(normalized)
+        if not grams:
+            return []
+
+        with self.lock:
+            hits = Counter()
+            for gram in grams:
+                hits.update(self.postings.get(gram, ()))
+            threshold = max(1, len(grams) // 2)
+            scored = []
+            for g_id, count in hits.items():
+                if count < threshold:
+                    continue
+                name = self.names[g_id]
+                normalized_name = self.normalize(name)
+                scored.append((
+                    -count / len(grams),
+                    0 if normalized_name.startswith(normalized) else 1,
+                    0 if normalized in normalized_name else 1,
+                    len(name),
+                    g_id,
+                    name
+                ))
+
+        scored.sort()
+        return [(row[4], row[5]) for row in scored[:limit]]
+
+catalog_index = CatalogIndex()
+catalog_loaded = False
+
+def load_catalog(min_g_id=0):
+    """
+    Загружает товары каталога из MSSQL пачками в catalog_index.
+    При min_g_id > 0 догружает только новые товары (g_id > min_g_id).
+    """
+    global catalog_index, catalog_loaded
+    logger.debug(f"[load_catalog] min_g_id={min_g_id}")
+    target = catalog_index if min_g_id else CatalogIndex()
+    loaded = 0
+    try:
+        with db_query("bulk", "load_catalog") as cursor:
+            cursor.execute(f"SELECT c.g_id, c.g_name FROM ({CATALOG_QUERY}) AS c WHERE c.g_id > ?", min_g_id)
+            while True:
+                rows = cursor.fetchmany(5000)
+                if not rows:
+                    break
+                for row in rows:
+                    if row[1]:
+                        target.add(int(row[0]), str(row[1]).strip())
+                        loaded += 1
+    except Exception as e:
+        logger.error(f"DB error in load_catalog: {e}")
+        return False
+
+    # Полную перезагрузку подменяем целиком, чтобы поиск не видел полупустой индекс
+    catalog_index = target
+    catalog_loaded = True
+    logger.info(f"Catalog {'updated' if min_g_id else 'loaded'}: +{loaded}, total={len(catalog_index)}")
+    return True
+
+def catalog_refresh_loop():
+    """
+    Фоновая загрузка каталога: полная при старте и раз в CATALOG_FULL_RELOAD_INTERVAL,
+    между ними — догрузка новых товаров раз в CATALOG_REFRESH_INTERVAL.
+    """
+    last_full_reload = 0
+    while True:
+        try:
+            if not catalog_loaded or time.time() - last_full_reload >= CATALOG_FULL_RELOAD_INTERVAL:
+                if load_catalog():
+                    last_full_reload = time.time()
+            else:
+                load_catalog(catalog_index.max_g_id)
+        except Exception as e:
+            logger.error(f"Error in catalog refresh loop: {e}")
+        time.sleep(CATALOG_REFRESH_INTERVAL)
+
+inline_product_cache = TTLCache(INLINE_CACHE_TTL, INLINE_CACHE_SIZE)
+
+def build_inline_result(payload):
+    """
+    Готовит результат inline-запроса для товара по заранее собранным данным.
+    """
+    caption = (
+        f"\U0001F4E6 Код: {payload['code']}\n"
+        f"\U0001F4DB Название: {payload['name']}\n"
+        f"\U0001F4B0 Ціна: {payload['price']} грн\n"
+        f"\U0001F4E5 Залишок: {payload['stock_total']} шт."
+    )
+    if payload.get('stale_note'):
+        caption += f"\n{payload['stale_note']}"
+    result_id = str(payload['code'])
+    description = f"{payload['price']} грн • {payload['stock_total']} шт."
+    photo = payload['photo']
+
+    if isinstance(photo, str) and photo.startswith(("http://", "https://")):
+        return InlineQueryResultPhoto(result_id, photo, photo, title=payload['name'],
+                                      description=description, caption=caption)
+    if isinstance(photo, str) and photo:
+        return InlineQueryResultCachedPhoto(result_id, photo, title=payload['name'],
+                                            description=description, caption=caption)
+    return InlineQueryResultArticle(result_id, payload['name'], InputTextMessageContent(caption),
+                                    description=description)
+
+def get_inline_result(code):
+    """
+    Результат inline-запроса для товара из кэша; при промахе собирается через
+    get_product_info и get_stock_info и кладётся в кэш на INLINE_CACHE_TTL.
+    Ненайденные товары тоже кэшируются, чтобы не ходить за ними в БД повторно.
+    """
+    cached = inline_product_cache.get(code)
+    if cached is not None:
+        return cached or None
+
+    product = get_product_info(code)
+    if not product:
+        inline_product_cache.set(code, False)
+        return None
+
+    stock = get_stock_info(code)
+    stale_note = make_stale_note(stock)
+    payload = {
+        "code": product['Код'],
+        "name": product['Название'],
+        "price": product['Цена'],
+        "photo": product['Фото'],
+        "stock_total": sum(row[2] for row in stock if row[2] and row[2] > 0),
+        "stale_note": stale_note
+    }
+    result = build_inline_result(payload)
+    # Устаревшие данные не кэшируем — после восстановления linked server сразу покажем свежие
+    if not stale_note:
+        inline_product_cache.set(code, result)
+    return result
+
+def make_manager_card(view, ctx, urgent, status_note=None, details=True):
+    """
+    Формирует полный текст карточки товара для MANAGER_TELEGRAM_ID с интересами, залогами и наличием.
+    details=False — только товар и клиент (для обновлённой карточки после решения).
+    """
+    product = view.product
+    stock, interest, zalog = (view.stock, view.interest, view.zalog) if details else (None, None, None)
+    lines = []
+    if status_note:
+        lines.append(status_note)
+    lines.append(f"\U0001F4E6 Код: {product['Код']}")
+    lines.append(f"\U0001F4DB Название: {product['Название']}")
+    lines.append(f"\U0001F4B0 Ціна: {product['Цена']} грн")
+    lines.append(f"Клієнт: [ID: {ctx['K_ID']}] {ctx['K_Name']} ({ctx['FIO']})")
+    lines.append(f"Менеджер клієнта: {ctx['Employee_FIO']}")
+    lines.append(f"Терміновість: {'Термінове' if urgent else 'Не термінове'}")
     
-    # Создаем уникальный ключ для этого запроса
-    request_key = f"{ctx['K_ID']}_{product['Код']}_{selected_shop[0]}"
+    stale_note = make_stale_note(stock) or make_stale_note(zalog)
+    if stale_note:
+        lines.append(stale_note)
+
+    if stock:
+        lines.append("\n\U0001F4E5 Наявність у магазинах:")
+        for i, row in enumerate(stock[:STOCK_PAGE_SIZE]):
+            lines.append(f"- {row[0]} • {row[2]} шт.")
+        if len(stock) > STOCK_PAGE_SIZE:
+            lines.append(f"... та ще {len(stock) - STOCK_PAGE_SIZE} магазинів")
     
-    # Кэш уже очищен при новом заказе, поэтому всегда отправляем новое уведомление
+    if interest:
+        lines.append("\n\U0001F575️ Цим товаром за останні два тижні цікавилися:")
+        for i, row in enumerate(interest[:INTEREST_PAGE_SIZE]):
+            date = row[0].strftime("%d.%m.%Y")
+            lines.append(f"- {date} • {row[1]} • {row[2]} • {row[3]}")
+        if len(interest) > INTEREST_PAGE_SIZE:
+            lines.append(f"... та ще {len(interest) - INTEREST_PAGE_SIZE} запитів")
     
-    # Создаем карточку товара
-    card_text = make_self_delivery_card(product, ctx, selected_shop, available_shops, receiver_name, 
-                                       "Самовивіз товару потребує підтвердження якості товару")
+    if zalog:
+        lines.append("\n\U0001F4BC Товар зараз у заставі:")
+        # Залоги запрашиваются постранично, точное число остальных неизвестно
+        for i, row in enumerate(zalog[:ZALOG_PAGE_SIZE]):
+            ondate = row[0].strftime("%d.%m.%Y")
+            lines.append(f"- {ondate} • {row[2]} • {row[5]} • {row[6]}")
+        if len(zalog) > ZALOG_PAGE_SIZE:
+            lines.append("... є й інші застави")
     
-    # Создаем кнопки для менеджеров
-    keyboard = InlineKeyboardMarkup(row_width=1)
+    return "\n".join(lines)
+
+def make_product_card_only(view, ctx, urgent, status_note=None):
+    """
+    Формирует только карточку товара без дополнительной информации.
+    """
+    product = view.product
+    lines = []
+    if status_note:
+        lines.append(status_note)
+    lines.append(f"📦 Код: {product['Код']}")
+    lines.append(f"📋 Название: {product['Название']}")
+    lines.append(f"💰 Ціна: {product['Цена']} грн")
+    lines.append(f"Клієнт: [ID: {ctx['K_ID']}] {ctx['K_Name']} ({ctx['FIO']})")
+    lines.append(f"Менеджер клієнта: {ctx['Employee_FIO']}")
+    lines.append(f"Терміновість: {'Термінове' if urgent else 'Не термінове'}")
     
-    # Кнопка подтверждения выбранного магазина
-    keyboard.add(InlineKeyboardButton(
-        f"✅ Підтвердити самовивіз з {selected_shop[1]}", 
-        callback_data=f"self_delivery_confirm_shop_{request_key}"
-    ))
+    return "\n".join(lines)
+
+def make_interest_info_message(interest):
+    """
+    Формирует сообщение с информацией о заинтересованных клиентах (одна страница).
+    """
+    if not interest:
+        return None
     
-    # Кнопки для изменения магазина
-    for shop in available_shops:
-        if shop[0] != selected_shop[0]:  # Не показываем уже выбранный магазин
-            keyboard.add(InlineKeyboardButton(
-                f"🔄 Змінити на {shop[1]}", 
-                callback_data=f"self_delivery_change_shop_{request_key}_{shop[0]}"
-            ))
+    lines = []
+    lines.append("🔍 Цим товаром за останні два тижні цікавилися:")
     
-    # Кнопка отказа
-    keyboard.add(InlineKeyboardButton(
-        "❌ Відхилити самовивіз", 
-        callback_data=f"self_delivery_reject_{request_key}"
-    ))
+    for i, row in enumerate(interest[:INTEREST_PAGE_SIZE]):
+        date = row[0].strftime("%d.%m.%Y")
+        lines.append(f"- {date} • {row[1]} • {row[2]} • {row[3]}")
     
-    # Отправляем всем менеджерам опта
-    for manager_id in opt_manager_ids:
-        try:
-            bot.send_photo(manager_id, product['Фото'], caption=card_text, reply_markup=keyboard)
-        except Exception as e:
-            logger.error(f"Error sending self-delivery notification to manager {manager_id}: {e}")
+    return "\n".join(lines)
 
-def handle_self_delivery_decision(action, request_key, shop_id=None, manager_id=None):
+def make_zalog_info_message(zalog):
     """
-    Обрабатывает решение менеджера по самовывозу.
+    Формирует сообщение с информацией о залогах товара (одна страница).
     """
-    logger.debug(f"[handle_self_delivery_decision] action={action}, request_key={request_key}, shop_id={shop_id}")
-    
-    # Кэш уже очищен при новом заказе, поэтому всегда обрабатываем новый запрос
+    if not zalog:
+        return None
     
-    # Сохраняем ответ первого менеджера
-    manager_self_delivery_responses[request_key] = {
-        'action': action,
-        'shop_id': shop_id,
-        'manager_id': manager_id
-    }
+    lines = []
+    lines.append("🏦 Товар зараз у заставі:")
     
-    # Парсим request_key для получения данных
-    parts = request_key.split("_")
-    client_id = int(parts[0])
-    code = int(parts[1])
-    original_shop_id = int(parts[2])
+    for i, row in enumerate(zalog[:ZALOG_PAGE_SIZE]):
+        ondate = row[0].strftime("%d.%m.%Y")
+        lines.append(f"- {ondate} • {row[2]} • {row[5]} • {row[6]}")
     
-    logger.debug(f"[handle_self_delivery_decision] parsed client_id={client_id}, code={code}, original_shop_id={original_shop_id}")
-    logger.debug(f"[handle_self_delivery_decision] user_context keys: {list(user_context.keys())}")
+    stale_note = make_stale_note(zalog)
+    if stale_note:
+        lines.append(stale_note)
     
-    # Ищем контекст по Telegram_ID, а не по client_id
-    ctx = None
-    for telegram_id, context in user_context.items():
-        if context.get('K_ID') == client_id:
-            ctx = context
-            logger.debug(f"[handle_self_delivery_decision] found context by K_ID={client_id} for telegram_id={telegram_id}")
-            break
+    return "\n".join(lines)
+
+def make_stock_info_message(shops):
+    """
+    Формирует сообщение с информацией о магазинах где есть товар (одна страница).
+    """
+    if not shops:
+        return None
     
-    if not ctx:
-        logger.error(f"[SELF_DELIVERY] Не найден контекст для клиента {client_id}")
-        return
+    lines = []
+    lines.append("🏪 Наявність у магазинах:")
     
-    product = get_product_info(code)
-    if not product:
-        logger.error(f"[SELF_DELIVERY] Не найден товар {code}")
-        return
+    for i, row in enumerate(shops[:STOCK_PAGE_SIZE]):
+        lines.append(f"- {row[1]} (ID: {row[0]})")
     
-    # Получаем данные по правильному telegram_id
-    telegram_id = ctx.get('Telegram_ID')
-    selected_shop = user_selected_shop.get(telegram_id)
-    available_shops = get_self_delivery_shops(code)  # Используем функцию для самовывоза
-    receiver_name = user_receiver_name.get(telegram_id)
+    return "\n".join(lines)
+
+# Секции карточки с подгрузкой «Показати ще»: (размер страницы, сообщение, подпись кнопки)
+DETAIL_SECTIONS = {
+    "interest": (INTEREST_PAGE_SIZE, make_interest_info_message, "🔍 Ще зацікавлені"),
+    "zalog": (ZALOG_PAGE_SIZE, make_zalog_info_message, "🏦 Ще застави"),
+    "shops": (STOCK_PAGE_SIZE, make_stock_info_message, "🏪 Ще магазини")
+}
+
+def next_detail_cursor(section, rows, offset=0):
+    """
+    Курсор следующей страницы секции (для callback_data) или None, если страница последняя.
+    Интересы листаются по смещению в индексе, залоги и магазины — keyset по последней строке.
+    """
+    page_size = DETAIL_SECTIONS[section][0]
+    if len(rows) <= page_size:
+        return None
+    last = rows[page_size - 1]
+    if section == "interest":
+        return str(offset + page_size)
+    if section == "zalog":
+        # Точное значение created_at (ISO, без потери долей секунды и без перевода через локальное время)
+        return f"{last[0].isoformat()}_{last[7]}"
+    return str(last[0])
+
+def fetch_detail_page(section, code, cursor):
+    """
+    Страница секции после курсора: (строки, смещение первой строки).
+    """
+    if section == "interest":
+        offset = int(cursor)
+        return get_interest_info_cached(code)[offset:offset + INTEREST_PAGE_SIZE + 1], offset
+    if section == "zalog":
+        created_at, guarantee_id = cursor.split("_")
+        return get_zalog_info(code, (datetime.fromisoformat(created_at), int(guarantee_id))), 0
+    return get_shops_for_sensitive_brand(code, int(cursor)), 0
+
+def detail_more_button(section, code, rows, offset=0):
+    cursor = next_detail_cursor(section, rows, offset)
+    if cursor is None:
+        return None
+    return InlineKeyboardButton(DETAIL_SECTIONS[section][2], callback_data=f"more_{section}_{code}_{cursor}")
+
+
+
+def tg_len(text):
+    """
+    Длина текста так, как её считает Telegram (в UTF-16 code units: эмодзи = 2).
+    """
+    return len(text.encode("utf-16-le")) // 2
+
+def split_text(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Режет текст на куски не длиннее limit, по возможности по границам строк.
+    """
+    chunks = []
+    current = ""
+    for line in text.split("\n"):
+        # Слишком длинную строку режем посимвольно
+        while tg_len(line) > limit:
+            cut = limit
+            while tg_len(line[:cut]) > limit:
+                cut -= 1
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:cut])
+            line = line[cut:]
+        candidate = f"{current}\n{line}" if current else line
+        if tg_len(candidate) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+def compose_card(header, sections):
+    """
+    Собирает карточку для менеджера в одно сообщение: шапка + секции в подписи к фото.
+    Секции, которые не помещаются в лимит подписи, уходят в дополнительные текстовые
+    сообщения (порядок секций сохраняется, каждое сообщение — не длиннее лимита Telegram).
+    Не поместившийся в подпись хвост шапки идёт первым из дополнительных сообщений.
+    Возвращает (caption, follow_ups).
+    """
+    header_chunks = split_text(header, TELEGRAM_CAPTION_LIMIT) or [""]
+    caption = header_chunks[0]
+    follow_ups = header_chunks[1:]
+    overflow = bool(follow_ups)
+
+    for section in sections:
+        if not section:
+            continue
+        candidate = f"{caption}\n\n{section}" if caption else section
+        if not overflow and tg_len(candidate) <= TELEGRAM_CAPTION_LIMIT:
+            caption = candidate
+            continue
+        overflow = True
+        # Упаковываем секции в минимальное количество сообщений
+        for chunk in split_text(section):
+            if follow_ups and tg_len(f"{follow_ups[-1]}\n\n{chunk}") <= TELEGRAM_MESSAGE_LIMIT:
+                follow_ups[-1] = f"{follow_ups[-1]}\n\n{chunk}"
+            else:
+                follow_ups.append(chunk)
+
+    return caption, follow_ups
+
+def send_card(chat_id, photo, caption, follow_ups=None, reply_markup=None):
+    """
+    Отправляет карточку: фото с подписью и кнопками, затем (если нужно) продолжение текстом.
+    В обычном случае это ровно один вызов Bot API.
+    """
+    sent = bot.send_photo(chat_id, photo, caption=caption, reply_markup=reply_markup)
+    for text in follow_ups or []:
+        bot.send_message(chat_id, text)
+    return sent
+
+def make_opt_manager_card(view, ctx, urgent, status_note=None):
+    """
+    Формирует текст карточки товара для OPT_MANAGER_TELEGRAM_ID БЕЗ интересов и залогов.
+    """
+    product = view.product
+    lines = []
+    if status_note:
+        lines.append(status_note)
+    stale_note = make_stale_note(view.stock)
+    if stale_note:
+        lines.append(stale_note)
+    lines.append(f"\U0001F4E6 Код: {product['Код']}")
+    lines.append(f"\U0001F4DB Название: {product['Название']}")
+    lines.append(f"\U0001F4B0 Ціна: {product['Цена']} грн")
+    lines.append(f"Клієнт: [ID: {ctx['K_ID']}] {ctx['K_Name']} ({ctx['FIO']})")
+    lines.append(f"Менеджер клієнта: {ctx['Employee_FIO']}")
+    lines.append(f"Терміновість: {'Термінове' if urgent else 'Не термінове'}")
     
-    logger.debug(f"[handle_self_delivery_decision] telegram_id={telegram_id}, selected_shop={selected_shop}, receiver_name={receiver_name}")
+    return "\n".join(lines)
+
+def make_self_delivery_card(view, ctx, selected_shop, receiver_name=None, status_note=None):
+    """
+    Формирует карточку для самовывоза с выбором магазина.
+    """
+    product = view.product
+    available_shops = view.self_delivery_shops
+    lines = []
+    if status_note:
+        lines.append(status_note)
+    lines.append(f"\U0001F4E6 Код: {product['Код']}")
+    lines.append(f"\U0001F4DB Название: {product['Название']}")
+    lines.append(f"\U0001F4B0 Ціна: {product['Цена']} грн")
+    lines.append(f"Клієнт: [ID: {ctx['K_ID']}] {ctx['K_Name']} ({ctx['FIO']})")
+    lines.append(f"Менеджер клієнта: {ctx['Employee_FIO']}")
+    lines.append(f"\n\U0001F4E5 Обраний магазин клієнтом: {selected_shop[1]}")
+    
+    if receiver_name:
+        lines.append(f"\U0001F464 Отримувач: {receiver_name}")
+    
+    if available_shops:
+        lines.append("\n\U0001F4E5 Доступні магазини для самовивозу:")
+        for shop in available_shops:
+            lines.append(f"- {shop[1]} (ID: {shop[0]})")
     
-    # Убираем кнопки у всех менеджеров и показываем результат
-    for manager_id in opt_manager_ids:
+    return "\n".join(lines)
+
+def send_opt_manager_notification(view, ctx, urgent, status_note):
+    full_text = make_opt_manager_card(view, ctx, urgent, status_note)
+    for m_id in opt_manager_ids:
         try:
-            if action == "confirm_shop":
-                message_text = f"✅ Підтверджено самовивіз з {selected_shop[1]}"
-                logger.debug(f"[handle_self_delivery_decision] sending confirmation to manager {manager_id}: {message_text}")
-            elif action == "change_shop":
-                new_shop = next((shop for shop in available_shops if shop[0] == shop_id), None)
-                if new_shop:
-                    message_text = f"🔄 Змінено магазин на {new_shop[1]}"
-                    # Обновляем выбранный магазин для клиента
-                    user_selected_shop[client_id] = new_shop
-                    logger.debug(f"[handle_self_delivery_decision] updated shop for client {client_id}: {new_shop[1]}")
-                else:
-                    message_text = f"🔄 Змінено магазин"
-                logger.debug(f"[handle_self_delivery_decision] sending shop change to manager {manager_id}: {message_text}")
-            elif action == "reject":
-                message_text = "❌ Самовивіз відхилено"
-                logger.debug(f"[handle_self_delivery_decision] sending rejection to manager {manager_id}: {message_text}")
-            
-            # Отправляем новое сообщение с тем же текстом карточки, но без кнопок
-            card_text = make_self_delivery_card(product, ctx, selected_shop, available_shops, receiver_name, status_note=message_text)
-            bot.send_photo(manager_id, product['Фото'], caption=card_text, reply_markup=None)
-            logger.debug(f"[handle_self_delivery_decision] updated card sent to manager {manager_id}")
+            bot.send_photo(m_id, view.photo, caption=full_text)
         except Exception as e:
-            logger.error(f"Error sending response to manager {manager_id}: {e}")
-    
-    # Отправляем ответ клиенту
+            logger.error(f"Failed to send to opt manager {m_id}: {e}")
+
+opt_routing_counter = Counter()  # "sent", "reassigned", "broadcast_equivalent"
+opt_routing_rr_lock = threading.Lock()
+opt_routing_rr_next = 0
+
+def opt_manager_load():
+    """
+    Число нерешённых заявок на каждом оптовом менеджере.
+    """
+    load = Counter({m_id: 0 for m_id in opt_manager_ids})
+    for request_key, assignment in list(opt_request_assignments.items()):
+        if request_key in pending_requests:
+            load.update(assignment["managers"])
+    return load
+
+def pick_opt_manager(exclude=()):
+    """
+    Выбор менеджера для заявки по OPT_ROUTING (round_robin / least_pending) среди ещё не получивших её.
+    """
+    global opt_routing_rr_next
+    candidates = [m_id for m_id in opt_manager_ids if m_id not in exclude]
+    if not candidates:
+        return None
+    if OPT_ROUTING == "least_pending":
+        load = opt_manager_load()
+        return min(candidates, key=lambda m_id: (load[m_id], opt_manager_ids.index(m_id)))
+    with opt_routing_rr_lock:
+        m_id = candidates[opt_routing_rr_next % len(candidates)]
+        opt_routing_rr_next += 1
+    return m_id
+
+def remember_request_message(request_key, sent):
+    """
+    Запоминает карточку с кнопками по заявке, чтобы убрать кнопки при истечении срока.
+    """
+    if sent is not None:
+        modify_state(request_messages, request_key,
+                     lambda messages: None if messages is None else messages + [[sent.chat.id, sent.message_id]])
+
+def send_opt_card(request_key, manager_id, assignment, status_note=None):
+    caption = f"{status_note}\n{assignment['caption']}" if status_note else assignment['caption']
+    keyboard = InlineKeyboardMarkup.de_json(assignment["keyboard"]) if assignment["keyboard"] else None
     try:
-        logger.debug(f"[handle_self_delivery_decision] sending response to client telegram_id={telegram_id}, action={action}")
-        
-        if action == "confirm_shop":
-            logger.debug(f"[handle_self_delivery_decision] sending confirmation to client telegram_id={telegram_id}")
-            bot.send_message(telegram_id, f"✅ Менеджер підтвердив самовивіз з {selected_shop[1]}")
-            bot.send_message(telegram_id, "📝 Натисніть кнопку нижче для підтвердження замовлення:")
-            
-            keyboard = InlineKeyboardMarkup(row_width=1)
-            keyboard.add(InlineKeyboardButton("✅ Підтвердити замовлення", callback_data="confirm_self_delivery_order"))
-            keyboard.add(InlineKeyboardButton("🔄 Вибрати інший товар", callback_data="change_product"))
-            bot.send_message(telegram_id, "Підтвердіть замовлення:", reply_markup=keyboard)
-            
-        elif action == "change_shop":
-            new_shop = next((shop for shop in available_shops if shop[0] == shop_id), None)
-            if new_shop:
-                logger.debug(f"[handle_self_delivery_decision] sending shop change to client telegram_id={telegram_id}: {new_shop[1]}")
-                bot.send_message(telegram_id, f"🔄 Менеджер змінив магазин на {new_shop[1]}")
-                bot.send_message(telegram_id, "📝 Натисніть кнопку нижче для підтвердження замовлення:")
-                
-                keyboard = InlineKeyboardMarkup(row_width=1)
-                keyboard.add(InlineKeyboardButton("✅ Підтвердити замовлення", callback_data="confirm_self_delivery_order"))
-                keyboard.add(InlineKeyboardButton("🔄 Вибрати інший товар", callback_data="change_product"))
-                bot.send_message(telegram_id, "Підтвердіть замовлення:", reply_markup=keyboard)
-            
-        elif action == "reject":
-            logger.debug(f"[handle_self_delivery_decision] sending rejection to client telegram_id={telegram_id}")
-            bot.send_message(telegram_id, "❌ Менеджер відхилив самовивіз. Обраний товар є заставним.")
-            keyboard = InlineKeyboardMarkup(row_width=1)
-            keyboard.add(InlineKeyboardButton("🔄 Вибрати інший товар", callback_data="change_product"))
-            bot.send_message(telegram_id, "Оберіть інший товар:", reply_markup=keyboard)
-            
-            # Очищаем кэш после отмены самовывоза
-            clear_user_cache(telegram_id)
-            
+        # Заявка кошика — несколько товаров, карточка без фото
+        if assignment["photo"] is None:
+            sent = bot.send_message(manager_id, caption, reply_markup=keyboard)
+        else:
+            sent = bot.send_photo(manager_id, assignment["photo"], caption=caption, reply_markup=keyboard)
+        opt_routing_counter["sent"] += 1
+        remember_request_message(request_key, sent)
+        return True
     except Exception as e:
-        logger.error(f"Error sending response to client telegram_id={telegram_id}: {e}")
-    
-    logger.debug(f"[handle_self_delivery_decision] END - function completed")
+        logger.error(f"Error sending opt request card to manager {manager_id}: {e}")
+        return False
 
-def send_shop_selection_notification(product, ctx, urgent, status_note="🔔 Потрібно вибрати магазин для відправки товару"):
+def route_opt_request(request_key, photo, caption, keyboard):
     """
-    Отправляет уведомление оптовым менеджерам с выбором магазина для обычных заказов.
+    Отправляет заявку оптовым менеджерам: всем (OPT_ROUTING=broadcast) или одному,
+    выбранному по round_robin / least_pending. Нерешённая заявка через OPT_ROUTING_TIMEOUT
+    передаётся следующему менеджеру или всем (reassign_opt_request).
     """
-    logger.debug(f"[send_shop_selection_notification] product={product['Код']}, client={ctx['K_ID']}")
-    
-    # Создаем уникальный ключ для этого запроса
-    request_key = f"shop_selection_{ctx['K_ID']}_{product['Код']}"
-    
-    # Кэш уже очищен при новом заказе, поэтому всегда отправляем новое уведомление
-    
-    # Получаем информацию о наличии
-    stock = get_stock_info(product['Код'])
-    
-    # Создаем карточку товара
-    card_text = make_opt_manager_card(product, ctx, urgent, stock, status_note)
+    routed_at = time.time()
+    assignment = {
+        "photo": photo,
+        "caption": caption,
+        "keyboard": keyboard.to_dict() if keyboard else None,
+        "managers": [],
+        "routed_at": routed_at
+    }
+    opt_routing_counter["broadcast_equivalent"] += len(opt_manager_ids)
+    if OPT_ROUTING == "broadcast":
+        targets = list(opt_manager_ids)
+    else:
+        manager_id = pick_opt_manager()
+        targets = [manager_id] if manager_id is not None else []
+    logger.debug(f"[route_opt_request] {request_key} -> {targets} ({OPT_ROUTING})")
+    assignment["managers"] = targets
+    opt_request_assignments[request_key] = assignment
+    for manager_id in targets:
+        send_opt_card(request_key, manager_id, assignment)
+    if OPT_ROUTING != "broadcast":
+        request_scheduler.schedule(OPT_ROUTING_TIMEOUT, reassign_opt_request, request_key, routed_at)
+    request_scheduler.schedule(OPT_ROUTING_RETENTION, forget_opt_request, request_key, routed_at)
+
+def opt_request_recipients(request_key):
+    """
+    Менеджеры, получившие заявку (им же уходят обновления по ней); без записи — все оптовые менеджеры.
+    """
+    assignment = opt_request_assignments.get(request_key)
+    return list(assignment["managers"]) if assignment else list(opt_manager_ids)
+
+def current_opt_assignment(request_key, routed_at):
+    assignment = opt_request_assignments.get(request_key)
+    return assignment if assignment and assignment["routed_at"] == routed_at else None
+
+def add_opt_recipients(request_key, assignment, targets, status_note):
+    """
+    Досылает карточку заявки новым получателям и добавляет их в список получивших.
+    """
+    modify_state(opt_request_assignments, request_key,
+                 lambda current: None if current is None else {**current, "managers": current["managers"] + targets})
+    for manager_id in targets:
+        send_opt_card(request_key, manager_id, assignment, status_note)
+
+def reassign_opt_request(request_key, routed_at, attempt=1):
+    """
+    Заявка не взята в работу за OPT_ROUTING_TIMEOUT: передаём следующему менеджеру
+    (или всем оставшимся при OPT_ROUTING_ESCALATION=broadcast) и ставим следующий срок.
+    Следующий срок ставится, даже если этот раунд уже выполнил другой процесс: цепочка
+    не обрывается, если тот процесс упадёт.
+    """
+    assignment = current_opt_assignment(request_key, routed_at)
+    request = pending_requests.get(request_key)
+    if not assignment or not request:
+        return
+    request_scheduler.schedule(routed_at + (attempt + 1) * OPT_ROUTING_TIMEOUT - time.time(),
+                               reassign_opt_request, request_key, routed_at, attempt + 1)
+    if not claim_request_timer(request_key, f"reassign:{routed_at}:{attempt}"):
+        return
+    if OPT_ROUTING_ESCALATION == "broadcast":
+        targets = [m_id for m_id in opt_manager_ids if m_id not in assignment["managers"]]
+    else:
+        manager_id = pick_opt_manager(exclude=assignment["managers"])
+        targets = [manager_id] if manager_id is not None else []
+    if not targets:
+        return
+    waited = int(time.time() - request["created"]) // 60
+    logger.info(f"Opt request {request_key} is not handled for {waited} min, reassigning to {targets}")
+    add_opt_recipients(request_key, assignment, targets, f"⏰ Заявка без відповіді {waited} хв")
+    opt_routing_counter["reassigned"] += len(targets)
+
+def forget_opt_request(request_key, routed_at):
+    if current_opt_assignment(request_key, routed_at) and request_key not in pending_requests:
+        opt_request_assignments.pop(request_key, None)
+
+def schedule_opt_routing_timers(request_key, assignment):
+    """
+    После рестарта ставит заново сроки распределения заявки: текущий раунд передачи
+    (просроченный — сразу) и забывание получателей через OPT_ROUTING_RETENTION.
+    """
+    routed_at = assignment["routed_at"]
+    age = time.time() - routed_at
+    if OPT_ROUTING != "broadcast" and request_key in pending_requests:
+        attempt = max(1, int(age // OPT_ROUTING_TIMEOUT))
+        request_scheduler.schedule(attempt * OPT_ROUTING_TIMEOUT - age, reassign_opt_request, request_key, routed_at, attempt)
+    request_scheduler.schedule(OPT_ROUTING_RETENTION - age, forget_opt_request, request_key, routed_at)
+
+REQUEST_TYPE_LABELS = {
+    "sensitive_brand": "підтвердження (чутливий бренд)",
+    "shop_selection": "вибір магазину",
+    "self_delivery": "самовивіз",
+    "cart": "кошик"
+}
+
+def current_request(request_key, created):
+    """
+    Заявка, если она всё ещё ждёт решения и не пересоздана с тем же ключом.
+    """
+    request = pending_requests.get(request_key)
+    return request if request and request["created"] == created else None
+
+def request_managers(request_key, request):
+    if request["type"] == "sensitive_brand":
+        return list(manager_ids)
+    return opt_request_recipients(request_key)
+
+def describe_request(request):
+    label = REQUEST_TYPE_LABELS.get(request["type"], request["type"])
+    if request.get("codes"):
+        return f"{label}, товари {', '.join(map(str, request['codes']))}, клієнт {request.get('K_ID', '?')}"
+    return f"{label}, товар {request.get('code', '?')}, клієнт {request.get('K_ID', '?')}"
+
+def schedule_request_timers(request_key, created):
+    """
+    Ставит сроки заявки: напоминание, эскалация, истечение. При восстановлении после
+    рестарта уже пропущенные промежуточные этапы не повторяются, если заявка и так истекла.
+    """
+    age = time.time() - created
+    stages = [(after, action) for after, action in (
+        (REQUEST_REMIND_AFTER, remind_pending_request),
+        (REQUEST_ESCALATE_AFTER, escalate_pending_request),
+        (REQUEST_EXPIRE_AFTER, expire_pending_request)
+    ) if after]
+    for i, (after, action) in enumerate(stages):
+        later_due = any(later_after <= age for later_after, _ in stages[i + 1:])
+        if after <= age and later_due:
+            continue
+        request_scheduler.schedule(after - age, action, request_key, created)
+
+def claim_request_timer(request_key, stage):
+    """
+    Атомарно отмечает срок заявки как выполняемый этим процессом. Один и тот же срок может
+    стоять в нескольких процессах (у воркера, создавшего заявку, и после восстановления
+    в диспетчере) — действие выполняет только тот, кто отметил первым.
+    """
+    claimed = False
+
+    def claim(stages):
+        nonlocal claimed
+        stages = stages or {}
+        claimed = stage not in stages
+        return {**stages, stage: time.time()} if claimed else stages
+
+    modify_state(request_timer_claims, request_key, claim)
+    return claimed
+
+def remind_pending_request(request_key, created):
+    request = current_request(request_key, created)
+    if not request or not claim_request_timer(request_key, f"remind:{created}"):
+        return
+    send_request_reminder(request_key, request, created)
+
+def send_request_reminder(request_key, request, created):
+    waited = int(time.time() - created) // 60
+    text = f"⏰ Нагадування: заявка чекає рішення {waited} хв ({describe_request(request)})"
+    request_deadline_counter["reminded"] += 1
+    for manager_id in request_managers(request_key, request):
+        try:
+            bot.send_message(manager_id, text)
+        except Exception as e:
+            logger.error(f"Failed to send reminder for {request_key} to {manager_id}: {e}")
+
+def escalate_pending_request(request_key, created):
+    """
+    Заявка опта без решения за REQUEST_ESCALATE_AFTER: карточка с кнопками уходит
+    менеджерам подтверждения (MANAGER_TELEGRAM_ID), которые её ещё не получали.
+    """
+    request = current_request(request_key, created)
+    if not request or not claim_request_timer(request_key, f"escalate:{created}"):
+        return
+    if request["type"] == "sensitive_brand":
+        send_request_reminder(request_key, request, created)
+        return
+    assignment = opt_request_assignments.get(request_key)
+    if not assignment:
+        return
+    targets = [m_id for m_id in manager_ids if m_id not in assignment["managers"]]
+    if not targets:
+        return
+    waited = int(time.time() - created) // 60
+    logger.info(f"Request {request_key} is not handled for {waited} min, escalating to managers {targets}")
+    add_opt_recipients(request_key, assignment, targets, f"🚨 Ескалація: заявка без відповіді {waited} хв")
+    request_deadline_counter["escalated"] += 1
+
+def expire_pending_request(request_key, created):
+    """
+    Закрывает заявку без решения: убирает кнопки с карточек менеджеров и сообщает клиенту.
+    """
+    request = current_request(request_key, created)
+    if not request or not claim_request_timer(request_key, f"expire:{created}"):
+        return
+    messages = request_messages.get(request_key, [])
+    resolve_pending_request(request_key, "expired")
+    request_deadline_counter["expired"] += 1
+    logger.info(f"Request {request_key} expired after {REQUEST_EXPIRE_AFTER}s ({len(messages)} cards)")
+    for chat_id, message_id in messages:
+        try:
+            bot.edit_message_reply_markup(chat_id, message_id, reply_markup=None)
+        except Exception as e:
+            logger.debug(f"[expire_pending_request] cannot remove buttons in {chat_id}/{message_id}: {e}")
+    if request.get("uid"):
+        try:
+            subject = "кошика" if request.get("codes") else f"товару {request.get('code', '')}"
+            bot.send_message(request["uid"], f"⌛ Менеджер не відповів на запит щодо {subject}. "
+                                             f"Запит закрито — спробуйте ще раз або зверніться до свого менеджера.")
+        except Exception as e:
+            logger.error(f"Failed to notify client {request['uid']} about expired {request_key}: {e}")
+
+def rebuild_request_timers():
+    """
+    После рестарта ставит заново все сроки: напоминание, эскалацию и истечение ожидающих заявок,
+    передачу и забывание получателей заявок опта. Повторная постановка безопасна —
+    каждый срок выполняется один раз (claim_request_timer).
+    """
+    count = 0
+    for request_key, request in list(pending_requests.items()):
+        schedule_request_timers(request_key, request["created"])
+        count += 1
+    routed = 0
+    for request_key, assignment in list(opt_request_assignments.items()):
+        schedule_opt_routing_timers(request_key, assignment)
+        routed += 1
+    logger.info(f"Request timers rebuilt for {count} pending requests and {routed} routed requests")
+
+def send_sensitive_brand_notification(view, ctx, urgent, uid):
+    """
+    Отправляет менеджеру карточку бренд-чувствительного товара: фото, интересы, залоги,
+    наличие и кнопки — одним сообщением (продолжение только если не влезло в подпись).
+    """
+    code = view.code
+    logger.debug(f"[send_sensitive_brand_notification] sending to manager for sensitive brand, code={code}")
     
-    # Получаем список магазинов для выбора (TOP 5)
-    available_shops = get_shops_for_opt_managers(product['Код'])
+    if not manager_ids:
+        logger.error("ERROR: No confirmation managers configured! Cannot send notification.")
+        return False
     
-    if not available_shops:
-        # Если нет доступных магазинов, отправляем уведомление об ошибке
-        for manager_id in opt_manager_ids:
-            try:
-                bot.send_message(manager_id, f"❌ Товар {product['Код']} недоступний в жодному магазині")
-            except Exception as e:
-                logger.error(f"Error sending no shops notification to manager {manager_id}: {e}")
-        return
+    # Формируем сообщения
+    card_text = make_product_card_only(view, ctx, urgent, "🔔 Клієнт зацікавився товаром (чувствительный бренд)")
+    interest_text = make_interest_info_message(view.interest)
+    zalog_text = make_zalog_info_message(view.zalog)
+    stock_text = make_stock_info_message(view.sensitive_shops)
     
-    # Создаем кнопки для выбора магазина
+    # Создаем клавиатуру
     keyboard = InlineKeyboardMarkup(row_width=1)
+    keyboard.add(
+        InlineKeyboardButton("✅ Підтвердити", callback_data=f"approve_{uid}_{code}"),
+        InlineKeyboardButton("❌ Відхилити", callback_data=f"reject_{uid}_{code}")
+    )
+    # В карточке только первые страницы секций, остальное — по кнопкам
+    for section, rows in (("interest", view.interest), ("zalog", view.zalog), ("shops", view.sensitive_shops)):
+        button = detail_more_button(section, code, rows)
+        if button:
+            keyboard.add(button)
     
-    # Кнопки для выбора магазина
-    for shop in available_shops:
-        shop_id, shop_name = shop
-        keyboard.add(InlineKeyboardButton(
-            f"🏪 {shop_name}", 
-            callback_data=f"select_shop_{request_key}_{shop_id}"
-        ))
+    # Склеиваем всё в одну карточку (фото + подпись + кнопки); что не влезло — продолжением
+    caption, follow_ups = compose_card(card_text, [interest_text, zalog_text, stock_text])
+    logger.debug(f"[send_sensitive_brand_notification] caption_len={tg_len(caption)}, follow_ups={len(follow_ups)}")
     
-    # Кнопка отмены
-    keyboard.add(InlineKeyboardButton(
-        "❌ Скасувати замовлення", 
-        callback_data=f"cancel_order_{request_key}"
-    ))
+    success = True
+    request_key = f"sensitive_{uid}_{code}"
+    track_pending_request(request_key, "sensitive_brand", K_ID=ctx['K_ID'], code=code, urgent=urgent, uid=uid)
     
-    # Отправляем всем оптовым менеджерам
-    for manager_id in opt_manager_ids:
+    for manager_id in manager_ids:
         try:
-            bot.send_photo(manager_id, product['Фото'], caption=card_text, reply_markup=keyboard)
+            logger.debug(f"[send_sensitive_brand_notification] sending card to manager {manager_id}")
+            sent = send_card(manager_id, view.photo, caption, follow_ups, reply_markup=keyboard)
+            remember_request_message(request_key, sent)
+            logger.debug(f"[send_sensitive_brand_notification] card sent successfully to manager {manager_id}")
+            
         except Exception as e:
-            logger.error(f"Error sending shop selection notification to manager {manager_id}: {e}")
-
+            logger.error(f"Error sending sensitive brand notification to manager {manager_id}: {e}")
+            success = False
+    
+    return success
+
+def send_self_delivery_notification(view, ctx, selected_shop, receiver_name=None):
+    """
+    Отправляет уведомление о самовывозе менеджерам опта.
+    """
+    product = view.product
+    available_shops = view.self_delivery_shops
+    logger.debug(f"[send_self_delivery_notification] product={product['Код']}, client={ctx['K_ID']}")
+    
+    # Создаем уникальный ключ для этого запроса
+    request_key = f"{ctx['K_ID']}_{product['Код']}_{selected_shop[0]}"
+    
+    # Кэш уже очищен при новом заказе, поэтому всегда отправляем новое уведомление
+    
+    # Создаем карточку товара
+    card_text = make_self_delivery_card(view, ctx, selected_shop, receiver_name,
+                                       "Самовивіз товару потребує підтвердження якості товару")
+    
+    # Создаем кнопки для менеджеров
+    keyboard = InlineKeyboardMarkup(row_width=1)
+    
+    # Кнопка подтверждения выбранного магазина
+    keyboard.add(InlineKeyboardButton(
+        f"✅ Підтвердити самовивіз з {selected_shop[1]}", 
+        callback_data=f"self_delivery_confirm_shop_{request_key}"
+    ))
+    
+    # Кнопки для изменения магазина
+    for shop in available_shops:
+        if shop[0] != selected_shop[0]:  # Не показываем уже выбранный магазин
+            keyboard.add(InlineKeyboardButton(
+                f"🔄 Змінити на {shop[1]}", 
+                callback_data=f"self_delivery_change_shop_{request_key}_{shop[0]}"
+            ))
+    
+    # Кнопка отказа
+    keyboard.add(InlineKeyboardButton(
+        "❌ Відхилити самовивіз", 
+        callback_data=f"self_delivery_reject_{request_key}"
+    ))
+    
+    track_pending_request(f"self_delivery_{request_key}", "self_delivery",
+                          K_ID=ctx['K_ID'], code=product['Код'], shop_id=selected_shop[0], uid=ctx['Telegram_ID'])
+    # Решение менеджера сверяется с тем списком, что был в кнопках, без повторного запроса
+    request_shop_lists[f"self_delivery_{request_key}"] = [[shop[0], shop[1]] for shop in available_shops]
+    
+    # Отправляем менеджерам опта (всем или одному — по OPT_ROUTING)
+    route_opt_request(f"self_delivery_{request_key}", product['Фото'], card_text, keyboard)
+
+def handle_self_delivery_decision(action, request_key, shop_id=None, manager_id=None):
+    """
+    Обрабатывает решение менеджера по самовывозу.
+    """
+    logger.debug(f"[handle_self_delivery_decision] action={action}, request_key={request_key}, shop_id={shop_id}")
+    
+    # Кэш уже очищен при новом заказе, поэтому всегда обрабатываем новый запрос
+    
+    # Магазины из кнопок заявки (до resolve_pending_request, который их удаляет)
+    frozen_shops = request_shop_lists.get(f"self_delivery_{request_key}")
+    resolve_pending_request(f"self_delivery_{request_key}", action, shop_id=shop_id, manager_id=manager_id)
+    
+    # Сохраняем ответ первого менеджера
+    manager_self_delivery_responses[request_key] = {
+        'action': action,
+        'shop_id': shop_id,
+        'manager_id': manager_id
+    }
+    
+    # Парсим request_key для получения данных
+    parts = request_key.split("_")
+    client_id = int(parts[0])
+    code = int(parts[1])
+    original_shop_id = int(parts[2])
+    
+    logger.debug(f"[handle_self_delivery_decision] parsed client_id={client_id}, code={code}, original_shop_id={original_shop_id}")
+    logger.debug(f"[handle_self_delivery_decision] user_context keys: {list(user_context.keys())}")
+    
+    # Ищем контекст по Telegram_ID, а не по client_id
+    ctx = None
+    for telegram_id, context in user_context.items():
+        if context.get('K_ID') == client_id:
+            ctx = context
+            logger.debug(f"[handle_self_delivery_decision] found context by K_ID={client_id} for telegram_id={telegram_id}")
+            break
+    
+    if not ctx:
+        logger.error(f"[SELF_DELIVERY] Не найден контекст для клиента {client_id}")
+        return
+    
+    if frozen_shops is not None:
+        view = fetch_product_view(code, ())
+        # view из fetch_product_view общий для одновременных вызовов — не меняем его, а копируем
+        view = view and replace(view, self_delivery_shops=frozen_shops)
+    else:
+        view = fetch_product_view(code, SELF_DELIVERY_VIEW_SECTIONS)
+    if not view:
+        logger.error(f"[SELF_DELIVERY] Не найден товар {code}")
+        return
+    
+    # Получаем данные по правильному telegram_id
+    telegram_id = ctx.get('Telegram_ID')
+    selected_shop = user_selected_shop.get(telegram_id)
+    available_shops = view.self_delivery_shops  # Магазины для самовывоза
+    if action in ("confirm_shop", "change_shop"):
+        # Заявка, по которой клиент затем подтвердит заказ (ключ для журнала заказов)
+        user_self_delivery_pending[telegram_id] = f"self_delivery_{request_key}"
+    receiver_name = user_receiver_name.get(telegram_id)
+    
+    logger.debug(f"[handle_self_delivery_decision] telegram_id={telegram_id}, selected_shop={selected_shop}, receiver_name={receiver_name}")
+    
+    # Убираем кнопки у менеджеров, получивших заявку, и показываем результат
+    for manager_id in opt_request_recipients(f"self_delivery_{request_key}"):
+        try:
+            if action == "confirm_shop":
+                message_text = f"✅ Підтверджено самовивіз з {selected_shop[1]}"
+                logger.debug(f"[handle_self_delivery_decision] sending confirmation to manager {manager_id}: {message_text}")
+            elif action == "change_shop":
+                new_shop = next((shop for shop in available_shops if shop[0] == shop_id), None)
+                if new_shop:
+                    message_text = f"🔄 Змінено магазин на {new_shop[1]}"
+                    # Обновляем выбранный магазин для клиента
+                    user_selected_shop[client_id] = new_shop
+                    logger.debug(f"[handle_self_delivery_decision] updated shop for client {client_id}: {new_shop[1]}")
+                else:
+                    message_text = f"🔄 Змінено магазин"
+                logger.debug(f"[handle_self_delivery_decision] sending shop change to manager {manager_id}: {message_text}")
+            elif action == "reject":
+                message_text = "❌ Самовивіз відхилено"
+                logger.debug(f"[handle_self_delivery_decision] sending rejection to manager {manager_id}: {message_text}")
+            
+            # Отправляем новое сообщение с тем же текстом карточки, но без кнопок
+            card_text = make_self_delivery_card(view, ctx, selected_shop, receiver_name, status_note=message_text)
+            bot.send_photo(manager_id, view.photo, caption=card_text, reply_markup=None)
+            logger.debug(f"[handle_self_delivery_decision] updated card sent to manager {manager_id}")
+        except Exception as e:
+            logger.error(f"Error sending response to manager {manager_id}: {e}")
+    
+    # Отправляем ответ клиенту
+    try:
+        logger.debug(f"[handle_self_delivery_decision] sending response to client telegram_id={telegram_id}, action={action}")
+        
+        if action == "confirm_shop":
+            logger.debug(f"[handle_self_delivery_decision] sending confirmation to client telegram_id={telegram_id}")
+            bot.send_message(telegram_id, f"✅ Менеджер підтвердив самовивіз з {selected_shop[1]}")
+            bot.send_message(telegram_id, "📝 Натисніть кнопку нижче для підтвердження замовлення:")
+            
+            keyboard = InlineKeyboardMarkup(row_width=1)
+            keyboard.add(InlineKeyboardButton("✅ Підтвердити замовлення", callback_data="confirm_self_delivery_order"))
+            keyboard.add(InlineKeyboardButton("🔄 Вибрати інший товар", callback_data="change_product"))
+            bot.send_message(telegram_id, "Підтвердіть замовлення:", reply_markup=keyboard)
+            
+        elif action == "change_shop":
+            new_shop = next((shop for shop in available_shops if shop[0] == shop_id), None)
+            if new_shop:
+                logger.debug(f"[handle_self_delivery_decision] sending shop change to client telegram_id={telegram_id}: {new_shop[1]}")
+                bot.send_message(telegram_id, f"🔄 Менеджер змінив магазин на {new_shop[1]}")
+                bot.send_message(telegram_id, "📝 Натисніть кнопку нижче для підтвердження замовлення:")
+                
+                keyboard = InlineKeyboardMarkup(row_width=1)
+                keyboard.add(InlineKeyboardButton("✅ Підтвердити замовлення", callback_data="confirm_self_delivery_order"))
+                keyboard.add(InlineKeyboardButton("🔄 Вибрати інший товар", callback_data="change_product"))
+                bot.send_message(telegram_id, "Підтвердіть замовлення:", reply_markup=keyboard)
+            
+        elif action == "reject":
+            logger.debug(f"[handle_self_delivery_decision] sending rejection to client telegram_id={telegram_id}")
+            bot.send_message(telegram_id, "❌ Менеджер відхилив самовивіз. Обраний товар є заставним.")
+            keyboard = InlineKeyboardMarkup(row_width=1)
+            keyboard.add(InlineKeyboardButton("🔄 Вибрати інший товар", callback_data="change_product"))
+            bot.send_message(telegram_id, "Оберіть інший товар:", reply_markup=keyboard)
+            
+            # Очищаем кэш после отмены самовывоза
+            clear_user_cache(telegram_id)
+            
+    except Exception as e:
+        logger.error(f"Error sending response to client telegram_id={telegram_id}: {e}")
+    
+    logger.debug(f"[handle_self_delivery_decision] END - function completed")
+
+def send_shop_selection_notification(view, ctx, urgent, status_note="🔔 Потрібно вибрати магазин для відправки товару"):
+    """
+    Отправляет уведомление оптовым менеджерам с выбором магазина для обычных заказов.
+    Наличие и список магазинов берутся из view (секции stock и opt_shops).
+    """
+    product = view.product
+    logger.debug(f"[send_shop_selection_notification] product={product['Код']}, client={ctx['K_ID']}")
+    
+    # Создаем уникальный ключ для этого запроса
+    request_key = f"shop_selection_{ctx['K_ID']}_{product['Код']}"
+    
+    # Кэш уже очищен при новом заказе, поэтому всегда отправляем новое уведомление
+    
+    # Создаем карточку товара
+    card_text = make_opt_manager_card(view, ctx, urgent, status_note)
+    
+    # Список магазинов для выбора
+    available_shops = view.opt_shops
+    
+    if not available_shops:
+        # Если нет доступных магазинов, отправляем уведомление об ошибке
+        for manager_id in opt_manager_ids:
+            try:
+                if available_shops.unavailable:
+                    bot.send_message(manager_id, f"⚠️ Товар {product['Код']}: дані про наявність тимчасово недоступні, спробуйте пізніше")
+                else:
+                    bot.send_message(manager_id, f"❌ Товар {product['Код']} недоступний в жодному магазині")
+            except Exception as e:
+                logger.error(f"Error sending no shops notification to manager {manager_id}: {e}")
+        return
+    
+    # Магазины без повторов по убыванию остатка; в карточке только первая страница,
+    # остальные подгружаются кнопками ◀️/▶️ из request_shop_lists
+    shops = rank_shops(available_shops, view.stock)
+    keyboard = make_shop_page_keyboard(request_key, shops)
+    
+    track_pending_request(request_key, "shop_selection", K_ID=ctx['K_ID'], code=product['Код'], urgent=urgent,
+                          uid=ctx['Telegram_ID'])
+    request_shop_lists[request_key] = shops
+    
+    # Отправляем оптовым менеджерам (всем или одному — по OPT_ROUTING)
+    route_opt_request(request_key, product['Фото'], card_text, keyboard)
+
+def rank_shops(shops, stock):
+    """
+    Магазины без повторов, по убыванию остатка товара (секция stock: имя, g_id, остаток, K_ID —
+    сопоставление по K_ID, не по названию); магазины без данных об остатке — в конце в исходном порядке.
+    """
+    quantities = Counter()
+    for row in stock:
+        quantities[row[3]] += row[2] or 0
+    ranked = []
+    seen = set()
+    for shop_id, shop_name in shops:
+        if shop_id in seen:
+            continue
+        seen.add(shop_id)
+        ranked.append([shop_id, shop_name, quantities.get(shop_id, 0)])
+    ranked.sort(key=lambda shop: -shop[2])
+    return ranked
+
+def make_shop_page_keyboard(request_key, shops, page=0):
+    """
+    Страница клавиатуры выбора магазина: SHOP_KEYBOARD_PAGE_SIZE магазинов,
+    кнопки ◀️/▶️ (shop_page_{request_key}_{page}) и отмена.
+    """
+    pages = max(1, -(-len(shops) // SHOP_KEYBOARD_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    keyboard = InlineKeyboardMarkup(row_width=1)
+    for shop_id, shop_name, quantity in shops[page * SHOP_KEYBOARD_PAGE_SIZE:(page + 1) * SHOP_KEYBOARD_PAGE_SIZE]:
+        label = f"🏪 {shop_name} ({quantity} шт)" if quantity else f"🏪 {shop_name}"
+        keyboard.add(InlineKeyboardButton(label[:64], callback_data=f"select_shop_{request_key}_{shop_id}"))
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(f"◀️ {page}/{pages}", callback_data=f"shop_page_{request_key}_{page - 1}"))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton(f"▶️ {page + 2}/{pages}", callback_data=f"shop_page_{request_key}_{page + 1}"))
+    if navigation:
+        keyboard.row(*navigation)
+    keyboard.add(InlineKeyboardButton(
+        "❌ Скасувати замовлення", 
+        callback_data=f"cancel_order_{request_key}"
+    ))
+    return keyboard
+
+def submit_transfer(order_key, ctx, code, urgent, receiver_name, shop_id, tag):
+    """
+    Вызывает create_transfer_opt_bot для заявки order_key и возвращает текст результата для клиента.
+    Повторный вызов по той же заявке (двойное нажатие, два менеджера одновременно, повтор
+    после падения) пропускается: заявка захватывается атомарно, после рестарта — по журналу.
+    """
+    if transfer_already_submitted(order_key) or not claim_transfer(order_key):
+        logger.warning(f"[{tag}] create_transfer_opt_bot for {order_key} was already submitted, skipping")
+        return "ℹ️ Це замовлення вже оформлено"
+
+    logger.info(f"[{tag}] Вызов процедуры create_transfer_opt_bot: K_ID={ctx['K_ID']}, code={code}, Emp_ID={ctx['Emp_ID']}, urgent={urgent}, Receiver='{receiver_name}', shop_id={shop_id}")
+    journal_order_event("transfer_started", order_key, K_ID=ctx['K_ID'], code=code, urgent=urgent,
+                        receiver=receiver_name, shop_id=shop_id)
+    try:
+        with db_query("transaction", "create_transfer_opt_bot") as cursor:
+            # Вызываем процедуру с OUTPUT параметром @result
+            cursor.execute("DECLARE @result nvarchar(200); EXEC create_transfer_opt_bot ?, ?, ?, ?, ?, ?, @result OUTPUT; SELECT @result as result", 
+                          ctx['K_ID'], code, ctx['Emp_ID'], urgent, receiver_name, shop_id)
+        
+            # Получаем результат процедуры
+            if cursor.nextset():
+                result_row = cursor.fetchone()
+                if result_row and result_row[0]:
+                    result = result_row[0]
+                    logger.info(f"[{tag}] Получен результат процедуры: {result}")
+                else:
+                    result = "✅ Замовлення обробляється"
+                    logger.info(f"[{tag}] Результат процедуры пустой, используем статическое сообщение")
+            else:
+                result = "✅ Замовлення обробляється"
+                logger.info(f"[{tag}] Не удалось получить результат процедуры, используем статическое сообщение")
+    except Exception as e:
+        logger.error(f"DB error in {tag} processing: {e}")
+        journal_order_event("transfer_failed", order_key, error=str(e))
+        # Процедура не выполнилась — заявку можно оформить повторно
+        transfer_claims.pop(order_key, None)
+        return f"Помилка обробки: {str(e)}"
+
+    journal_order_event("transfer_submitted", order_key, result=result)
+    return result
+
+def make_cart_card(cart, status_note=None):
+    """
+    Карточка заявки кошика для оптовых менеджеров: клиент, терміновість и по строке
+    на позицию с выбранным магазином.
+    """
+    client = cart["client"]
+    lines = []
+    if status_note:
+        lines.append(status_note)
+    lines.append(f"🛒 Замовлення з кошика: {len(cart['lines'])} поз.")
+    lines.append(f"Клієнт: [ID: {client['K_ID']}] {client['K_Name']} ({client['FIO']})")
+    lines.append(f"Менеджер клієнта: {client['Employee_FIO']}")
+    lines.append(f"Терміновість: {'Термінове' if cart['urgent'] else 'Не термінове'}")
+    for number, line in enumerate(cart["lines"], 1):
+        lines.append(f"\n{number}. 📦 {line['code']} • {line['name'][:60]} • {line['price']} грн")
+        shop = next((shop for shop in line["shops"] if shop[0] == line["shop_id"]), None)
+        if shop:
+            lines.append(f"    🏪 {shop[1]} ({shop[2]} шт)" if shop[2] else f"    🏪 {shop[1]}")
+        else:
+            lines.append("    ❌ Немає магазинів з наявністю")
+    return "\n".join(lines)
+
+def make_cart_keyboard(request_key, cart):
+    """
+    Кнопки карточки кошика: смена магазина по позиции (cart_line_{request_key}_{номер}),
+    оформление всех позиций и отмена.
+    """
+    keyboard = InlineKeyboardMarkup(row_width=1)
+    for number, line in enumerate(cart["lines"]):
+        if len(line["shops"]) > 1:
+            keyboard.add(InlineKeyboardButton(f"{number + 1}. {line['code']}: змінити магазин",
+                                              callback_data=f"cart_line_{request_key}_{number}"))
+    keyboard.row(
+        InlineKeyboardButton("✅ Оформити все", callback_data=f"cart_confirm_{request_key}"),
+        InlineKeyboardButton("❌ Скасувати", callback_data=f"cart_cancel_{request_key}")
+    )
+    return keyboard
+
+def make_cart_line_keyboard(request_key, cart, number):
+    """
+    Выбор магазина для одной позиции кошика: первые SHOP_KEYBOARD_PAGE_SIZE магазинов
+    по убыванию остатка и возврат к карточке.
+    """
+    line = cart["lines"][number]
+    keyboard = InlineKeyboardMarkup(row_width=1)
+    for shop_id, shop_name, quantity in line["shops"][:SHOP_KEYBOARD_PAGE_SIZE]:
+        mark = "✅ " if shop_id == line["shop_id"] else "🏪 "
+        label = f"{mark}{shop_name} ({quantity} шт)" if quantity else f"{mark}{shop_name}"
+        keyboard.add(InlineKeyboardButton(label[:64], callback_data=f"cart_shop_{request_key}_{number}_{shop_id}"))
+    keyboard.add(InlineKeyboardButton("⬅️ Назад", callback_data=f"cart_back_{request_key}"))
+    return keyboard
+
+def update_cart_cards(messages, text, keyboard=None):
+    """
+    Обновляет все разосланные карточки заявки кошика ([[chat_id, message_id], ...]).
+    """
+    for chat_id, message_id in messages:
+        try:
+            bot.edit_message_text(text, chat_id, message_id, reply_markup=keyboard)
+        except Exception as e:
+            logger.debug(f"[update_cart_cards] cannot edit {chat_id}/{message_id}: {e}")
+
+def send_cart_request(uid, ctx, codes, urgent):
+    """
+    Собирает позиции кошика (товар, магазины по убыванию остатка; первый выбран по умолчанию)
+    и отправляет одну заявку оптовым менеджерам. Возвращает заявку или None, если
+    ни одного товара не найдено.
+    """
+    lines = []
+    for code in codes:
+        view = fetch_product_view(code, DECISION_VIEW_SECTIONS)
+        if not view:
+            logger.warning(f"[send_cart_request] product {code} not found, skipping")
+            continue
+        shops = rank_shops(view.opt_shops, view.stock)
+        lines.append({
+            "code": code,
+            "name": view.product['Название'],
+            "price": view.product['Цена'],
+            "shops": shops,
+            "shop_id": shops[0][0] if shops else None
+        })
+    if not lines:
+        return None
+
+    # Ключ уникален и для двух заявок одного K_ID в одну секунду (разные пользователи, повторы)
+    request_key = f"cart_{ctx['K_ID']}_{uuid.uuid4().hex[:12]}"
+    cart = {
+        "uid": uid,
+        "client": {key: ctx[key] for key in ("K_ID", "K_Name", "FIO", "Employee_FIO", "Emp_ID")},
+        "urgent": urgent,
+        "lines": lines
+    }
+    logger.debug(f"[send_cart_request] {request_key}: {len(lines)} lines, urgent={urgent}")
+    track_pending_request(request_key, "cart", K_ID=ctx['K_ID'], codes=[line["code"] for line in lines],
+                          urgent=urgent, uid=uid)
+    cart_requests[request_key] = cart
+    route_opt_request(request_key, None, make_cart_card(cart, "🔔 Нове замовлення з кошика"),
+                      make_cart_keyboard(request_key, cart))
+    return cart
+
+def submit_cart_transfers(order_key, cart):
+    """
+    Оформляет все позиции кошика одним пакетом в одной транзакции: create_transfer_opt_bot
+    по каждой позиции с магазином, результаты — одним набором (номер позиции, @result).
+    При ошибке откатываются все позиции (XACT_ABORT). Возвращает текст результата по каждой позиции.
+    """
+    if transfer_already_submitted(order_key):
+        logger.warning(f"[cart] create_transfer_opt_bot for {order_key} was already submitted, skipping")
+        return ["ℹ️ Це замовлення вже оформлено"] * len(cart["lines"])
+
+    client = cart["client"]
+    numbers = [number for number, line in enumerate(cart["lines"]) if line["shop_id"] is not None]
+    results = ["❌ Немає в наявності"] * len(cart["lines"])
+    if not numbers:
+        return results
+
+    statements = []
+    params = []
+    for number in numbers:
+        line = cart["lines"][number]
+        statements.append(f"DECLARE @result{number} nvarchar(200); "
+                          f"EXEC create_transfer_opt_bot ?, ?, ?, ?, ?, ?, @result{number} OUTPUT;")
+        params += [client['K_ID'], line["code"], client['Emp_ID'], cart["urgent"], '', line["shop_id"]]
+    sql = ("SET NOCOUNT ON; SET XACT_ABORT ON; BEGIN TRANSACTION; " + " ".join(statements) +
+           " COMMIT TRANSACTION; " +
+           " UNION ALL ".join(f"SELECT {number} AS line, @result{number} AS result" for number in numbers))
+
+    logger.info(f"[cart] Вызов create_transfer_opt_bot пакетом: K_ID={client['K_ID']}, Emp_ID={client['Emp_ID']}, "
+                f"urgent={cart['urgent']}, lines={[(cart['lines'][n]['code'], cart['lines'][n]['shop_id']) for n in numbers]}")
+    journal_order_event("transfer_started", order_key, K_ID=client['K_ID'], urgent=cart["urgent"],
+                        lines=[[cart["lines"][n]["code"], cart["lines"][n]["shop_id"]] for n in numbers])
+    try:
+        with db_query("transaction", "create_transfer_cart") as cursor:
+            cursor.execute(sql, *params)
+            # Последний набор — наш SELECT; процедура может вернуть и свои наборы раньше
+            result_sets = read_result_sets(cursor)
+    except Exception as e:
+        logger.error(f"DB error in cart processing: {e}")
+        journal_order_event("transfer_failed", order_key, error=str(e))
+        for number in numbers:
+            results[number] = f"Помилка обробки: {str(e)}"
+        return results
+
+    returned = {row[0]: row[1] for row in (result_sets[-1] if result_sets else [])}
+    for number in numbers:
+        results[number] = returned.get(number) or "✅ Замовлення обробляється"
+    logger.info(f"[cart] Результаты процедуры по {order_key}: {results}")
+    journal_order_event("transfer_submitted", order_key, result=results)
+    return results
+
 def handle_shop_selection_decision(action, request_key, shop_id=None, shop_name=None, manager_id=None):
     """
     Обрабатывает решение менеджера по выбору магазина для обычных заказов.
@@ -802,6 +3433,8 @@ def handle_shop_selection_decision(action, request_key, shop_id=None, shop_name=
     
     # Кэш уже очищен при новом заказе, поэтому всегда обрабатываем новый запрос
     
+    resolve_pending_request(request_key, action, shop_id=shop_id, manager_id=manager_id)
+    
     # Сохраняем ответ первого менеджера
     manager_shop_selection_responses[request_key] = {
         'action': action,
@@ -834,18 +3467,18 @@ def handle_shop_selection_decision(action, request_key, shop_id=None, shop_name=
     
     logger.debug(f"[handle_shop_selection_decision] found context: {ctx}")
     
-    product = get_product_info(code)
-    if not product:
+    view = fetch_product_view(code, ())
+    if not view:
         logger.error(f"[SHOP_SELECTION] Не найден товар {code}")
         return
     
-    logger.debug(f"[handle_shop_selection_decision] found product: {product}")
+    logger.debug(f"[handle_shop_selection_decision] found product: {view.product}")
     
     urgent = user_urgency_choice.get(telegram_id, 0)
     logger.debug(f"[handle_shop_selection_decision] urgent={urgent}")
     
-    # Убираем кнопки у всех менеджеров и показываем результат
-    for manager_id in opt_manager_ids:
+    # Убираем кнопки у менеджеров, получивших заявку, и показываем результат
+    for manager_id in opt_request_recipients(request_key):
         try:
             if action == "select_shop":
                 message_text = f"✅ Менеджер вибрав магазин для відправки: {shop_name}"
@@ -855,8 +3488,8 @@ def handle_shop_selection_decision(action, request_key, shop_id=None, shop_name=
                 logger.debug(f"[handle_shop_selection_decision] sending cancellation to manager {manager_id}: {message_text}")
             
             # Отправляем новое сообщение с тем же текстом карточки, но без кнопок
-            card_text = make_opt_manager_card(product, ctx, urgent, status_note=message_text)
-            bot.send_photo(manager_id, product['Фото'], caption=card_text, reply_markup=None)
+            card_text = make_opt_manager_card(view, ctx, urgent, status_note=message_text)
+            bot.send_photo(manager_id, view.photo, caption=card_text, reply_markup=None)
             logger.debug(f"[handle_shop_selection_decision] updated card sent to manager {manager_id}")
         except Exception as e:
             logger.error(f"Error sending shop selection response to manager {manager_id}: {e}")
@@ -872,30 +3505,7 @@ def handle_shop_selection_decision(action, request_key, shop_id=None, shop_name=
             bot.send_message(telegram_id, "📦 Ваше замовлення обробляється...")
             
             # Выполняем процедуру с выбранным магазином
-            try:
-                logger.info(f"[SHOP_SELECTION_CONFIRM] Вызов процедуры create_transfer_opt_bot: K_ID={ctx['K_ID']}, code={code}, Emp_ID={ctx['Emp_ID']}, urgent={urgent}, Receiver='', shop_id={shop_id}")
-                
-                # Вызываем процедуру с OUTPUT параметром @result
-                cursor.execute("DECLARE @result nvarchar(200); EXEC create_transfer_opt_bot ?, ?, ?, ?, ?, ?, @result OUTPUT; SELECT @result as result", 
-                              ctx['K_ID'], code, ctx['Emp_ID'], urgent, '', shop_id)
-                
-                # Получаем результат процедуры
-                if cursor.nextset():
-                    result_row = cursor.fetchone()
-                    if result_row and result_row[0]:
-                        result = result_row[0]
-                        logger.info(f"[SHOP_SELECTION_CONFIRM] Получен результат процедуры: {result}")
-                    else:
-                        result = "✅ Замовлення обробляється"
-                        logger.info(f"[SHOP_SELECTION_CONFIRM] Результат процедуры пустой, используем статическое сообщение")
-                else:
-                    result = "✅ Замовлення обробляється"
-                    logger.info(f"[SHOP_SELECTION_CONFIRM] Не удалось получить результат процедуры, используем статическое сообщение")
-                
-            except Exception as e:
-                logger.error(f"DB error in shop selection processing: {e}")
-                result = f"Помилка обробки: {str(e)}"
-                logger.debug(f"[handle_shop_selection_decision] procedure failed with error: {e}")
+            result = submit_transfer(request_key, ctx, code, urgent, '', shop_id, "SHOP_SELECTION_CONFIRM")
             
             # Отправляем результат процедуры клиенту
             bot.send_message(telegram_id, result)
@@ -923,7 +3533,7 @@ def handle_shop_selection_decision(action, request_key, shop_id=None, shop_name=
     logger.debug(f"[handle_shop_selection_decision] END - function completed")
 
 # ─────────────────────────────────────────────────────────────────────────────
-# 6. Обработчики команд и сообщений
+# 7. Обработчики команд и сообщений
 # ─────────────────────────────────────────────────────────────────────────────
 @bot.message_handler(commands=['start'])
 def welcome(message):
@@ -934,11 +3544,148 @@ def welcome(message):
     else:
         bot.reply_to(message, "У вас немає доступу до цього бота.")
 
-@bot.message_handler(func=lambda m: m.text and m.text.isdigit())
-def handle_product_request(message):
-    uid  = message.from_user.id
-    code = int(message.text.strip())
-    logger.debug(f"[product_request] user={uid}, code={code}")
+@bot.message_handler(commands=['watch'])
+def handle_watch(message):
+    uid = message.from_user.id
+    logger.debug(f"[/watch] from {uid}: {message.text}")
+    if not is_allowed_user(uid):
+        bot.reply_to(message, "У вас немає доступу до цього бота.")
+        return
+
+    args = message.text.split()[1:]
+    if not args:
+        with stock_watches_lock:
+            codes = sorted(code for code, subscribers in stock_watches.items() if uid in subscribers)
+        if codes:
+            bot.reply_to(message, "🔔 Ви стежите за товарами: " + ", ".join(str(code) for code in codes))
+        else:
+            bot.reply_to(message, "Використання: /watch <код товару>")
+        return
+
+    if not args[0].isdigit():
+        bot.reply_to(message, "Використання: /watch <код товару>")
+        return
+
+    code = int(args[0])
+    if not get_product_info(code):
+        bot.reply_to(message, "Товар не знайдено. Спробуйте ще раз.")
+        return
+
+    if not add_stock_watch(uid, code):
+        bot.reply_to(message, f"❌ Досягнуто ліміту підписок ({WATCH_LIMIT_PER_USER}). Скасуйте зайві через /unwatch <код>.")
+        return
+
+    bot.reply_to(message, f"🔔 Повідомимо, щойно товар {code} з'явиться в наявності.")
+
+@bot.message_handler(commands=['unwatch'])
+def handle_unwatch(message):
+    uid = message.from_user.id
+    logger.debug(f"[/unwatch] from {uid}: {message.text}")
+    args = message.text.split()[1:]
+    if not args or not args[0].isdigit():
+        bot.reply_to(message, "Використання: /unwatch <код товару>")
+        return
+
+    code = int(args[0])
+    if remove_stock_watch(uid, code):
+        bot.reply_to(message, f"🔕 Підписку на товар {code} скасовано.")
+    else:
+        bot.reply_to(message, f"Ви не стежите за товаром {code}.")
+
+@bot.message_handler(commands=['pricelist'])
+def handle_pricelist(message):
+    uid = message.from_user.id
+    logger.debug(f"[/pricelist] from {uid}: {message.text}")
+    args = message.text.split()[1:]
+    fmt = "xlsx" if args and args[0].lower() == "xlsx" else "csv"
+
+    if not throttle_request(uid, ("pricelist", fmt)):
+        return
+
+    if not is_allowed_user(uid):
+        bot.reply_to(message, "У вас немає доступу до цього бота.")
+        return
+
+    if fmt == "xlsx" and not xlsx_available():
+        bot.reply_to(message, "XLSX зараз недоступний, надсилаємо CSV.")
+        fmt = "csv"
+
+    if not pricelist_cache.is_fresh(fmt):
+        bot.reply_to(message, "⏳ Формуємо прайс-лист, це може зайняти кілька хвилин — надішлемо файл, щойно він буде готовий.")
+    # Сборка идёт в фоне: поток обработки обновлений не ждёт её
+    pricelist_cache.request(fmt, functools.partial(deliver_pricelist, uid, fmt))
+
+def deliver_pricelist(uid, fmt, entry, error, retry=True):
+    """
+    Отправляет клиенту готовый прайс-лист (по file_id или файлом). Если файл уже удалён,
+    один раз запрашивает свежую сборку.
+    """
+    if error is not None:
+        bot.send_message(uid, "❌ Не вдалося сформувати прайс-лист. Спробуйте пізніше.")
+        return
+    caption = f"📄 Прайс-лист: {entry['products']} товарів у наявності, станом на {entry['built_at']:%d.%m.%Y %H:%M}"
+    if entry["file_id"]:
+        bot.send_document(uid, entry["file_id"], caption=caption)
+        return
+    try:
+        f = open(entry["path"], "rb")
+    except FileNotFoundError:
+        logger.warning(f"Pricelist file {entry['path']} is gone, rebuilding")
+        pricelist_cache.invalidate(fmt, entry)
+        if retry:
+            pricelist_cache.request(fmt, functools.partial(deliver_pricelist, uid, fmt, retry=False))
+        else:
+            bot.send_message(uid, "❌ Не вдалося сформувати прайс-лист. Спробуйте пізніше.")
+        return
+    with f:
+        sent = bot.send_document(uid, f, caption=caption,
+                                 visible_file_name=f"pricelist_{entry['built_at']:%Y%m%d_%H%M}.{fmt}")
+    entry["file_id"] = sent.document.file_id
+
+def send_cart(uid):
+    """
+    Показывает клиенту кошик: позиции, выбор терміновості (он же отправка), удаление позиций.
+    """
+    codes = user_carts.get(uid, [])
+    if not codes:
+        bot.send_message(uid, "🛒 Кошик порожній. Введіть код товару та натисніть «🛒 Додати в кошик».")
+        return
+    products = load_products_batch(codes)
+    lines = [f"🛒 Кошик ({len(codes)} поз.):"]
+    keyboard = InlineKeyboardMarkup(row_width=4)
+    for number, code in enumerate(codes, 1):
+        product = products.get(code)
+        lines.append(f"{number}. {code} • {product['Название']} • {product['Цена']} грн" if product
+                     else f"{number}. {code} • товар не знайдено")
+    keyboard.add(*[InlineKeyboardButton(f"🗑 {code}", callback_data=f"cart_remove_{code}") for code in codes])
+    keyboard.row(InlineKeyboardButton("🚀 Відправити: термінове", callback_data="cart_send_1"))
+    keyboard.row(InlineKeyboardButton("⏳ Відправити: не термінове", callback_data="cart_send_0"))
+    keyboard.row(InlineKeyboardButton("❌ Очистити кошик", callback_data="cart_clear"))
+    bot.send_message(uid, "\n".join(lines), reply_markup=keyboard)
+
+@bot.message_handler(commands=['cart'])
+def handle_cart(message):
+    uid = message.from_user.id
+    logger.debug(f"[/cart] from {uid}")
+
+    if not throttle_request(uid, ("cart",)):
+        return
+
+    if not is_allowed_user(uid):
+        bot.reply_to(message, "У вас немає доступу до цього бота.")
+        return
+
+    send_cart(uid)
+
+@bot.message_handler(func=lambda m: m.text and m.text.isdigit())
+def handle_product_request(message):
+    uid  = message.from_user.id
+    code = int(message.text.strip())
+    logger.debug(f"[product_request] user={uid}, code={code}")
+
+    # Лимит проверяем до авторизации, чтобы поток запросов не доходил до БД
+    if not throttle_request(uid, ("product", code)):
+        return
 
     if not is_allowed_user(uid):
         bot.reply_to(message, "У вас немає доступу до цього бота.")
@@ -947,10 +3694,17 @@ def handle_product_request(message):
     # Очищаем кэш при новом запросе товара
     clear_user_cache(uid)
 
+    if not send_product_offer(uid, code):
+        bot.reply_to(message, "Товар не знайдено. Спробуйте ще раз.")
+
+def send_product_offer(uid, code):
+    """
+    Показывает клиенту товар (фото и данные) с кнопками запроса.
+    Возвращает False, если товар не найден.
+    """
     product = get_product_info(code)
     if not product:
-        bot.reply_to(message, "Товар не знайдено. Спробуйте ще раз.")
-        return
+        return False
 
     # Отправляем фото и данные
     caption = (
@@ -963,13 +3717,32 @@ def handle_product_request(message):
     # Сохраняем код
     user_last_product_code[uid] = code
 
-    # Кнопки: запросить / выбрать другой
-    keyboard = InlineKeyboardMarkup()
+    # Кнопки: запросить / в кошик / выбрать другой
+    keyboard = InlineKeyboardMarkup(row_width=2)
     keyboard.add(
         InlineKeyboardButton("📩 Запросити цей товар", callback_data="request_product"),
+        InlineKeyboardButton("🛒 Додати в кошик", callback_data="cart_add"),
         InlineKeyboardButton("🔄 Вибрати інший товар", callback_data="change_product")
     )
     bot.send_message(uid, "Що бажаєте зробити далі?", reply_markup=keyboard)
+    return True
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith("show_product:"))
+def handle_show_product(c):
+    uid = c.from_user.id
+    code = int(c.data.split(":")[1])
+    logger.debug(f"[show_product] user={uid}, code={code}")
+
+    if not throttle_request(uid, ("product", code)):
+        return
+
+    if not is_allowed_user(uid):
+        bot.send_message(uid, "У вас немає доступу до цього бота.")
+        return
+
+    clear_user_cache(uid)
+    if not send_product_offer(uid, code):
+        bot.send_message(uid, "Товар не знайдено. Спробуйте ще раз.")
 
 @bot.callback_query_handler(func=lambda c: c.data == "change_product")
 def handle_change_product(c):
@@ -1024,8 +3797,10 @@ def handle_self_delivery_request(c):
     # Получаем список доступных магазинов для самовывоза из Киева
     available_shops = get_self_delivery_shops(code)
     if not available_shops:
-        bot.send_message(uid, "На жаль, товар недоступний для самовивозу з Києва.")
+        bot.send_message(uid, f"На жаль, товар недоступний для самовивозу з Києва. Щоб дізнатися про появу товару, надішліть /watch {code}")
         return
+    # Выбор клиента и карточка менеджерам строятся по этому же списку
+    user_self_delivery_shops[uid] = {"code": code, "shops": [[shop[0], shop[1]] for shop in available_shops]}
 
     # Показываем список магазинов
     shop_text = "Оберіть магазин для самовивозу з Києва:\n\n"
@@ -1045,6 +3820,13 @@ def handle_self_delivery_request(c):
     keyboard.add(InlineKeyboardButton("🔄 Вибрати інший товар", callback_data="change_product"))
     bot.send_message(uid, "Оберіть магазин:", reply_markup=keyboard)
 
+def offered_self_delivery_shops(uid, code):
+    """
+    Магазины самовывоза, показанные клиенту для этого товара (None — список не сохранён).
+    """
+    offered = user_self_delivery_shops.get(uid)
+    return offered["shops"] if offered and offered["code"] == code else None
+
 @bot.callback_query_handler(func=lambda c: c.data.startswith("select_shop:"))
 def handle_shop_selection(c):
     uid = c.from_user.id
@@ -1058,7 +3840,9 @@ def handle_shop_selection(c):
         return
 
     # Получаем информацию о выбранном магазине
-    available_shops = get_self_delivery_shops(code)
+    available_shops = offered_self_delivery_shops(uid, code)
+    if available_shops is None:
+        available_shops = get_self_delivery_shops(code)
     selected_shop = None
     for shop in available_shops:
         if shop[0] == shop_id:
@@ -1127,10 +3911,14 @@ def handle_receiver_name_input(message):
         return
     
     # Отправляем уведомление менеджерам с ФИО получателя
-    product = get_product_info(code)
-    if product:
-        available_shops = get_self_delivery_shops(code)
-        send_self_delivery_notification(product, ctx, selected_shop, available_shops, receiver_name)
+    offered_shops = offered_self_delivery_shops(uid, code)
+    if offered_shops is not None:
+        view = fetch_product_view(code, ())
+        view = view and replace(view, self_delivery_shops=offered_shops)
+    else:
+        view = fetch_product_view(code, SELF_DELIVERY_VIEW_SECTIONS)
+    if view:
+        send_self_delivery_notification(view, ctx, selected_shop, receiver_name)
     
     bot.send_message(uid, f"✅ ФИО отримувача збережено: {receiver_name}")
     bot.send_message(uid, "⏳ Очікуйте підтвердження від менеджера...")
@@ -1151,20 +3939,18 @@ def handle_urgency_choice(c):
         bot.send_message(uid, "Внутрішня помилка. Спробуйте ще раз.")
         return
     
-    product = get_product_info(code)
-    if not product:
+    # Товар, флаг бренда и все секции карточек для обоих сценариев — одним пакетом
+    view = fetch_product_view(code, MANAGER_VIEW_SECTIONS)
+    if not view:
         bot.send_message(uid, "Товар не знайдено.")
         return
     
     # Проверяем чувствительность бренда
-    brand_id = product.get('Brand_ID')
-    is_sensitive = is_sensitive_brand(brand_id) if brand_id else False
-    
-    if is_sensitive:
-        # Для чувствительных брендов отправляем разбитые сообщения менеджеру
+    if view.sensitive:
+        # Для чувствительных брендов отправляем менеджеру одну карточку с полной информацией
         logger.debug(f"[urgency_choice] sending sensitive brand notification for code={code}")
         
-        success = send_sensitive_brand_notification(product, ctx, urgent, uid, code)
+        success = send_sensitive_brand_notification(view, ctx, urgent, uid)
         
         if success:
             bot.send_message(uid, "Ваш запит відправлено менеджеру для підтвердження.")
@@ -1176,7 +3962,7 @@ def handle_urgency_choice(c):
         bot.send_message(uid, "Ваш запит відправлено менеджерам для опрацювання зачекайте.")
         
         # Отправляем уведомление менеджерам опта с выбором магазина
-        send_shop_selection_notification(product, ctx, urgent, "🔔 Клієнт зацікавився товаром")
+        send_shop_selection_notification(view, ctx, urgent, "🔔 Клієнт зацікавився товаром")
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith("approve_") or c.data.startswith("reject_"))
 def handle_decision(c):
@@ -1191,13 +3977,13 @@ def handle_decision(c):
     if ctx is None:
         bot.send_message(int(uid_str), "Внутрішня помилка (контекст користувача). Спробуйте ще раз.")
         return
-    product = get_product_info(code)
-    if product is None:
+    view = fetch_product_view(code, DECISION_VIEW_SECTIONS)
+    if view is None:
         bot.send_message(int(uid_str), "Сталася внутрішня помилка. Спробуйте ще раз.")
         return
 
+    resolve_pending_request(f"sensitive_{uid_str}_{code}", action, manager_id=c.from_user.id)
     urgent = user_urgency_choice.get(int(uid_str), 0)
-    stock = get_stock_info(code)
 
     if action == "approve":
         logger.debug(f"[CONFIRM] manager approved request for user {uid_str}, code {code}")
@@ -1209,20 +3995,20 @@ def handle_decision(c):
                 logger.debug(f"[CONFIRM] sending confirmation to manager {manager_id}: {message_text}")
                 
                 # Отправляем новое сообщение с тем же текстом карточки, но без кнопок
-                card_text = make_manager_card(product, ctx, urgent, interest=None, zalog=None, stock=None, status_note=message_text)
-                bot.send_photo(manager_id, product['Фото'], caption=card_text, reply_markup=None)
+                card_text = make_manager_card(view, ctx, urgent, status_note=message_text, details=False)
+                bot.send_photo(manager_id, view.photo, caption=card_text, reply_markup=None)
                 logger.debug(f"[CONFIRM] updated card sent to manager {manager_id}")
             except Exception as e:
                 logger.error(f"Error sending confirmation to manager {manager_id}: {e}")
         
         # Отправляем уведомление менеджерам опта с выбором магазина
         logger.debug(f"[CONFIRM] sending shop selection notification to opt managers")
-        send_shop_selection_notification(product, ctx, urgent, "✅ Замовлення підтверджено менеджером.")
+        send_shop_selection_notification(view, ctx, urgent, "✅ Замовлення підтверджено менеджером.")
         
     else:  # reject
         bot.send_message(int(uid_str), "Ваш запит відхилено. Спробуйте інший товар або зверніться до менеджера.")
         # ОПТОВЫМ МЕНЕДЖЕРАМ: отклонено менеджером
-        send_opt_manager_notification(product, ctx, urgent, "❌ Замовлення відхилено менеджером.", stock)
+        send_opt_manager_notification(view, ctx, urgent, "❌ Замовлення відхилено менеджером.")
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith("self_delivery_"))
 def handle_self_delivery_decision_callback(c):
@@ -1285,31 +4071,9 @@ def handle_confirm_self_delivery_order(c):
         bot.send_message(uid, "Внутрішня помилка. Спробуйте ще раз.")
         return
     
-    # Выполняем процедуру с новыми параметрами
-    try:
-        logger.info(f"[SELF_DELIVERY_CONFIRM] Вызов процедуры create_transfer_opt_bot: K_ID={ctx['K_ID']}, code={code}, Emp_ID={ctx['Emp_ID']}, urgent=1, Receiver='{receiver_name}', shop_id={selected_shop[0]}")
-        
-        # Вызываем процедуру с OUTPUT параметром @result
-        cursor.execute("DECLARE @result nvarchar(200); EXEC create_transfer_opt_bot ?, ?, ?, ?, ?, ?, @result OUTPUT; SELECT @result as result", 
-                      ctx['K_ID'], code, ctx['Emp_ID'], 1, receiver_name or '', selected_shop[0])
-        
-        # Получаем результат процедуры
-        if cursor.nextset():
-            result_row = cursor.fetchone()
-            if result_row and result_row[0]:
-                result = result_row[0]
-                logger.info(f"[SELF_DELIVERY_CONFIRM] Получен результат процедуры: {result}")
-            else:
-                result = "✅ Замовлення обробляється"
-                logger.info(f"[SELF_DELIVERY_CONFIRM] Результат процедуры пустой, используем статическое сообщение")
-        else:
-            result = "✅ Замовлення обробляється"
-            logger.info(f"[SELF_DELIVERY_CONFIRM] Не удалось получить результат процедуры, используем статическое сообщение")
-        
-    except Exception as e:
-        logger.error(f"DB error in self-delivery confirm processing: {e}")
-        result = f"Помилка обробки: {str(e)}"
-        logger.debug(f"[SELF_DELIVERY_CONFIRM] procedure failed with error: {e}")
+    # Выполняем процедуру с новыми параметрами; заявка — та, по которой менеджер подтвердил самовывоз
+    order_key = user_self_delivery_pending.get(uid) or f"self_delivery_{ctx['K_ID']}_{code}_{selected_shop[0]}"
+    result = submit_transfer(order_key, ctx, code, 1, receiver_name or '', selected_shop[0], "SELF_DELIVERY_CONFIRM")
     
     # Отправляем результат процедуры клиенту
     bot.send_message(uid, result)
@@ -1318,7 +4082,7 @@ def handle_confirm_self_delivery_order(c):
     # Уведомляем менеджеров о подтверждении заказа
     product = get_product_info(code)
     if product:
-        for manager_id in opt_manager_ids:
+        for manager_id in opt_request_recipients(order_key):
             try:
                 notification_text = (
                     f"✅ Клієнт підтвердив замовлення\n"
@@ -1364,12 +4128,18 @@ def handle_shop_selection_callback(c):
         parts = request_key.split("_")
         code = int(parts[3])  # получаем code из shop_selection_{client_id}_{code} -> parts[3] = code
         logger.debug(f"[handle_shop_selection_callback] parsed code: {code}")
-        available_shops = get_available_shops(code)
-        shop_name = "неизвестный магазин"
-        for shop in available_shops:
-            if shop[0] == shop_id:  # shop[0] - это shop_id
-                shop_name = shop[1]  # shop[1] - это shop_name
-                break
+        # Магазин ищем в списке, который был в кнопках заявки; без него — в справочнике
+        frozen_shops = request_shop_lists.get(request_key)
+        if frozen_shops is not None:
+            shop = next((shop for shop in frozen_shops if shop[0] == shop_id), None)
+            if not shop:
+                logger.warning(f"[handle_shop_selection_callback] shop {shop_id} is not in request {request_key}")
+                bot.answer_callback_query(c.id, "Цього магазину немає в заявці")
+                return
+            shop_name = shop[1]
+        else:
+            ensure_shop_directory()
+            shop_name = shop_directory.name(shop_id, "неизвестный магазин")
         logger.debug(f"[handle_shop_selection_callback] found shop_name: {shop_name}")
         logger.debug(f"[handle_shop_selection_callback] calling handle_shop_selection_decision with shop_name: {shop_name}")
         handle_shop_selection_decision("select_shop", request_key, shop_id=shop_id, shop_name=shop_name, manager_id=c.from_user.id)
@@ -1385,9 +4155,1571 @@ def handle_shop_selection_callback(c):
     else:
         logger.error(f"[handle_shop_selection_callback] unknown action pattern: {action_data}")
 
+@bot.callback_query_handler(func=lambda c: c.data.startswith("shop_page_"))
+def handle_shop_page_callback(c):
+    # Формат: shop_page_shop_selection_{client_id}_{code}_{page}
+    request_key, page = c.data[len("shop_page_"):].rsplit("_", 1)
+    shops = request_shop_lists.get(request_key)
+    logger.debug(f"[handle_shop_page_callback] request_key={request_key}, page={page}, shops={len(shops or [])}")
+    if shops is None or request_key not in pending_requests:
+        bot.answer_callback_query(c.id, "Заявку вже оброблено")
+        return
+    try:
+        bot.edit_message_reply_markup(c.message.chat.id, c.message.message_id,
+                                      reply_markup=make_shop_page_keyboard(request_key, shops, int(page)))
+    except Exception as e:
+        logger.debug(f"[handle_shop_page_callback] cannot switch page: {e}")
+    bot.answer_callback_query(c.id)
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith("more_"))
+def handle_show_more_callback(c):
+    # Формат: more_{section}_{code}_{cursor}
+    uid = c.from_user.id
+    # Интересы и залоги (продавцы, телефоны) — только для менеджеров
+    if uid not in manager_ids and uid not in opt_manager_ids:
+        logger.warning(f"[handle_show_more_callback] user {uid} is not a manager: {c.data}")
+        bot.answer_callback_query(c.id, "У вас немає доступу")
+        return
+    if not throttle_request(uid, ("more", c.data)):
+        bot.answer_callback_query(c.id)
+        return
+    _, section, code, cursor = c.data.split("_", 3)
+    logger.debug(f"[handle_show_more_callback] section={section}, code={code}, cursor={cursor}")
+    if section not in DETAIL_SECTIONS:
+        logger.error(f"[handle_show_more_callback] unknown section: {c.data}")
+        return
+    rows, offset = fetch_detail_page(section, int(code), cursor)
+    text = DETAIL_SECTIONS[section][1](rows)
+    keyboard = None
+    button = detail_more_button(section, code, rows, offset)
+    if button:
+        keyboard = InlineKeyboardMarkup()
+        keyboard.add(button)
+    bot.send_message(c.message.chat.id, f"📦 Код: {code}\n{text}" if text else "Більше записів немає", reply_markup=keyboard)
+    bot.answer_callback_query(c.id)
+
+@bot.callback_query_handler(func=lambda c: c.data in ("cart_add", "cart_clear")
+                            or c.data.startswith("cart_remove_") or c.data.startswith("cart_send_"))
+def handle_cart_callback(c):
+    uid = c.from_user.id
+    logger.debug(f"[handle_cart_callback] user={uid}, data={c.data}")
+
+    # Повторное нажатие той же кнопки (в том числе «Відправити») отсекается здесь
+    if not throttle_request(uid, ("cart", c.data, user_last_product_code.get(uid))):
+        bot.answer_callback_query(c.id)
+        return
+
+    if c.data == "cart_add":
+        code = user_last_product_code.get(uid)
+        product = get_product_info(code) if code else None
+        if not product:
+            bot.answer_callback_query(c.id, "Спочатку введіть код товару")
+            return
+        # Чутливі бренди потребують окремого підтвердження — у кошик не додаються
+        if product['Brand_ID'] and is_sensitive_brand(product['Brand_ID']):
+            bot.send_message(uid, "⚠️ Цей товар потребує підтвердження менеджера — замовте його окремо кнопкою «📩 Запросити цей товар».")
+            bot.answer_callback_query(c.id)
+            return
+        outcome = None
+
+        def add_line(cart):
+            nonlocal outcome
+            cart = cart or []
+            if code in cart:
+                outcome = "duplicate"
+                return cart
+            if len(cart) >= CART_MAX_LINES:
+                outcome = "full"
+                return cart
+            outcome = "added"
+            return cart + [code]
+
+        cart = modify_state(user_carts, uid, add_line)
+        if outcome == "duplicate":
+            bot.answer_callback_query(c.id, "Товар вже в кошику")
+            return
+        if outcome == "full":
+            bot.send_message(uid, f"У кошику вже {CART_MAX_LINES} позицій — відправте його (/cart) і почніть новий.")
+        else:
+            bot.send_message(uid, f"🛒 Товар {code} додано. У кошику {len(cart)} поз. "
+                                  f"Введіть наступний код або /cart, щоб відправити замовлення.")
+    elif c.data == "cart_clear":
+        user_carts.pop(uid, None)
+        bot.send_message(uid, "🛒 Кошик очищено.")
+    elif c.data.startswith("cart_remove_"):
+        code = int(c.data[len("cart_remove_"):])
+        modify_state(user_carts, uid, lambda cart: [item for item in cart or [] if item != code] or None)
+        send_cart(uid)
+    else:
+        urgent = 1 if c.data == "cart_send_1" else 0
+        ctx = user_context.get(uid)
+        # Кошик забираем атомарно: второе нажатие (или другой поток) получит пустой кошик
+        cart = user_carts.pop(uid, None) if ctx else None
+        if not cart:
+            bot.answer_callback_query(c.id, "Кошик порожній")
+            return
+        try:
+            sent = send_cart_request(uid, ctx, cart, urgent)
+        except Exception:
+            sent = None
+            logger.exception(f"[handle_cart_callback] failed to send cart of user {uid}")
+        if not sent:
+            # Возвращаем позиции в кошик, не теряя добавленных за это время
+            modify_state(user_carts, uid, lambda current: cart + [item for item in current or [] if item not in cart])
+            bot.send_message(uid, "Не вдалося відправити кошик. Спробуйте ще раз.")
+            bot.answer_callback_query(c.id)
+            return
+        bot.send_message(uid, f"Ваше замовлення ({len(sent['lines'])} поз.) відправлено менеджерам для опрацювання, зачекайте.")
+    bot.answer_callback_query(c.id)
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith(("cart_line_", "cart_shop_", "cart_back_",
+                                                              "cart_confirm_", "cart_cancel_")))
+def handle_cart_request_callback(c):
+    # Форматы: cart_line_{request_key}_{номер}, cart_shop_{request_key}_{номер}_{shop_id},
+    # cart_back_/cart_confirm_/cart_cancel_{request_key}; request_key = cart_{K_ID}_{uuid}
+    _, action, request_key = c.data.split("_", 2)
+    number = shop_id = None
+    if action == "line":
+        request_key, number = request_key.rsplit("_", 1)
+    elif action == "shop":
+        request_key, number, shop_id = request_key.rsplit("_", 2)
+    logger.debug(f"[handle_cart_request_callback] action={action}, request_key={request_key}, number={number}, shop_id={shop_id}")
+
+    cart = cart_requests.get(request_key)
+    if cart is None or request_key not in pending_requests:
+        bot.answer_callback_query(c.id, "Заявку вже оброблено")
+        return
+
+    if action == "line":
+        try:
+            bot.edit_message_reply_markup(c.message.chat.id, c.message.message_id,
+                                          reply_markup=make_cart_line_keyboard(request_key, cart, int(number)))
+        except Exception as e:
+            logger.debug(f"[handle_cart_request_callback] cannot show shops: {e}")
+    elif action == "back":
+        try:
+            bot.edit_message_reply_markup(c.message.chat.id, c.message.message_id,
+                                          reply_markup=make_cart_keyboard(request_key, cart))
+        except Exception as e:
+            logger.debug(f"[handle_cart_request_callback] cannot return to card: {e}")
+    elif action == "shop":
+        number, shop_id = int(number), int(shop_id)
+        line = cart["lines"][number]
+        if not any(shop[0] == shop_id for shop in line["shops"]):
+            bot.answer_callback_query(c.id, "Цього магазину немає в заявці")
+            return
+        # Заявка общая для всех получивших: заменяем позицию атомарно и обновляем все карточки
+        def select_shop(current):
+            if current is None:
+                return None
+            lines = list(current["lines"])
+            lines[number] = {**lines[number], "shop_id": shop_id}
+            return {**current, "lines": lines}
+
+        cart = modify_state(cart_requests, request_key, select_shop)
+        if cart is None:
+            bot.answer_callback_query(c.id, "Заявку вже оброблено")
+            return
+        update_cart_cards(request_messages.get(request_key, []), make_cart_card(cart),
+                          make_cart_keyboard(request_key, cart))
+    elif action == "confirm":
+        messages = request_messages.get(request_key, [])
+        # Заявку забирает только один менеджер: pop атомарен и между потоками, и между процессами
+        if pending_requests.pop(request_key, None) is None:
+            bot.answer_callback_query(c.id, "Заявку вже оброблено")
+            return
+        cart = cart_requests.get(request_key, cart)
+        resolve_pending_request(request_key, "confirm", manager_id=c.from_user.id)
+        bot.answer_callback_query(c.id, "Оформлюємо…")
+        results = submit_cart_transfers(request_key, cart)
+        summary = "\n".join(f"{number}. {line['code']} • {line['name'][:60]}: {result}"
+                            for number, (line, result) in enumerate(zip(cart["lines"], results), 1))
+        update_cart_cards(messages, f"{make_cart_card(cart, '✅ Оформлено')}\n\n{summary}")
+        try:
+            bot.send_message(cart["uid"], f"📦 Результат замовлення з кошика:\n{summary}")
+        except Exception as e:
+            logger.error(f"Failed to notify client {cart['uid']} about cart {request_key}: {e}")
+        return
+    else:
+        messages = request_messages.get(request_key, [])
+        if pending_requests.pop(request_key, None) is None:
+            bot.answer_callback_query(c.id, "Заявку вже оброблено")
+            return
+        resolve_pending_request(request_key, "cancel", manager_id=c.from_user.id)
+        update_cart_cards(messages, make_cart_card(cart, "❌ Замовлення скасовано"))
+        try:
+            bot.send_message(cart["uid"], "❌ Менеджер скасував замовлення з кошика. Зверніться до свого менеджера.")
+        except Exception as e:
+            logger.error(f"Failed to notify client {cart['uid']} about cart {request_key}: {e}")
+    bot.answer_callback_query(c.id)
+
+@bot.inline_handler(func=lambda q: True)
+def handle_inline_query(q):
+    uid = q.from_user.id
+    query = (q.query or "").strip()
+    logger.debug(f"[inline_query] user={uid}, query={query}")
+
+    # Контекст уже загружен — не проверяем доступ в БД на каждый набранный символ
+    if uid not in user_context and not is_allowed_user(uid):
+        bot.answer_inline_query(q.id, [], cache_time=INLINE_CACHE_TIME, is_personal=True)
+        return
+
+    if query.isdigit():
+        codes = [int(query)]
+    elif len(CatalogIndex.normalize(query)) >= 3 and catalog_loaded:
+        codes = [g_id for g_id, name in catalog_index.search(query, limit=INLINE_RESULTS_LIMIT)]
+    else:
+        codes = []
+
+    results = []
+    for code in codes:
+        result = get_inline_result(code)
+        if result:
+            results.append(result)
+
+    try:
+        bot.answer_inline_query(q.id, results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+    except Exception as e:
+        logger.error(f"Failed to answer inline query from {uid}: {e}")
+
+@bot.message_handler(func=lambda m: m.text and not m.text.startswith("/") and not m.text.strip().isdigit())
+def handle_name_search(message):
+    uid = message.from_user.id
+    query = message.text.strip()
+    logger.debug(f"[name_search] user={uid}, query={query}")
+
+    if not throttle_request(uid, ("search", query.lower())):
+        return
+
+    if not is_allowed_user(uid):
+        bot.reply_to(message, "У вас немає доступу до цього бота.")
+        return
+
+    if len(CatalogIndex.normalize(query)) < 3:
+        bot.reply_to(message, "Введіть код товару або щонайменше 3 символи назви.")
+        return
+
+    if not catalog_loaded:
+        bot.reply_to(message, "Пошук за назвою ще завантажується. Спробуйте за хвилину або введіть код товару.")
+        return
+
+    started = time.perf_counter()
+    results = catalog_index.search(query)
+    logger.debug(f"[name_search] {len(results)} results in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    if not results:
+        bot.reply_to(message, "Нічого не знайдено. Спробуйте інший запит або введіть код товару.")
+        return
+
+    keyboard = InlineKeyboardMarkup(row_width=1)
+    for g_id, name in results:
+        keyboard.add(InlineKeyboardButton(f"{g_id} • {name}"[:64], callback_data=f"show_product:{g_id}"))
+    bot.send_message(uid, "🔎 Знайдені товари:", reply_markup=keyboard)
+
+# ─────────────────────────────────────────────────────────────────────────────
+# 8. Запись и воспроизведение трафика
+# ─────────────────────────────────────────────────────────────────────────────
+# Трасса — JSON Lines (gzip, если путь заканчивается на .gz). Записи:
+#   {"v": 1, "managers": [...], "opt_managers": [...]}            — заголовок
+#   {"t": сек, "u": update}                                         — входящее обновление
+#   {"t": сек, "db": имя, "a": параметры, "r": [наборы строк], "c": [первая колонка набора], "d": сек, "e": ошибка}
+#   {"t": сек, "db": имя, "a": параметры, "n": [число строк], "d": сек} — массовые загрузки ("bulk")
+# Telegram ID заменяются псевдонимами, персональные данные — заглушками.
+
+# Запросы, текстовые поля которых можно сохранять как есть (каталог и магазины)
+TRACE_KEEP_TEXT = {
+    "get_product_info", "get_stock_info", "get_available_shops", "get_self_delivery_shops",
+    "get_shops_for_sensitive_brand", "get_shops_for_opt_managers", "load_catalog",
+    "is_sensitive_brand", "get_stock_snapshot", "probe_mysql_sales",
+    "load_shop_directory",
+}
+
+def trace_params(name, params, scrub_value=lambda v: v):
+    """
+    Параметры запроса в том виде, в каком они пишутся в трассу: строки (ФИО получателя,
+    поисковые фразы) заменяются заглушкой, если запрос не в TRACE_KEEP_TEXT.
+    """
+    keep_text = name in TRACE_KEEP_TEXT
+    return ["***" if isinstance(v, str) and not keep_text else scrub_value(v) for v in params]
+
+def trace_encode(value):
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    if isinstance(value, date):
+        return {"$d": value.isoformat()}
+    if isinstance(value, Decimal):
+        return {"$dec": str(value)}
+    if isinstance(value, (bytes, bytearray)):
+        return {"$bytes": len(value)}
+    if isinstance(value, (tuple, set, pyodbc.Row)):
+        return list(value)
+    raise TypeError(f"Unsupported trace value: {type(value)}")
+
+def trace_decode(obj):
+    if "$dt" in obj:
+        return datetime.fromisoformat(obj["$dt"])
+    if "$d" in obj:
+        return date.fromisoformat(obj["$d"])
+    if "$dec" in obj:
+        return Decimal(obj["$dec"])
+    if "$bytes" in obj:
+        return b""
+    return obj
+
+def open_trace(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+class TraceRecorder:
+    """
+    Пишет трассу: входящие обновления и результаты запросов к БД, с обезличиванием.
+    """
+
+    def __init__(self, path):
+        self.file = open_trace(path, "w")
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.ids = {}  # настоящий Telegram ID -> псевдоним
+        self.write({
+            "v": 1,
+            "managers": [self.pseudonym(m_id) for m_id in manager_ids],
+            "opt_managers": [self.pseudonym(m_id) for m_id in opt_manager_ids]
+        })
+
+    def write(self, record):
+        line = json.dumps(record, default=trace_encode, ensure_ascii=False, separators=(",", ":"))
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def pseudonym(self, telegram_id):
+        with self.lock:
+            if telegram_id not in self.ids:
+                self.ids[telegram_id] = 900000000 + len(self.ids) + 1
+            return self.ids[telegram_id]
+
+    def scrub_value(self, value):
+        # Короткие числа (коды, флаги, K_ID) не трогаем — Telegram ID длиннее
+        if isinstance(value, int) and not isinstance(value, bool) and value >= 1000000 and value in self.ids:
+            return self.ids[value]
+        return value
+
+    def scrub_text(self, text):
+        if text.startswith("/") or text.strip().isdigit():
+            return text
+        return "x" * len(text)
+
+    def scrub_update(self, value, key=None):
+        if isinstance(value, dict):
+            if key in ("from", "chat", "user", "sender_chat") and "id" in value:
+                value = dict(value, id=self.pseudonym(value["id"]))
+            result = {}
+            for k, v in value.items():
+                if k in ("first_name", "last_name", "username", "title", "phone_number"):
+                    result[k] = "user"
+                elif k in ("text", "query", "caption") and isinstance(v, str):
+                    result[k] = self.scrub_text(v)
+                elif k == "data" and isinstance(v, str):
+                    result[k] = re.sub(r"\d+", lambda m: str(self.scrub_value(int(m.group()))), v)
+                else:
+                    result[k] = self.scrub_update(v, k)
+            return result
+        if isinstance(value, list):
+            return [self.scrub_update(item) for item in value]
+        return value
+
+    def record_update(self, raw_update):
+        self.write({"t": round(time.monotonic() - self.started, 3), "u": self.scrub_update(raw_update)})
+
+    def record_db(self, name, params, result_sets, duration, error=None, counts_only=False, columns=None):
+        record = {
+            "t": round(time.monotonic() - self.started, 3),
+            "db": name,
+            "a": trace_params(name, params, self.scrub_value),
+            "d": round(duration, 4)
+        }
+        if error:
+            record["e"] = error
+        # Массовые загрузки перечитываются целиком на каждом обновлении — пишем только число строк
+        if counts_only:
+            record["n"] = result_sets
+            self.write(record)
+            return
+        keep_text = name in TRACE_KEEP_TEXT
+        scrubbed_sets = []
+        for rows in result_sets:
+            scrubbed_rows = []
+            for row in rows:
+                if isinstance(row, dict):
+                    scrubbed_rows.append(row)
+                    continue
+                scrubbed_rows.append([
+                    "***" if isinstance(v, str) and not keep_text else self.scrub_value(v)
+                    for v in row
+                ])
+            scrubbed_sets.append(scrubbed_rows)
+        record["r"] = scrubbed_sets
+        # Имена колонок нужны при воспроизведении, чтобы отличить наборы-метки пакетов
+        if columns and any(columns):
+            record["c"] = columns
+        self.write(record)
+
+class RecordingCursor:
+    """
+    Обёртка над курсором pyodbc, которая запоминает всё прочитанное и пишет это в трассу.
+    При counts_only вместо строк запоминает только их число по наборам.
+    """
+
+    def __init__(self, cursor, name, counts_only=False):
+        self.cursor = cursor
+        self.name = name
+        self.counts_only = counts_only
+        self.params = ()
+        self.result_sets = [0] if counts_only else [[]]
+        self.columns = [None]
+        self.duration = 0.0
+        self.error = None
+
+    def execute(self, sql, *params):
+        self.params = params
+        started = time.perf_counter()
+        try:
+            self.cursor.execute(sql, *params)
+        except Exception as e:
+            self.error = str(e)
+            raise
+        finally:
+            self.duration = time.perf_counter() - started
+        self.columns = [self.first_column()]
+        return self
+
+    def first_column(self):
+        description = self.cursor.description
+        return description[0][0] if description else None
+
+    def collect(self, rows):
+        if self.counts_only:
+            self.result_sets[-1] += len(rows)
+        else:
+            self.result_sets[-1].extend(rows)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.collect([row])
+        return row
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.collect(rows)
+        return rows
+
+    def fetchmany(self, size):
+        rows = self.cursor.fetchmany(size)
+        self.collect(rows)
+        return rows
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def nextset(self):
+        has_next = self.cursor.nextset()
+        # Результаты без колонок в трассу не пишем — при воспроизведении их бы прочитали как пустые
+        if has_next and self.cursor.description is not None:
+            self.result_sets.append(0 if self.counts_only else [])
+            self.columns.append(self.first_column())
+        return has_next
+
+    def cancel(self):
+        self.cursor.cancel()
+
+    def close(self):
+        try:
+            trace_recorder.record_db(
+                self.name, self.params, self.result_sets, self.duration, self.error, self.counts_only,
+                self.columns
+            )
+        except Exception as e:
+            logger.error(f"Failed to record {self.name} to trace: {e}")
+        self.cursor.close()
+
+class ReplayCursor:
+    """
+    Курсор фейковой БД: отдаёт записанные в трассе результаты для (имя запроса, параметры).
+    """
+
+    def __init__(self, replayer, name):
+        self.replayer = replayer
+        self.name = name
+        self.result_sets = []
+        self.rows = []
+        self.columns = []
+        self.column = None
+
+    @property
+    def description(self):
+        return ((self.column or "",),)
+
+    def execute(self, sql, *params):
+        record = self.replayer.next_result(self.name, params)
+        self.columns = list(record.get("c", [])) if record else []
+        if record is None:
+            self.result_sets = [[]]
+        else:
+            if self.replayer.simulate_latency:
+                time.sleep(record.get("d", 0))
+            if record.get("e"):
+                raise pyodbc.Error("HY000", record["e"])
+            # У массовых загрузок записано только число строк — отдаём пустые наборы
+            self.result_sets = [[tuple(row) for row in rows] for rows in record.get("r", [])] or [[]]
+        self.rows = self.result_sets.pop(0)
+        self.column = self.columns.pop(0) if self.columns else None
+        return self
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def nextset(self):
+        if not self.result_sets:
+            return False
+        self.rows = self.result_sets.pop(0)
+        self.column = self.columns.pop(0) if self.columns else None
+        return True
+
+class FakeBotAPIResponse:
+    status_code = 200
+
+    def __init__(self, result):
+        self.payload = {"ok": True, "result": result}
+        self.text = json.dumps(self.payload)
+
+    def json(self):
+        return self.payload
+
+class TraceReplayer:
+    """
+    Прогоняет трассу через обработчики бота с фейковой БД и фейковым Bot API.
+    """
+
+    def __init__(self, path, simulate_latency=True):
+        self.simulate_latency = simulate_latency
+        self.results = {}  # (имя, параметры) -> записи по порядку
+        self.updates = []
+        self.header = {}
+        self.lock = threading.Lock()
+        self.db_hits = 0
+        self.db_misses = 0
+        self.api_calls = Counter()
+        self.message_id = 0
+
+        with open_trace(path, "r") as f:
+            for line in f:
+                record = json.loads(line, object_hook=trace_decode)
+                if "v" in record:
+                    self.header = record
+                elif "u" in record:
+                    self.updates.append(record)
+                elif "db" in record:
+                    key = (record["db"], json.dumps(record["a"], default=trace_encode))
+                    self.results.setdefault(key, []).append(record)
+
+    def next_result(self, name, params):
+        # Строковые параметры в трассе заменены заглушкой — сопоставляем так же
+        key = (name, json.dumps(trace_params(name, params), default=trace_encode))
+        with self.lock:
+            records = self.results.get(key)
+            if not records:
+                self.db_misses += 1
+                return None
+            self.db_hits += 1
+            # Последний результат оставляем для повторных запросов сверх записанных
+            return records.pop(0) if len(records) > 1 else records[0]
+
+    def cursor(self, name):
+        return ReplayCursor(self, name)
+
+    def bot_api(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        method_name = url.rsplit("/", 1)[-1]
+        with self.lock:
+            self.api_calls[method_name] += 1
+            self.message_id += 1
+            message_id = self.message_id
+        if method_name == "getMe":
+            return FakeBotAPIResponse({"id": 1, "is_bot": True, "first_name": "bot", "username": "replay_bot"})
+        if method_name.startswith("send"):
+            chat_id = int((params or {}).get("chat_id", 0))
+            return FakeBotAPIResponse({
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}
+            })
+        return FakeBotAPIResponse(True)
+
+def start_trace_recorder(path):
+    """
+    Включает запись трассы: обёртка над получением обновлений и курсорами БД.
+    """
+    global trace_recorder
+    trace_recorder = TraceRecorder(path)
+    get_updates = telebot.apihelper.get_updates
+
+    def recording_get_updates(*args, **kwargs):
+        raw_updates = get_updates(*args, **kwargs)
+        for raw_update in raw_updates:
+            trace_recorder.record_update(raw_update)
+        return raw_updates
+
+    telebot.apihelper.get_updates = recording_get_updates
+    logger.info(f"Recording trace to {path}")
+
+def replay_trace(path, fast=False):
+    """
+    Воспроизводит трассу в темпе записи (или максимально быстро при fast=True)
+    и печатает сводку задержек обработки.
+    """
+    global trace_replayer
+    trace_replayer = TraceReplayer(path, simulate_latency=not fast)
+    manager_ids[:] = trace_replayer.header.get("managers", [])
+    opt_manager_ids[:] = trace_replayer.header.get("opt_managers", [])
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = trace_replayer.bot_api
+    bot.threaded = False
+
+    latencies = []
+    started = time.monotonic()
+    for record in trace_replayer.updates:
+        if not fast:
+            delay = record["t"] - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+        t0 = time.perf_counter()
+        try:
+            bot.process_new_updates([telebot.types.Update.de_json(record["u"])])
+        except Exception as e:
+            logger.error(f"Replay failed on update {record['u'].get('update_id')}: {e}")
+        latencies.append(time.perf_counter() - t0)
+
+    elapsed = time.monotonic() - started
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0.0
+
+    print(f"updates:      {len(latencies)} in {elapsed:.2f}s ({len(latencies) / elapsed if elapsed else 0:.1f}/s)")
+    print(f"latency ms:   p50={percentile(0.5):.1f} p95={percentile(0.95):.1f} p99={percentile(0.99):.1f} max={percentile(1):.1f}")
+    print(f"db results:   {trace_replayer.db_hits} replayed, {trace_replayer.db_misses} missing")
+    print(f"bot api:      {dict(trace_replayer.api_calls)}")
+
+# ─────────────────────────────────────────────────────────────────────────────
+# 9. Профилирование обработчиков по команде
+# ─────────────────────────────────────────────────────────────────────────────
+class UpdateProfiler:
+    """
+    Семплирующий профилировщик по настенному времени: пока сессия активна, фоновый поток
+    раз в PROFILE_INTERVAL_MS снимает стеки потоков, выполняющих обработчики, и копит их
+    в формате folded stacks (flamegraph.pl, speedscope, inferno). Когда сессия выключена,
+    обёртка обработчика стоит одну проверку флага.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.lock = threading.Lock()
+        self.running = {}  # thread ident -> имя обработчика
+        self.stacks = Counter()
+        self.handler_calls = Counter()
+        self.handler_seconds = Counter()
+        self.seen = 0
+        self.deadline = None
+        self.remaining = None
+        self.owner = None
+        self.started_at = None
+
+    def start(self, owner, minutes=None, updates=None):
+        with self.lock:
+            if self.active:
+                return False
+            self.stacks.clear()
+            self.handler_calls.clear()
+            self.handler_seconds.clear()
+            self.seen = 0
+            self.deadline = time.monotonic() + minutes * 60 if minutes else None
+            self.remaining = updates
+            self.owner = owner
+            self.started_at = datetime.now()
+            self.active = True
+        threading.Thread(target=self.sample_loop, name="Profiler", daemon=True).start()
+        logger.info(f"Profiling started by {owner}: minutes={minutes}, updates={updates}")
+        return True
+
+    def wrap(self, handler_name, func):
+        def profiled_handler(*args, **kwargs):
+            if not self.active:
+                return func(*args, **kwargs)
+            with self.lock:
+                self.seen += 1
+                sampled = self.seen % PROFILE_SAMPLE_EVERY == 0
+            if not sampled:
+                return func(*args, **kwargs)
+
+            ident = threading.get_ident()
+            self.running[ident] = handler_name
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.running.pop(ident, None)
+                with self.lock:
+                    self.handler_calls[handler_name] += 1
+                    self.handler_seconds[handler_name] += time.perf_counter() - started
+                    if self.remaining is not None:
+                        self.remaining -= 1
+                    finished = self.remaining is not None and self.remaining <= 0
+                if finished:
+                    self.stop()
+        profiled_handler.__name__ = func.__name__
+        self.wrapper_code = profiled_handler.__code__
+        return profiled_handler
+
+    def sample_loop(self):
+        interval = PROFILE_INTERVAL_MS / 1000
+        while self.active:
+            time.sleep(interval)
+            if self.deadline and time.monotonic() >= self.deadline:
+                self.stop()
+                break
+            frames = sys._current_frames()
+            for ident, handler_name in list(self.running.items()):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None and frame.f_code is not self.wrapper_code:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name}@{os.path.basename(code.co_filename)}:{code.co_firstlineno}")
+                    frame = frame.f_back
+                stack.append(handler_name)
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        with self.lock:
+            if not self.active:
+                return
+            self.active = False
+        threading.Thread(target=self.report, name="ProfilerReport", daemon=True).start()
+
+    def report(self):
+        """
+        Пишет folded stacks в PROFILE_DIR и отправляет сводку тому, кто запускал профилирование.
+        """
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"profile-{self.started_at:%Y%m%d-%H%M%S}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, samples in self.stacks.most_common():
+                f.write(f"{stack} {samples}\n")
+
+        lines = [f"📊 Профілювання завершено ({sum(self.handler_calls.values())} оновлень)"]
+        for handler_name, calls in self.handler_calls.most_common():
+            total = self.handler_seconds[handler_name]
+            lines.append(f"- {handler_name}: {calls} викл., сер. {total / calls * 1000:.0f} мс, всього {total:.1f} с")
+        leaf_samples = Counter()
+        for stack, samples in self.stacks.items():
+            leaf_samples[stack.rsplit(";", 1)[-1]] += samples
+        if leaf_samples:
+            lines.append("\nНайгарячіші функції (семпли):")
+            for leaf, samples in leaf_samples.most_common(5):
+                lines.append(f"- {leaf}: {samples}")
+        logger.info(f"Profiling finished, folded stacks written to {path}")
+
+        try:
+            bot.send_message(self.owner, "\n".join(lines))
+            with open(path, "rb") as f:
+                bot.send_document(self.owner, f, visible_file_name=os.path.basename(path))
+        except Exception as e:
+            logger.error(f"Failed to send profiling report to {self.owner}: {e}")
+
+update_profiler = UpdateProfiler()
+
+def install_handler_profiling():
+    """
+    Оборачивает все зарегистрированные обработчики бота профилировщиком.
+    """
+    for handlers in (bot.message_handlers, bot.callback_query_handlers, bot.inline_handlers):
+        for handler in handlers:
+            func = handler['function']
+            handler['function'] = update_profiler.wrap(func.__name__, func)
+
+@bot.message_handler(commands=['profile'])
+def handle_profile_command(message):
+    uid = message.from_user.id
+    logger.debug(f"[/profile] from {uid}: {message.text}")
+    if uid not in manager_ids:
+        bot.reply_to(message, "У вас немає доступу до цієї команди.")
+        return
+
+    args = message.text.split()[1:]
+    if args and args[0] == "off":
+        if update_profiler.active:
+            update_profiler.stop()
+            bot.reply_to(message, "⏹ Профілювання зупинено, звіт буде надіслано.")
+        else:
+            bot.reply_to(message, "Профілювання не запущено.")
+        return
+
+    if not args:
+        if update_profiler.active:
+            bot.reply_to(message, f"Профілювання працює з {update_profiler.started_at:%H:%M:%S}. Зупинити: /profile off")
+        else:
+            bot.reply_to(message, "Використання: /profile <хвилин>m | /profile <кількість оновлень> | /profile off")
+        return
+
+    value = args[0]
+    # 0 хвилин / 0 оновлень означало бы профилирование без ограничения — не принимаем
+    if value.endswith("m") and value[:-1].isdigit() and int(value[:-1]) > 0:
+        minutes, updates = min(int(value[:-1]), PROFILE_MAX_MINUTES), None
+    elif value.isdigit() and int(value) > 0:
+        minutes, updates = PROFILE_MAX_MINUTES, int(value)
+    else:
+        bot.reply_to(message, "Використання: /profile <хвилин>m | /profile <кількість оновлень> | /profile off")
+        return
+
+    if update_profiler.start(uid, minutes=minutes, updates=updates):
+        bot.reply_to(message, f"▶️ Профілювання запущено ({f'{updates} оновлень, ' if updates else ''}до {minutes} хв).")
+    else:
+        bot.reply_to(message, "Профілювання вже запущено. Зупинити: /profile off")
+
+# ─────────────────────────────────────────────────────────────────────────────
+# 10. Статистика работы
+# ─────────────────────────────────────────────────────────────────────────────
+class RateWindow:
+    """
+    Скользящее окно счётчика по секундам: add() за O(1), rate() — событий в секунду за окно.
+    """
+
+    def __init__(self, seconds=60):
+        self.seconds = seconds
+        self.buckets = [0] * seconds
+        self.stamps = [0] * seconds
+        self.lock = threading.Lock()
+
+    def add(self, n=1):
+        now = int(time.time())
+        i = now % self.seconds
+        with self.lock:
+            if self.stamps[i] != now:
+                self.stamps[i] = now
+                self.buckets[i] = 0
+            self.buckets[i] += n
+
+    def rate(self):
+        now = int(time.time())
+        with self.lock:
+            total = sum(count for count, stamp in zip(self.buckets, self.stamps) if now - stamp < self.seconds)
+        return total / self.seconds
+
+# Вызовы Bot API по методам
+bot_api_calls = Counter()
+bot_api_errors = Counter()
+bot_api_throttled = Counter()  # ответы 429 Too Many Requests
+bot_api_rates = defaultdict(RateWindow)
+bot_api_latency = defaultdict(lambda: deque(maxlen=DB_LATENCY_SAMPLES))
+
+def record_bot_api_call(method_name, status_code, elapsed):
+    bot_api_calls[method_name] += 1
+    bot_api_rates[method_name].add()
+    bot_api_latency[method_name].append(elapsed)
+    if status_code == 429:
+        bot_api_throttled[method_name] += 1
+    elif status_code is None or status_code >= 400:
+        bot_api_errors[method_name] += 1
+
+class BotApiRetry(Retry):
+    """
+    Повтор по ответу сервера — только 503 с Retry-After: после 502/504 шлюза сообщение
+    могло уже уйти, и повтор sendMessage/sendPhoto продублировал бы его.
+    """
+    RETRY_AFTER_STATUS_CODES = frozenset({503})
+
+def make_bot_api_session():
+    """
+    Сессия Bot API с общим пулом keep-alive соединений на BOT_API_POOL_SIZE: потоки не открывают
+    TCP/TLS заново на каждый вызов и при нехватке соединений ждут свободное, а не плодят новые.
+    Повторяются сбои соединения (запрос не ушёл) и 503 с Retry-After; таймаут чтения и 502/504
+    не повторяются — сообщение могло уже уйти.
+    """
+    retry = BotApiRetry(
+        total=BOT_API_RETRIES, connect=BOT_API_RETRIES, read=0, status=BOT_API_RETRIES,
+        status_forcelist=(), allowed_methods=None, respect_retry_after_header=True,
+        backoff_factor=BOT_API_RETRY_BACKOFF, raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=BOT_API_POOL_SIZE, pool_block=True, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+bot_api_session = make_bot_api_session() if BOT_API_POOLED else None
+# Таймауты (connect, read) pyTelegramBotAPI передаёт в instrumented_request_sender
+telebot.apihelper.CONNECT_TIMEOUT = BOT_API_CONNECT_TIMEOUT
+telebot.apihelper.READ_TIMEOUT = BOT_API_READ_TIMEOUT
+
+thread_bot_api_sessions = threading.local()
+
+def thread_bot_api_session():
+    """
+    Сессия requests своего потока — как у pyTelegramBotAPI без общего пула (BOT_API_POOLED=0).
+    """
+    session = getattr(thread_bot_api_sessions, "session", None)
+    if session is None:
+        session = thread_bot_api_sessions.session = requests.Session()
+    return session
+
+def instrumented_request_sender(method, url, params=None, files=None, timeout=None, proxies=None):
+    """
+    Отправка запроса к Bot API через общий пул (bot_api_session) или сессию своего потока
+    со сбором статистики: вызовы, ошибки, 429 и задержка по методам.
+    """
+    method_name = url.rsplit("/", 1)[-1]
+    session = bot_api_session or thread_bot_api_session()
+    started = time.perf_counter()
+    try:
+        response = session.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+    except Exception:
+        record_bot_api_call(method_name, None, time.perf_counter() - started)
+        raise
+    record_bot_api_call(method_name, response.status_code, time.perf_counter() - started)
+    return response
+
+telebot.apihelper.CUSTOM_REQUEST_SENDER = instrumented_request_sender
+
+def percentile_ms(samples, p):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 1)
+
+def cache_stats(cache):
+    total = cache.hits + cache.misses
+    return {
+        "size": len(cache),
+        "hits": cache.hits,
+        "misses": cache.misses,
+        "hit_ratio": round(cache.hits / total, 3) if total else None
+    }
+
+def collect_runtime_stats():
+    """
+    Снимок состояния бота из счётчиков в памяти процесса (без запросов к БД).
+    """
+    now = time.time()
+    pending = {}
+    for request_key, request in pending_requests.items():
+        age = now - request["created"]
+        item = pending.setdefault(request["type"], {"count": 0, "oldest_s": 0, "older_than_15m": 0})
+        item["count"] += 1
+        item["oldest_s"] = max(item["oldest_s"], int(age))
+        if age > 15 * 60:
+            item["older_than_15m"] += 1
+
+    db = {}
+    for name, samples in list(db_helper_latency.items()):
+        samples = list(samples)
+        db[name] = {
+            "count": db_helper_counts[name],
+            "p50_ms": percentile_ms(samples, 0.5),
+            "p95_ms": percentile_ms(samples, 0.95),
+            "p99_ms": percentile_ms(samples, 0.99)
+        }
+
+    bot_api = {}
+    for method_name, calls in list(bot_api_calls.items()):
+        samples = list(bot_api_latency[method_name])
+        bot_api[method_name] = {
+            "calls": calls,
+            "per_minute": round(bot_api_rates[method_name].rate() * 60, 1),
+            "throttled_429": bot_api_throttled[method_name],
+            "errors": bot_api_errors[method_name],
+            "p50_ms": percentile_ms(samples, 0.5),
+            "p95_ms": percentile_ms(samples, 0.95)
+        }
+
+    queues = {}
+    if bot.threaded and getattr(bot, "worker_pool", None):
+        queues["telebot_worker_pool"] = bot.worker_pool.tasks.qsize()
+
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "pid": os.getpid(),
+        "known_users": len(user_context),
+        "pending_requests": pending,
+        "db": db,
+        "db_classes": {
+            "queries": dict(db_query_counts),
+            "deadline_hits": dict(db_deadline_hits),
+            "cancelled": dict(db_cancelled)
+        },
+        "mysql_sales_circuit": {
+            "state": mysql_sales_breaker.state,
+            "open_count": mysql_sales_breaker.open_count
+        },
+        "bot_api": bot_api,
+        "caches": {
+            "inline_products": cache_stats(inline_product_cache),
+            "linked_last_good": cache_stats(linked_server_last_good),
+            "interest_index": cache_stats(interest_index),
+            "shop_directory": {"size": len(shop_directory), "hit_ratio": None},
+            "pricelist": cache_stats(pricelist_cache)
+        },
+        "order_journal": {
+            "written": order_journal.written,
+            "batches": order_journal.batches,
+            "queued": len(order_journal.pending),
+            "write_errors": order_journal.write_errors
+        } if order_journal else None,
+        "single_flight": {
+            name: {"calls": calls, "merged": single_flight.merged[name]}
+            for name, calls in single_flight.calls.items()
+        },
+        "throttle": {
+            "allowed": request_throttle.allowed,
+            "duplicates": request_throttle.duplicates,
+            "throttled": request_throttle.throttled
+        },
+        "opt_routing": {
+            "mode": OPT_ROUTING,
+            "cards_sent": opt_routing_counter["sent"],
+            "broadcast_equivalent": opt_routing_counter["broadcast_equivalent"],
+            "escalated": opt_routing_counter["reassigned"],
+            "pending_by_manager": dict(opt_manager_load()) if OPT_ROUTING != "broadcast" else None
+        },
+        "request_timers": {
+            "scheduled": len(request_scheduler),
+            "fired": dict(request_scheduler.fired),
+            **request_deadline_counter
+        },
+        "catalog_size": len(catalog_index),
+        "stock_watches": len(stock_watches),
+        "queues": queues,
+        "update_pipeline": update_pipeline.stats()
+    }
+
+def format_runtime_stats(stats):
+    lines = [f"📈 Стан бота на {stats['time']} (pid {stats['pid']})"]
+    lines.append(f"Відомі користувачі: {stats['known_users']}, підписки /watch: {stats['stock_watches']}, каталог: {stats['catalog_size']}")
+
+    lines.append("\n⏳ Заявки в очікуванні:")
+    if not stats['pending_requests']:
+        lines.append("- немає")
+    for request_type, item in stats['pending_requests'].items():
+        lines.append(f"- {request_type}: {item['count']} (найстаріша {item['oldest_s'] // 60} хв, >15 хв: {item['older_than_15m']})")
+
+    lines.append("\n🗄 Запити до БД (p50/p95/p99, мс):")
+    for name, item in sorted(stats['db'].items(), key=lambda kv: -(kv[1]['p95_ms'] or 0)):
+        lines.append(f"- {name}: {item['count']} • {item['p50_ms']}/{item['p95_ms']}/{item['p99_ms']}")
+    deadline_hits = sum(stats['db_classes']['deadline_hits'].values())
+    lines.append(f"Перевищень таймауту: {deadline_hits}, mysql_sales: {stats['mysql_sales_circuit']['state']}")
+
+    merged = {name: item for name, item in stats['single_flight'].items() if item['merged']}
+    if merged:
+        lines.append("Об'єднано однакових запитів: " + ", ".join(
+            f"{name} {item['merged']}/{item['calls']}" for name, item in sorted(merged.items())))
+
+    throttle = stats['throttle']
+    lines.append(f"Запити товарів: {throttle['allowed']}, повтори: {throttle['duplicates']}, обмежено: {throttle['throttled']}")
+
+    routing = stats['opt_routing']
+    if routing['mode'] != "broadcast":
+        lines.append(f"Заявки опту ({routing['mode']}): карток {routing['cards_sent']} "
+                     f"замість {routing['broadcast_equivalent']}, передано {routing['escalated']}")
+
+    timers = stats['request_timers']
+    lines.append(f"⏱ Строки заявок: в черзі {timers['scheduled']}, нагадувань {timers.get('reminded', 0)}, "
+                 f"ескалацій {timers.get('escalated', 0)}, закрито {timers.get('expired', 0)}")
+
+    lines.append("\n📨 Bot API (викликів • за хв • 429 • p50/p95 мс):")
+    for method_name, item in sorted(stats['bot_api'].items()):
+        lines.append(f"- {method_name}: {item['calls']} • {item['per_minute']} • {item['throttled_429']} • "
+                     f"{item['p50_ms']}/{item['p95_ms']}")
+
+    lines.append("\n💾 Кеші (hit ratio):")
+    for name, item in stats['caches'].items():
+        lines.append(f"- {name}: {item['hit_ratio']} ({item['size']} записів)")
+
+    journal = stats['order_journal']
+    if journal:
+        lines.append(f"\n📒 Журнал заказів: записано {journal['written']} ({journal['batches']} пачок), "
+                     f"в черзі {journal['queued']}, помилок {journal['write_errors']}")
+
+    if stats['queues']:
+        lines.append("\n📥 Черги: " + ", ".join(f"{name}={depth}" for name, depth in stats['queues'].items()))
+
+    pipeline = {kind: item for kind, item in stats['update_pipeline'].items() if item['enqueued']}
+    if pipeline:
+        lines.append("\n📥 Оновлення (в черзі • оброблено • скинуто • очікування p50/p95 мс):")
+        for kind, item in pipeline.items():
+            lines.append(f"- {kind}: {item['queued']} • {item['processed']} • {item['dropped']} • "
+                         f"{item['wait_p50_ms']}/{item['wait_p95_ms']}")
+    return "\n".join(lines)
+
+@bot.message_handler(commands=['stats'])
+def handle_stats_command(message):
+    uid = message.from_user.id
+    logger.debug(f"[/stats] from {uid}")
+    if uid not in manager_ids:
+        bot.reply_to(message, "У вас немає доступу до цієї команди.")
+        return
+    for chunk in split_text(format_runtime_stats(collect_runtime_stats())):
+        bot.send_message(uid, chunk)
+
+class StatsHTTPHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/stats"):
+            self.send_error(404)
+            return
+        body = json.dumps(collect_runtime_stats(), ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"[stats_http] {format % args}")
+
+def start_stats_server(port):
+    """
+    Отдаёт collect_runtime_stats() в JSON на http://STATS_HTTP_HOST:port/stats.
+    """
+    server = ThreadingHTTPServer((STATS_HTTP_HOST, port), StatsHTTPHandler)
+    threading.Thread(target=server.serve_forever, name="StatsHTTP", daemon=True).start()
+    logger.info(f"Stats endpoint listening on http://{STATS_HTTP_HOST}:{port}/stats")
+
+def start_order_journal():
+    """
+    Восстанавливает состояние заявок из журнала и запускает фоновую запись.
+    """
+    if order_journal is None:
+        return
+    try:
+        order_journal.recover()
+    except Exception as e:
+        logger.error(f"Failed to recover order journal {order_journal.path}: {e}")
+    order_journal.start()
+
+def replay_order_journal(path, key=None):
+    """
+    Быстрое воспроизведение журнала для аудита: итоговые состояния заявок или история одной заявки.
+    """
+    states = {}
+    records = 0
+    for record in OrderJournal.read(path):
+        OrderJournal.apply(states, record)
+        records += 1
+        if key and record["key"] == key:
+            details = {k: v for k, v in record.items() if k not in ("ts", "ev", "key")}
+            print(f"{datetime.fromtimestamp(record['ts']):%Y-%m-%d %H:%M:%S} {record['ev']:18} {details}")
+    if key:
+        return
+
+    print(f"records: {records}, orders: {len(states)}")
+    print(f"by status:   {dict(Counter(state['status'] for state in states.values()))}")
+    print(f"transfers:   {dict(Counter(state['transfer'] or 'none' for state in states.values()))}")
+    in_doubt = [key for key, state in states.items() if state["transfer"] == "started"]
+    if in_doubt:
+        print("unknown result (create_transfer_opt_bot started, no outcome):")
+        for order_key in in_doubt:
+            print(f"  {order_key}")
+
+
+def bench_product_view(code, runs):
+    """
+    Сравнивает сборку карточки товара отдельными запросами и одним пакетом:
+    задержка (p50/p95/среднее) и число round trip к БД на одну карточку.
+    Выполняется против настроенной БД; режимы чередуются, чтобы уравнять влияние кэшей сервера.
+    """
+    ensure_shop_directory()
+    modes = {"separate": False, "batched": True}
+    latencies = {mode: [] for mode in modes}
+    round_trips = Counter()
+    for _ in range(runs):
+        for mode, batched in modes.items():
+            # Интересы иначе отдал бы индекс — сравниваем полный сбор данных
+            interest_index.rows.pop(code, None)
+            queries_before = sum(db_query_counts.values())
+            started = time.perf_counter()
+            view = fetch_product_view(code, MANAGER_VIEW_SECTIONS, batched=batched)
+            latencies[mode].append(time.perf_counter() - started)
+            round_trips[mode] += sum(db_query_counts.values()) - queries_before
+            if view is None:
+                print(f"product {code} not found")
+                return
+
+    for mode in modes:
+        samples = latencies[mode]
+        mean_ms = sum(samples) / len(samples) * 1000
+        print(f"{mode:9} p50={percentile_ms(samples, 0.5)} ms p95={percentile_ms(samples, 0.95)} ms "
+              f"mean={mean_ms:.1f} ms round trips/view={round_trips[mode] / runs:.1f}")
+
+class BotApiStandInHandler(BaseHTTPRequestHandler):
+    """
+    Локальная замена api.telegram.org для bench_bot_api: keep-alive HTTP/1.1, на любой метод
+    отвечает {"ok": true}. Установка соединения стоит 2×rtt (TCP + TLS), каждый запрос — rtt.
+    """
+    protocol_version = "HTTP/1.1"
+    rtt = 0.02
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with BotApiStandInHandler.lock:
+            BotApiStandInHandler.connections += 1
+        time.sleep(2 * self.rtt)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        time.sleep(self.rtt)
+        body = json.dumps({"ok": True, "result": {"message_id": 1, "date": 0,
+                                                  "chat": {"id": 1, "type": "private"}}}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+def bench_bot_api(runs, fanout, rtt_ms):
+    """
+    Сравнивает задержку одного sendMessage против локальной замены Bot API:
+    new_session — новое соединение на каждый вызов (сессия на один раз),
+    per_thread — сессии по потокам (как в pyTelegramBotAPI), fan-out в новых потоках (как у разовых рассылок),
+    pooled — общий пул bot_api_session. В каждом прогоне fanout отправок идут параллельно.
+    """
+    BotApiStandInHandler.rtt = rtt_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BotApiStandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="BotApiStandIn", daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+    pooled_session = bot_api_session or make_bot_api_session()
+
+    def send_new_session():
+        with requests.Session() as session:
+            return session.post(url, params={"chat_id": 1, "text": "bench"})
+
+    def send_per_thread():
+        return thread_bot_api_session().post(url, params={"chat_id": 1, "text": "bench"})
+
+    def send_pooled():
+        return pooled_session.post(url, params={"chat_id": 1, "text": "bench"})
+
+    modes = {"new_session": send_new_session, "per_thread": send_per_thread, "pooled": send_pooled}
+    latencies = {mode: [] for mode in modes}
+    connections = Counter()
+    lock = threading.Lock()
+    for _ in range(runs):
+        for mode, send in modes.items():
+            def timed_send():
+                started = time.perf_counter()
+                send().raise_for_status()
+                with lock:
+                    latencies[mode].append(time.perf_counter() - started)
+
+            connections_before = BotApiStandInHandler.connections
+            threads = [threading.Thread(target=timed_send) for _ in range(fanout)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            connections[mode] += BotApiStandInHandler.connections - connections_before
+    server.shutdown()
+
+    print(f"stand-in rtt={rtt_ms} ms, {runs} runs × {fanout} parallel sends, pool size {BOT_API_POOL_SIZE}")
+    for mode in modes:
+        samples = latencies[mode]
+        mean_ms = sum(samples) / len(samples) * 1000
+        print(f"{mode:11} p50={percentile_ms(samples, 0.5)} ms p95={percentile_ms(samples, 0.95)} ms "
+              f"mean={mean_ms:.1f} ms connections/send={connections[mode] / len(samples):.2f}")
+
 # ─────────────────────────────────────────────────────────────────────────────
-# 7. Запуск polling
+# 11. Запуск polling
 # ─────────────────────────────────────────────────────────────────────────────
+install_handler_profiling()
+
+def update_user_id(raw_update):
+    """
+    Telegram ID пользователя, от которого пришло обновление (для разбиения по воркерам).
+    """
+    for key, value in raw_update.items():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("chat") or {}
+            if "id" in sender:
+                return sender["id"]
+    return 0
+
+class UpdatePipeline:
+    """
+    Ограниченные очереди обновлений по типам с приоритетом: кнопки менеджеров, кнопки клиентов,
+    сообщения, inline-запросы. Потоки-обработчики берут обновление из самой приоритетной непустой
+    очереди. Полная очередь притормаживает опрос Telegram (необработанное остаётся на стороне
+    Telegram), после UPDATE_ENQUEUE_TIMEOUT обновление сбрасывается; inline-запрос вместо ожидания
+    вытесняет самый старый — на него уже никто не ждёт ответа.
+    Обновления одного пользователя обрабатываются по одному и в порядке поступления (как у
+    воркеров по user_id % N): поток берёт обновление, только если пользователь сейчас не
+    обрабатывается и это его самое раннее обновление в очередях.
+    """
+    KINDS = ("manager_callback", "callback", "message", "inline")
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.queues = {kind: deque() for kind in self.KINDS}
+        self.cond = threading.Condition()
+        self.seq = itertools.count()
+        self.user_seqs = defaultdict(deque)  # user_id -> номера его обновлений в очередях, по порядку
+        self.busy = set()                    # user_id, чьё обновление сейчас обрабатывается
+        self.enqueued = Counter()
+        self.processed = Counter()
+        self.dropped = Counter()
+        self.wait = defaultdict(lambda: deque(maxlen=DB_LATENCY_SAMPLES))
+
+    @staticmethod
+    def kind_of(raw_update):
+        callback = raw_update.get("callback_query")
+        if callback:
+            uid = callback.get("from", {}).get("id")
+            return "manager_callback" if uid in manager_ids or uid in opt_manager_ids else "callback"
+        if "inline_query" in raw_update or "chosen_inline_result" in raw_update:
+            return "inline"
+        return "message"
+
+    def put(self, raw_update, timeout):
+        kind = self.kind_of(raw_update)
+        uid = update_user_id(raw_update)
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            queue = self.queues[kind]
+            while len(queue) >= self.maxsize:
+                if kind == "inline":
+                    _, dropped_seq, dropped_uid, _ = queue.popleft()
+                    self.forget_seq(dropped_uid, dropped_seq)
+                    self.dropped[kind] += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.dropped[kind] += 1
+                    logger.warning(f"Update queue {kind} is full, dropping update {raw_update.get('update_id')}")
+                    return False
+                self.cond.wait(remaining)
+            seq = next(self.seq)
+            queue.append((time.monotonic(), seq, uid, raw_update))
+            self.user_seqs[uid].append(seq)
+            self.enqueued[kind] += 1
+            self.cond.notify_all()
+        return True
+
+    def forget_seq(self, uid, seq):
+        seqs = self.user_seqs[uid]
+        seqs.remove(seq)
+        if not seqs:
+            del self.user_seqs[uid]
+
+    def get(self):
+        with self.cond:
+            while True:
+                for kind in self.KINDS:
+                    queue = self.queues[kind]
+                    for i, (queued_at, seq, uid, raw_update) in enumerate(queue):
+                        if uid in self.busy or self.user_seqs[uid][0] != seq:
+                            continue
+                        del queue[i]
+                        self.forget_seq(uid, seq)
+                        self.busy.add(uid)
+                        self.wait[kind].append(time.monotonic() - queued_at)
+                        # Место освободилось — будим опрос, если он ждёт
+                        self.cond.notify_all()
+                        return kind, uid, raw_update
+                self.cond.wait()
+
+    def done(self, kind, uid):
+        with self.cond:
+            self.busy.discard(uid)
+            self.processed[kind] += 1
+            # Следующее обновление этого пользователя теперь можно брать
+            self.cond.notify_all()
+
+    def worker_loop(self):
+        while True:
+            kind, uid, raw_update = self.get()
+            try:
+                bot.process_new_updates([telebot.types.Update.de_json(raw_update)])
+            except Exception as e:
+                logger.error(f"Failed to process {kind} update {raw_update.get('update_id')}: {e}")
+            finally:
+                self.done(kind, uid)
+
+    def stats(self):
+        with self.cond:
+            lengths = {kind: len(queue) for kind, queue in self.queues.items()}
+        result = {}
+        for kind in self.KINDS:
+            samples = list(self.wait[kind])
+            result[kind] = {
+                "queued": lengths[kind],
+                "enqueued": self.enqueued[kind],
+                "processed": self.processed[kind],
+                "dropped": self.dropped[kind],
+                "wait_p50_ms": percentile_ms(samples, 0.5),
+                "wait_p95_ms": percentile_ms(samples, 0.95)
+            }
+        return result
+
+update_pipeline = UpdatePipeline(UPDATE_QUEUE_SIZE)
+
+def run_update_pipeline():
+    """
+    Один процесс: опрос getUpdates (только ALLOWED_UPDATES) в очереди update_pipeline,
+    обработка в UPDATE_WORKERS потоках.
+    """
+    bot.threaded = False
+    for i in range(UPDATE_WORKERS):
+        threading.Thread(target=update_pipeline.worker_loop, name=f"UpdateWorker-{i}", daemon=True).start()
+    logger.info(f"Update pipeline started: {UPDATE_WORKERS} workers, queue size {UPDATE_QUEUE_SIZE}, "
+                f"allowed updates {ALLOWED_UPDATES}")
+    offset = None
+    while True:
+        try:
+            raw_updates = telebot.apihelper.get_updates(TELEGRAM_BOT_TOKEN, offset=offset, timeout=20,
+                                                        long_polling_timeout=20, allowed_updates=ALLOWED_UPDATES)
+        except Exception as e:
+            logger.error(f"Failed to get updates: {e}")
+            time.sleep(1)
+            continue
+
+        for raw_update in raw_updates:
+            offset = raw_update["update_id"] + 1
+            update_pipeline.put(raw_update, UPDATE_ENQUEUE_TIMEOUT)
+
+def run_worker(index, queue):
+    """
+    Процесс-воркер: обрабатывает обновления своей доли пользователей строго по очереди,
+    поэтому порядок сообщений каждого пользователя сохраняется.
+    """
+    logger.info(f"Worker {index} started (pid={os.getpid()}, store={STATE_STORE})")
+    bot.threaded = False
+    start_order_journal()
+    threading.Thread(target=catalog_refresh_loop, name="CatalogRefresh", daemon=True).start()
+    threading.Thread(target=interest_refresh_loop, name="InterestRefresh", daemon=True).start()
+    threading.Thread(target=shop_directory_refresh_loop, name="ShopDirectory", daemon=True).start()
+    if STATS_HTTP_PORT:
+        start_stats_server(STATS_HTTP_PORT + 1 + index)
+    while True:
+        raw_update = queue.get()
+        if raw_update is None:
+            break
+        try:
+            bot.process_new_updates([telebot.types.Update.de_json(raw_update)])
+        except Exception as e:
+            logger.error(f"Worker {index} failed to process update {raw_update.get('update_id')}: {e}")
+    logger.info(f"Worker {index} stopped")
+
+def run_dispatcher(workers_count):
+    """
+    Процесс-диспетчер: забирает обновления из Telegram и раздаёт их воркерам по user_id % N.
+    Упавший воркер перезапускается.
+    """
+    mp = multiprocessing.get_context("spawn")
+    queues = [mp.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(workers_count)]
+    workers = [None] * workers_count
+    # Сроки заявок после рестарта восстанавливает и выполняет диспетчер: он не перезапускается
+    # вместе с воркерами; воркеры ставят сроки своих новых заявок
+    start_order_journal()
+    rebuild_request_timers()
+
+    def ensure_worker(i):
+        if workers[i] is None or not workers[i].is_alive():
+            if workers[i] is not None:
+                logger.error(f"Worker {i} died with exit code {workers[i].exitcode}, restarting")
+                # Сроки заявок упавшего воркера пропали вместе с ним
+                rebuild_request_timers()
+            workers[i] = mp.Process(target=run_worker, args=(i, queues[i]), name=f"BotWorker-{i}", daemon=True)
+            workers[i].start()
+
+    for i in range(workers_count):
+        ensure_worker(i)
+
+    logger.info(f"Dispatcher started with {workers_count} workers")
+    offset = None
+    while True:
+        try:
+            raw_updates = telebot.apihelper.get_updates(TELEGRAM_BOT_TOKEN, offset=offset, timeout=20,
+                                                        long_polling_timeout=20, allowed_updates=ALLOWED_UPDATES)
+        except Exception as e:
+            logger.error(f"Failed to get updates: {e}")
+            time.sleep(1)
+            continue
+
+        for raw_update in raw_updates:
+            offset = raw_update["update_id"] + 1
+            i = update_user_id(raw_update) % workers_count
+            ensure_worker(i)
+            queues[i].put(raw_update)
+
 if __name__ == "__main__":
-    logger.info("Starting bot polling…")
-    bot.polling(non_stop=True)
+    parser = argparse.ArgumentParser(description="Goods OPT bot")
+    parser.add_argument("--replay", metavar="TRACE", help="воспроизвести записанную трассу вместо запуска бота")
+    parser.add_argument("--fast", action="store_true", help="воспроизводить без пауз (не в темпе записи)")
+    parser.add_argument("--bench-product-view", metavar="CODE", type=int,
+                        help="сравнить сборку карточки товара отдельными запросами и одним пакетом")
+    parser.add_argument("--bench-runs", type=int, default=20, help="число прогонов для --bench-product-view и --bench-bot-api")
+    parser.add_argument("--bench-bot-api", action="store_true",
+                        help="сравнить задержку отправки через разовые, поточные и общую сессии (локальная замена Bot API)")
+    parser.add_argument("--bench-fanout", type=int, default=8, help="параллельных отправок в прогоне --bench-bot-api")
+    parser.add_argument("--bench-rtt-ms", type=float, default=20, help="имитируемая сетевая задержка для --bench-bot-api")
+    parser.add_argument("--journal", metavar="PATH", help="прочитать журнал заказов и вывести сводку (аудит)")
+    parser.add_argument("--journal-key", metavar="KEY", help="с --journal: вывести историю одной заявки")
+    args = parser.parse_args()
+
+    if args.journal:
+        replay_order_journal(args.journal, args.journal_key)
+        sys.exit(0)
+
+    if args.replay:
+        replay_trace(args.replay, fast=args.fast)
+        sys.exit(0)
+
+    if args.bench_product_view:
+        bench_product_view(args.bench_product_view, args.bench_runs)
+        sys.exit(0)
+
+    if args.bench_bot_api:
+        bench_bot_api(args.bench_runs, args.bench_fanout, args.bench_rtt_ms)
+        sys.exit(0)
+
+    if TRACE_RECORD_PATH:
+        if BOT_WORKERS > 1:
+            logger.warning("TRACE_RECORD_PATH is ignored in multi-worker mode")
+        else:
+            start_trace_recorder(TRACE_RECORD_PATH)
+
+    threading.Thread(target=stock_watch_loop, name="StockWatch", daemon=True).start()
+    if BOT_WORKERS > 1:
+        run_dispatcher(BOT_WORKERS)
+    else:
+        start_order_journal()
+        rebuild_request_timers()
+        threading.Thread(target=catalog_refresh_loop, name="CatalogRefresh", daemon=True).start()
+        threading.Thread(target=interest_refresh_loop, name="InterestRefresh", daemon=True).start()
+        threading.Thread(target=shop_directory_refresh_loop, name="ShopDirectory", daemon=True).start()
+        if STATS_HTTP_PORT:
+            start_stats_server(STATS_HTTP_PORT)
+        logger.info("Starting bot polling…")
+        run_update_pipeline()